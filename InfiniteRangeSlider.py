@@ -14,6 +14,8 @@ NUM_TICKS = 500
 class InfiniteRangeSlider(QWidget):
     # Define signal
     valueChanged = Signal(float)
+    # Emitted as the slider is dragged, before it's released and the value actually changes
+    valueTracking = Signal(float)
 
     def __init__(self, startValue):
         super(InfiniteRangeSlider, self).__init__()
@@ -62,6 +64,12 @@ class InfiniteRangeSlider(QWidget):
         self.spinbox.blockSignals(True)
         self.spinbox.setValue(newVal)
         self.spinbox.blockSignals(False)
+        self.valueTracking.emit(newVal)
+
+    # Show the value greyed out and in italics, for an approximate value (e.g. a preview while solving)
+    def setApproximate(self, approximate):
+        self.spinbox.setStyleSheet("color: gray; font-style: italic;" if approximate else "")
+        self.spinbox.setToolTip("Approximate value - still solving" if approximate else "")
 
     # When the slider is released, jump it back to its centre position, and update the widget's internal value
     # Or if the spinner is updated
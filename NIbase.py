@@ -1,5 +1,23 @@
+import math
+
+
 def addDescVarOrRecurse(returnVal, expr, exprSetter):
     if expr.isComposite():
         returnVal.extend(expr.getDescendantVarsAndSetters())
     else:
-        returnVal.append((expr, exprSetter))
\ No newline at end of file
+        returnVal.append((expr, exprSetter))
+
+def allTrue(condition):
+    # Whether a condition holds - conditions on array values (e.g. when solving an NIObjectArray) must hold for every element
+    return bool(condition.all()) if hasattr(condition, "all") else bool(condition)
+
+
+# math functions by name, and their numpy equivalents for array values
+_numpyFunctionNames = {"sin": "sin", "cos": "cos", "tan": "tan", "asin": "arcsin", "acos": "arccos", "atan": "arctan", "log": "log"}
+
+def applyFunction(name, value):
+    # Apply a function from math to a value, or the numpy version of it to an array of values
+    if hasattr(value, "shape"):
+        import numpy
+        return getattr(numpy, _numpyFunctionNames[name])(value)
+    return getattr(math, name)(value)
@@ -0,0 +1,107 @@
+# asyncio entry points for solving, for using the solver from an event loop without blocking it
+# Each solve runs Problem.solve in an executor (the loop's default thread pool unless another is given), so the loop
+# carries on while it works. Cancelling the task awaiting a solve cancels the solve itself, through a cancel token in
+# its budget (see budgets.py), and waits for it to stop, so abandoned solves don't go on using a thread.
+# Streams of solves are async generators which only read more inputs as results are taken, so a slow consumer holds
+# back the solving (backpressure) rather than results piling up
+# N.B. The executor must use threads, not processes, as each solve writes its solution into its context. Solves in
+# threads share the problem safely (see SolveResult), but being mostly pure Python, they keep the loop responsive
+# rather than solving faster
+
+import asyncio
+import collections
+
+from budgets import SolveBudget
+
+# Default number of solves in flight at once in a stream
+DEFAULT_MAX_CONCURRENT = 4
+
+
+async def solveAsync(problem, context=False, refContext=False, budget=None, executor=None):
+    """
+    Solve a problem without blocking the event loop (see Problem.solve)
+    :param executor: concurrent.futures executor to solve in (defaults to the loop's default executor)
+    :return: SolveResult
+    """
+    # A token of our own, so cancelling this solve doesn't cancel others sharing the budget
+    budget = (budget if budget is not None else SolveBudget()).linkedCopy()
+    future = asyncio.get_running_loop().run_in_executor(executor, problem.solve, context, refContext, budget)
+    try:
+        return await asyncio.shield(future)
+    except asyncio.CancelledError:
+        budget.cancelToken.cancel()
+        # Let the solve stop before passing on the cancellation
+        await asyncio.wait([future])
+        raise
+
+
+async def iterate(rows):
+    # Go through a plain or an async iterable
+    if hasattr(rows, "__aiter__"):
+        async for row in rows:
+            yield row
+    else:
+        for row in rows:
+            yield row
+
+
+def makeContext(problem, inputs):
+    # As in batchsolver.sweep, each solve starts from the problem's default context
+    context = problem.defaultContext.copy()
+    context.varVals.update(inputs)
+    return context
+
+
+async def sweepAsync(problem, inputRows, warmStart=True, budget=None, executor=None):
+    """
+    Solve a problem once for each set of input values, one after another, as batchsolver.sweep does
+    Each set is only solved once the result before it has been taken
+
+    :param inputRows: iterable or async iterable of dicts mapping variable names to values
+    :param warmStart: use each solution as the starting point for any numerical solving in the next
+    :param budget: optional budgets.SolveBudget for each solve; cancelling its cancelToken stops the sweep
+    :return: async generator of (context, SolveResult) tuples, one per set of inputs
+    """
+    refContext = False
+    async for inputs in iterate(inputRows):
+        context = makeContext(problem, inputs)
+        result = await solveAsync(problem, context, refContext, budget, executor)
+        if result and warmStart:
+            refContext = context
+        yield (context, result)
+        if budget is not None and budget.cancelToken is not None and budget.cancelToken.isCancelled():
+            return
+
+
+async def solveStream(problem, inputRows, refContext=False, budget=None, executor=None, maxConcurrent=DEFAULT_MAX_CONCURRENT):
+    """
+    Solve a problem for each set of input values, several at once, giving the results in the order of the inputs
+    At most maxConcurrent solves are in flight or waiting to be taken at any time; closing the stream (or cancelling
+    the task reading it) cancels them
+
+    :param inputRows: iterable or async iterable of dicts mapping variable names to values
+    :param refContext: starting points for any numerical solving, shared by every solve (there's no warm start, as the
+        solves overlap)
+    :return: async generator of (context, SolveResult) tuples, one per set of inputs
+    """
+    pending = collections.deque()
+    try:
+        async for inputs in iterate(inputRows):
+            context = makeContext(problem, inputs)
+            pending.append((context, asyncio.ensure_future(solveAsync(problem, context, refContext, budget, executor))))
+            if len(pending) >= maxConcurrent:
+                (context, task) = pending.popleft()
+                yield (context, await task)
+        while pending:
+            (context, task) = pending.popleft()
+            yield (context, await task)
+    finally:
+        for (context, task) in pending:
+            task.cancel()
+        if pending:
+            await asyncio.gather(*[task for (context, task) in pending], return_exceptions=True)
+
+
+async def solveBatchAsync(problem, inputRows, refContext=False, budget=None, executor=None, maxConcurrent=DEFAULT_MAX_CONCURRENT):
+    # Solve for every set of input values, several at once (see solveStream), returning a list of (context, SolveResult)
+    return [item async for item in solveStream(problem, inputRows, refContext, budget, executor, maxConcurrent)]
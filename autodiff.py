@@ -0,0 +1,124 @@
+# Gradients of a solved problem's results with respect to its inputs, by reverse-mode automatic differentiation
+# The constraints R(x, p) = 0 link the unknowns x to the inputs p, so for a metric m(x, p) the chain rule gives
+#   dm/dp = dm/dp (holding x) - lambda . dR/dp   where   (dR/dx)^T lambda = dm/dx
+# i.e. the adjoints lambda come from a single (sparse) linear solve, whatever the number of inputs - this differentiates
+# implicitly through numerically-solved blocks just as through analytically-solved constraints.
+# The partial derivatives themselves come from a reverse pass over the problem's tape (Tape.reverseJacobian), so a full
+# gradient costs about as much as one solve.
+
+from expressions import Expression, FixedValue
+from tape import Tape
+
+
+class ExpressionResidual:
+    # Stands in for a constraint "expr = 0", so that a tape can be compiled for a lone expression
+    # (only what Tape needs - it isn't a real constraint that could be added to a problem)
+    def __init__(self, expr):
+        self.name = "Residual of " + expr.getName()
+        self.expr = expr
+
+    def getSides(self):
+        return (self.expr, FixedValue(0.0), None)
+
+    def getResidual(self, context):
+        return self.expr.getValue(context)
+
+
+def getMetric(problem, metric):
+    """
+    The expression for a metric
+    :param metric: an expression, the name of a variable in the problem, or a formula in .prob syntax (e.g. "a.W + b.W")
+    """
+    if isinstance(metric, Expression):
+        return metric
+    expr = problem.symbols.lookup(metric)
+    if expr is None:
+        from probparser import LineParser, ProbSyntaxError
+
+        def findVar(name):
+            var = problem.symbols.lookup(name)
+            if var is None:
+                raise ProbSyntaxError("unknown name " + name)
+            return var
+        expr = LineParser(findVar).parseFormula(metric)
+    return expr
+
+
+def gradient(problem, context, metric, inputs):
+    """
+    Gradient of a metric with respect to a problem's inputs, at a solution
+    Every variable in the problem's constraints that isn't an input is taken to be determined by them, so the inputs must
+    be every variable that had a value before solving (see solveWithGradient), not just those of interest
+
+    :param context: a context the problem has been solved in (scalar values only, not arrays)
+    :param metric: an expression, variable name or formula (see getMetric)
+    :param inputs: names of the input variables
+    :return: dict of the metric's derivative with respect to each input, by name (NaN if the constraints are singular there)
+    """
+    return gradients(problem, context, [metric], inputs)[0]
+
+
+def gradients(problem, context, metrics, inputs):
+    """
+    Gradients of several metrics at once (see gradient), sharing the constraints' Jacobian and its factorisation
+    :return: list of dicts of each metric's derivatives with respect to each input, by name
+    """
+    import numpy as np
+    import scipy.sparse.linalg
+    from sparsenewton import sparsityPattern
+    inputs = list(inputs)
+    tape = problem.getTape()
+    (residuals, jacobian) = tape.reverseJacobian(tape.getValues(context))
+    inputSet = set(inputs)
+    unknownCols = [slot for (slot, name) in enumerate(tape.slotNames) if name not in inputSet]
+    inputCols = [tape.slotIndex[name] for name in inputs if name in tape.slotIndex]
+    dRdx = jacobian[:, unknownCols]
+    # Constraints only between inputs (i.e. consistency checks) don't determine anything, so leave them out
+    # N.B. going by which variables they refer to, not by their derivatives, which can be zero at a singular point
+    rows = np.flatnonzero(sparsityPattern(tape, unknownCols).getnnz(axis=1))
+    dRdx = dRdx[rows]
+    dRdp = jacobian[rows][:, inputCols]
+    # Factorised when first needed, then reused for every metric
+    factors = []
+    results = []
+    for metric in metrics:
+        metricTape = Tape([ExpressionResidual(getMetric(problem, metric))])
+        metricGradient = metricTape.reverseJacobian(metricTape.getValues(context))[1].toarray()[0]
+        # The metric's partial derivatives with respect to the unknowns and the inputs
+        metricSlots = metricTape.slotIndex
+        dmdx = np.array([metricGradient[metricSlots[tape.slotNames[slot]]] if tape.slotNames[slot] in metricSlots else 0.0
+                         for slot in unknownCols])
+        result = {name: metricGradient[metricSlots[name]] if name in metricSlots else 0.0 for name in inputs}
+        if unknownCols and dmdx.any():
+            if dRdx.shape[0] < dRdx.shape[1]:
+                raise ValueError("More unknowns than constraints - the inputs must include every variable that was given a value")
+            if dRdx.shape[0] == dRdx.shape[1]:
+                if not factors:
+                    try:
+                        factors.append(scipy.sparse.linalg.splu(dRdx.T.tocsc()))
+                    except RuntimeError:
+                        # Singular
+                        factors.append(None)
+                adjoints = factors[0].solve(dmdx) if factors[0] is not None else np.full(len(dmdx), np.nan)
+            else:
+                # More constraints than unknowns (consistent, or the problem wouldn't have solved) - use the least-squares adjoints
+                adjoints = scipy.sparse.linalg.lsqr(dRdx.T, dmdx)[0]
+            adjoints = np.atleast_1d(adjoints)
+            total = dRdp.T.dot(adjoints)
+            for (name, value) in zip((name for name in inputs if name in tape.slotIndex), total):
+                result[name] -= value
+        results.append({name: float(value) for (name, value) in result.items()})
+    return results
+
+
+def solveWithGradient(problem, context, metric, refContext=False):
+    """
+    Solve a problem, then find the gradient of a metric with respect to every input (i.e. every variable with a value
+    before solving)
+    :return: (True if solved else False, dict of derivatives by input name - empty if not solved)
+    """
+    variables = problem.getVariables()
+    inputs = [name for name in variables if context.varVals.get(name) is not None]
+    if not problem.solve(context, refContext):
+        return (False, {})
+    return (True, gradient(problem, context, metric, inputs))
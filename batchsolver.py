@@ -0,0 +1,71 @@
+# Batch solving of a problem over many sets of input values, e.g. for parameter sweeps
+
+import itertools
+
+import numpy as np
+
+from resultexport import writerForFilename, DEFAULT_CHUNK_SIZE
+
+
+def gridInputs(ranges):
+    """
+    Make every combination of the given input values
+    :param ranges: dict mapping variable names to sequences of values for that variable
+    :return: generator of dicts mapping variable names to values
+    """
+    names = list(ranges.keys())
+    for values in itertools.product(*[ranges[name] for name in names]):
+        yield dict(zip(names, values))
+
+
+def sweep(problem, inputRows, warmStart=True, budget=None):
+    """
+    Solve a problem once for each set of input values
+    Each solve starts from the problem's default context, so variables given a default value are inputs unless overridden
+
+    :param problem: the Problem to solve
+    :param inputRows: iterable of dicts mapping variable names to values (a value of None makes that variable an output)
+    :param warmStart: use each solution as the starting point for any numerical solving in the next
+    :param budget: optional budgets.SolveBudget for each solve, so one badly-behaved row can't stall the whole sweep;
+        cancelling its cancelToken stops the sweep after the row being solved
+    :return: generator of (context, status) tuples, one per set of inputs
+    """
+    refContext = False
+    for inputs in inputRows:
+        context = problem.defaultContext.copy()
+        context.varVals.update(inputs)
+        result = problem.solve(context, refContext, budget)
+        if result and warmStart:
+            refContext = context
+        # N.B. A partial solve still gives every value that could be determined
+        yield (context, result.status)
+        if budget is not None and budget.cancelToken is not None and budget.cancelToken.isCancelled():
+            return
+
+
+def runSweep(problem, inputRows, filename, fieldnames=None, chunkSize=DEFAULT_CHUNK_SIZE, warmStart=True, budget=None):
+    """
+    Solve a problem for each set of input values, streaming the results to disk as they are found
+    The format is chosen from the file extension (see resultexport.RESULT_WRITERS)
+
+    :param fieldnames: names of the variables to record (defaults to all the problem's variables)
+    :return: the number of rows written
+    """
+    if fieldnames is None:
+        fieldnames = problem.getVariableNames()
+    with writerForFilename(filename, fieldnames, chunkSize=chunkSize) as writer:
+        writer.writeRows(sweep(problem, inputRows, warmStart, budget))
+    return writer.numRows
+
+
+def evaluateResiduals(problem, contexts):
+    """
+    Work out the residual of every constraint in a problem for many contexts at once (e.g. to check a sweep's solutions),
+    in a single pass of the problem's tape
+    Undefined values give NaN residuals
+
+    :return: array with a row per context and a column per constraint, in the order of problem.getTape().constrs
+    """
+    tape = problem.getTape()
+    values = np.array([tape.getValues(context) for context in contexts]).reshape(-1, len(tape.slotNames))
+    return tape.evaluate(values.T).T
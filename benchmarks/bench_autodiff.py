@@ -0,0 +1,79 @@
+# Gradient benchmark
+# Finds the gradient of one result of a generated model with respect to all its inputs, by reverse-mode automatic
+# differentiation (autodiff.gradient) and by finite differences (one extra solve per input)
+# Run from anywhere: python benchmarks/bench_autodiff.py [--inputs N] [--fd-inputs N]
+
+import argparse
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+
+from autodiff import gradient
+from parsedproblem import ParsedProblem
+
+
+def generateModel(numInputs):
+    # A chain of running totals, each adding a term that has to be solved for numerically from one input
+    lines = []
+    for i in range(1, numInputs + 1):
+        lines.append("p%d := %s" % (i, 1.0 + 0.01 * i))
+        lines.append("x%d + sin(x%d) / 4 = p%d" % (i, i, i))
+        lines.append(("s%d = s%d + x%d * x%d" % (i, i - 1, i, i)) if i > 1 else "s1 = x1 * x1")
+    return lines
+
+
+def solve(problem, inputs=None):
+    context = problem.defaultContext.copy()
+    if inputs:
+        context.varVals.update(inputs)
+    with contextlib.redirect_stdout(io.StringIO()):
+        assert problem.solve(context)
+    return context
+
+
+def main():
+    argParser = argparse.ArgumentParser(description=__doc__)
+    argParser.add_argument("--inputs", type=int, default=300, help="number of inputs to differentiate with respect to")
+    argParser.add_argument("--fd-inputs", type=int, default=10, help="number of inputs to time finite differences for (the rest are extrapolated)")
+    args = argParser.parse_args()
+
+    with tempfile.NamedTemporaryFile("w", suffix=".prob", delete=False) as modelFile:
+        modelFile.write("\n".join(generateModel(args.inputs)))
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            problem = ParsedProblem(modelFile.name)
+    finally:
+        os.remove(modelFile.name)
+    inputs = ["p%d" % i for i in range(1, args.inputs + 1)]
+    metric = "s%d" % args.inputs
+
+    start = time.perf_counter()
+    context = solve(problem)
+    solveSeconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    adjointGradient = gradient(problem, context, metric, inputs)
+    adjointSeconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    base = context.varVals[metric]
+    for name in inputs[:args.fd_inputs]:
+        step = 1e-6 * max(1.0, abs(context.varVals[name]))
+        perturbed = solve(problem, {name: context.varVals[name] + step})
+        assert np.isclose((perturbed.varVals[metric] - base) / step, adjointGradient[name], rtol=1e-4)
+    fdSeconds = (time.perf_counter() - start) * args.inputs / args.fd_inputs
+
+    print("%-26s %10.3f s" % ("one solve", solveSeconds))
+    print("%-26s %10.3f s  (%d inputs)" % ("gradient (adjoint)", adjointSeconds, args.inputs))
+    print("%-26s %10.3f s  (extrapolated from %d inputs)" % ("gradient (finite diff.)", fdSeconds, args.fd_inputs))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+# Solve budget benchmark
+# Sweeps a model with a large coupled block over inputs where some rows have no real solution, so the root-finders
+# struggle, with and without a per-block time budget, and reports the per-row latency distribution
+# Run from anywhere: python benchmarks/bench_budget.py [--unknowns N] [--rows N] [--block-seconds S]
+
+import argparse
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+
+from batchsolver import sweep
+from budgets import SolveBudget
+from parsedproblem import ParsedProblem
+
+
+def generateModel(n):
+    # v[i]^2 + v[i+1] / 10 = c, wrapping around - which has no real solution when c is much below zero
+    lines = ["v%d^2 + v%d / 10 = c" % (i, (i + 1) % n) for i in range(n)]
+    return lines
+
+
+def timedSweep(problem, rows, budget):
+    times = []
+    statuses = []
+    start = time.perf_counter()
+    for (context, status) in sweep(problem, rows, warmStart=False, budget=budget):
+        now = time.perf_counter()
+        times.append(now - start)
+        statuses.append(status)
+        start = now
+    return (np.array(times), statuses)
+
+
+def main():
+    argParser = argparse.ArgumentParser(description=__doc__)
+    argParser.add_argument("--unknowns", type=int, default=250, help="size of the coupled block")
+    argParser.add_argument("--rows", type=int, default=10, help="number of rows in the sweep")
+    argParser.add_argument("--block-seconds", type=float, default=0.1, help="time budget per numerical block")
+    args = argParser.parse_args()
+
+    with tempfile.NamedTemporaryFile("w", suffix=".prob", delete=False) as modelFile:
+        modelFile.write("\n".join(generateModel(args.unknowns)))
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            problem = ParsedProblem(modelFile.name)
+    finally:
+        os.remove(modelFile.name)
+    # Every fifth row is hopeless
+    rows = [{"c": -5.0 if i % 5 == 4 else 1.0 + 0.1 * i} for i in range(args.rows)]
+    for (label, budget) in [("no budget", None), ("%g s per block" % args.block_seconds, SolveBudget(blockSeconds=args.block_seconds))]:
+        with contextlib.redirect_stdout(io.StringIO()):
+            (times, statuses) = timedSweep(problem, rows, budget)
+        print("%-16s median %8.3f s  p95 %8.3f s  max %8.3f s  total %8.3f s  statuses %s" % (
+            label, np.median(times), np.percentile(times, 95), times.max(), times.sum(),
+            {status: statuses.count(status) for status in sorted(set(statuses))}))
+
+
+if __name__ == "__main__":
+    main()
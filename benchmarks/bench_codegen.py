@@ -0,0 +1,82 @@
+# Generated solver module benchmark
+# Solves a model - a long chain of analytic steps plus a small coupled nonlinear block - with the interpreted solver
+# and with a module generated from it (see codegen.py), and times importing each in a fresh process
+# Run from anywhere: python benchmarks/bench_codegen.py [--chain N] [--solves N]
+
+import argparse
+import contextlib
+import io
+import os
+import py_compile
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from codegen import writeModule
+from equationsolver import Context
+from parsedproblem import ParsedProblem
+
+
+def generateModel(n):
+    # x0 given; x[i+1] = 1.01 * x[i] + 0.5; then u and w coupled nonlinearly to the end of the chain
+    lines = ["x0 := 1.0"]
+    lines.extend("x%d = 1.01 * x%d + 0.5" % (i + 1, i) for i in range(n))
+    lines.append("u + sin(w) = x%d / 100" % n)
+    lines.append("u * w = 2")
+    return lines
+
+
+def timeImport(code, directory, repeats=5):
+    times = []
+    for i in range(repeats):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", code], cwd=directory, check=True, capture_output=True)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main():
+    argParser = argparse.ArgumentParser(description=__doc__)
+    argParser.add_argument("--chain", type=int, default=500, help="length of the chain of analytic steps")
+    argParser.add_argument("--solves", type=int, default=200, help="number of solves to time")
+    args = argParser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    modelFilename = os.path.join(directory, "model.prob")
+    with open(modelFilename, "w") as modelFile:
+        modelFile.write("\n".join(generateModel(args.chain)))
+    with contextlib.redirect_stdout(io.StringIO()):
+        problem = ParsedProblem(modelFilename)
+        writeModule(problem, os.path.join(directory, "generated_model.py"), refContext=Context({"u": 1.0, "w": 1.0}))
+    # As it would be once deployed (even if PYTHONDONTWRITEBYTECODE is set here)
+    py_compile.compile(os.path.join(directory, "generated_model.py"))
+    sys.path.insert(0, directory)
+    import generated_model
+
+    inputs = [1.0 + 0.001 * i for i in range(args.solves)]
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        for value in inputs:
+            context = problem.defaultContext.copy()
+            context.varVals["x0"] = value
+            assert problem.solve(context)
+        interpreted = (time.perf_counter() - start) / args.solves
+    start = time.perf_counter()
+    for value in inputs:
+        generated_model.solve({"x0": value})
+    generated = (time.perf_counter() - start) / args.solves
+    print("%-28s %10.3f ms per solve" % ("interpreted solver", interpreted * 1000.0))
+    print("%-28s %10.3f ms per solve  (%.0fx faster)" % ("generated module", generated * 1000.0, interpreted / generated))
+    # (Fresh processes, so these include the interpreter's own start-up)
+    print("%-28s %10.3f ms" % ("bare interpreter", 1000.0 * timeImport("pass", directory)))
+    print("%-28s %10.3f ms" % ("import solver and parse", 1000.0 * timeImport(
+        "import sys; sys.path.insert(0, %r); from parsedproblem import ParsedProblem; ParsedProblem('model.prob')" % REPO_DIR, directory)))
+    print("%-28s %10.3f ms" % ("import generated module", 1000.0 * timeImport("import generated_model", directory)))
+
+
+if __name__ == "__main__":
+    main()
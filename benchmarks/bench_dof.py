@@ -0,0 +1,50 @@
+# Degree-of-freedom analysis benchmark
+# Times setting up a DOFAnalyzer for a large generated model, toggling inputs one at a time (as the GUI does when an
+# "Input?" box is clicked), and producing the full report
+# Run from anywhere: python benchmarks/bench_dof.py [--lines N] [--toggles N]
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_tape import loadModel
+from dofanalyzer import DOFAnalyzer
+
+
+def main():
+    argParser = argparse.ArgumentParser(description=__doc__)
+    argParser.add_argument("--lines", type=int, default=20000, help="size of model")
+    argParser.add_argument("--toggles", type=int, default=2000, help="number of inputs to toggle")
+    args = argParser.parse_args()
+
+    problem = loadModel(args.lines)
+    start = time.perf_counter()
+    analyzer = DOFAnalyzer(problem)
+    setupSeconds = time.perf_counter() - start
+
+    names = problem.getVariableNames()
+    rng = random.Random(0)
+    toggles = [rng.choice(names) for i in range(args.toggles)]
+    start = time.perf_counter()
+    for name in toggles:
+        analyzer.setInput(name, not analyzer.isInput(name))
+        analyzer.getMissingInputs()
+    toggleSeconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    report = analyzer.getReport()
+    reportSeconds = time.perf_counter() - start
+
+    print("%d constraints, %d variables" % (len(problem.constrs), len(names)))
+    print("%-12s %10.3f ms" % ("set up", 1e3 * setupSeconds))
+    print("%-12s %10.1f us per toggle" % ("toggle", 1e6 * toggleSeconds / args.toggles))
+    print("%-12s %10.3f ms" % ("full report", 1e3 * reportSeconds))
+    print(report.missingInputs, "missing inputs,", report.excessConstraints, "excess constraints")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+# Monte Carlo benchmark
+# Propagates input distributions through a model - an analytic step and a small coupled nonlinear block - with
+# montecarlo.MonteCarlo, which solves a batch of samples at once, and with a plain loop of Problem.solve calls
+# Run from anywhere: python benchmarks/bench_montecarlo.py [--samples N] [--loop N] [--batch N]
+
+import argparse
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from equationsolver import Context
+from montecarlo import MonteCarlo, uniformSamples
+from parsedproblem import ParsedProblem
+
+MODEL = """
+F ~ normal(1000, 50)
+L ~ uniform(1.9, 2.1)
+k ~ lognormal(0, 0.1)
+M = F * L / 4
+x * y = M / 100
+x + sin(y) = k * 10
+"""
+
+
+def main():
+    argParser = argparse.ArgumentParser(description=__doc__)
+    argParser.add_argument("--samples", type=int, default=1000000, help="number of samples for the batched engine")
+    argParser.add_argument("--loop", type=int, default=200, help="number of samples to time with a loop of solves")
+    argParser.add_argument("--batch", type=int, default=100000, help="samples per batch")
+    args = argParser.parse_args()
+
+    modelFilename = os.path.join(tempfile.mkdtemp(), "model.prob")
+    with open(modelFilename, "w") as modelFile:
+        modelFile.write(MODEL)
+    refContext = Context({"x": 9.0, "y": 0.5})
+    with contextlib.redirect_stdout(io.StringIO()):
+        problem = ParsedProblem(modelFilename)
+        start = time.perf_counter()
+        for i in range(args.loop):
+            context = problem.defaultContext.copy()
+            for (name, distribution) in problem.distributions.items():
+                context.varVals[name] = float(distribution.ppf(uniformSamples(0, name, i, 1))[0])
+            assert problem.solve(context, refContext)
+        loop = (time.perf_counter() - start) / args.loop
+        start = time.perf_counter()
+        result = MonteCarlo(problem, refContext=refContext).run(args.samples, outputs=["M", "x", "y"], batchSize=args.batch)
+        batched = (time.perf_counter() - start) / args.samples
+    print(result.summary())
+    print("%-28s %10.3f us per sample" % ("loop of solves", loop * 1e6))
+    print("%-28s %10.3f us per sample  (%.0fx faster)" % ("batched Monte Carlo", batched * 1e6, loop / batched))
+    print("%-28s %10.1f s" % ("estimated loop time", loop * args.samples))
+
+
+if __name__ == "__main__":
+    main()
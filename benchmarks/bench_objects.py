@@ -0,0 +1,131 @@
+# Object array benchmark
+# Solves a fleet of identical objects as separate NIObjects (one problem holding every copy) and as one NIObjectArray,
+# and measures the time and memory taken to create the NIObjects
+# Also times loading and solving a .prob file that defines a class and instantiates it many times
+# Run from anywhere: python benchmarks/bench_objects.py [--count N] [--object-count N] [--parsed-count N]
+
+import argparse
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+
+from constraints import EqualityConstraint
+from equationsolver import Problem
+from expressions import ScalarVariable, ProductExpression, QuotientExpression, FixedValue
+from objects import NIClass, NIObject, NIObjectArray
+from parsedproblem import ParsedProblem
+
+# The same part as makeClass, as .prob file syntax
+PART_CLASS = """
+class Part {
+    F = m * a "Newton's 2nd law"
+    v = a * t "Velocity"
+    s = v * t / 2 "Distance"
+    F := 100
+    t := 2
+}
+"""
+
+
+def makeClass():
+    # A part with a few analytically-solvable equations
+    m = ScalarVariable("m")
+    F = ScalarVariable("F", 100.0)
+    a = ScalarVariable("a")
+    t = ScalarVariable("t", 2.0)
+    v = ScalarVariable("v")
+    s = ScalarVariable("s")
+    return NIClass("Part", [m, F, a, t, v, s], [
+        EqualityConstraint("Newton's 2nd law", F, ProductExpression(m, a)),
+        EqualityConstraint("Velocity", v, ProductExpression(a, t)),
+        EqualityConstraint("Distance", s, QuotientExpression(ProductExpression(v, t), FixedValue(2.0))),
+    ])
+
+
+def timeObjects(count):
+    niclass = makeClass()
+    masses = np.linspace(1.0, 10.0, count)
+    start = time.perf_counter()
+    problem = Problem("Fleet of objects")
+    for i in range(count):
+        obj = NIObject("part" + str(i), niclass)
+        obj.getVar("m").value = masses[i]
+        problem.addObj(obj)
+    with contextlib.redirect_stdout(io.StringIO()):
+        assert problem.solve(problem.defaultContext.copy())
+    return time.perf_counter() - start
+
+
+def measureConstruction(count):
+    # Time and memory (bytes per object) to create objects, not counting the class they share
+    niclass = makeClass()
+    tracemalloc.start()
+    start = time.perf_counter()
+    objs = [NIObject("part" + str(i), niclass) for i in range(count)]
+    seconds = time.perf_counter() - start
+    (size, peak) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return (seconds, size / count)
+
+
+def timeObjectArray(count):
+    niclass = makeClass()
+    start = time.perf_counter()
+    fleet = NIObjectArray("part", niclass, count)
+    fleet.setValues("m", np.linspace(1.0, 10.0, count))
+    with contextlib.redirect_stdout(io.StringIO()):
+        assert fleet.solve()
+    return time.perf_counter() - start
+
+
+def timeParsedObjects(count):
+    # Load and solve a file defining the class and instantiating it count times
+    lines = [PART_CLASS] + ["Part part%d(m = %g)" % (i, 1.0 + i % 10) for i in range(count)]
+    with tempfile.NamedTemporaryFile("w", suffix=".prob", delete=False) as modelFile:
+        modelFile.write("\n".join(lines))
+    try:
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            problem = ParsedProblem(modelFile.name)
+            loaded = time.perf_counter()
+            assert problem.solve(problem.defaultContext.copy())
+        return (loaded - start, time.perf_counter() - loaded)
+    finally:
+        os.remove(modelFile.name)
+
+
+def report(name, count, seconds):
+    print("%-24s %8d objects %10.3f s %10.2f us/object" % (name, count, seconds, 1e6 * seconds / count))
+
+
+def main():
+    argParser = argparse.ArgumentParser(description=__doc__)
+    argParser.add_argument("--count", type=int, default=100000, help="number of objects in the object array")
+    argParser.add_argument("--object-count", type=int, default=2000, help="number of separate (much slower) NIObjects")
+    argParser.add_argument("--parsed-count", type=int, default=10000, help="number of objects instantiated in a .prob file")
+    args = argParser.parse_args()
+
+    report("NIObjectArray", args.count, timeObjectArray(args.count))
+    if args.object_count:
+        report("NIObject per instance", args.object_count, timeObjects(args.object_count))
+        (seconds, bytesPerObject) = measureConstruction(args.object_count)
+        report("NIObject construction", args.object_count, seconds)
+        print("%-24s %8d objects %10.0f bytes/object" % ("NIObject memory", args.object_count, bytesPerObject))
+    if args.parsed_count:
+        # Twice as many objects should take twice as long
+        for count in [args.parsed_count // 2, args.parsed_count]:
+            (loadSeconds, solveSeconds) = timeParsedObjects(count)
+            report("Parsed objects: load", count, loadSeconds)
+            report("Parsed objects: solve", count, solveSeconds)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+# Design optimisation benchmark
+# Optimises a model - a long chain of analytic steps plus a small coupled nonlinear block - with designoptimizer, and
+# with the naive approach of scipy.optimize.minimize over fresh solves with finite-difference gradients
+# Run from anywhere: python benchmarks/bench_optimizer.py [--chain N]
+
+import argparse
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+import numpy as np
+import scipy.optimize
+
+from designoptimizer import DesignOptimizer
+from equationsolver import Context
+from parsedproblem import ParsedProblem
+
+
+def generateModel(n):
+    # Design variables a and b; x0 = a, x[i+1] = 1.001 * x[i] + 0.001 * b; then u and w coupled nonlinearly to the end
+    # of the chain, and a cost to minimise
+    lines = ["a := 1.0", "b := 1.0", "x0 = a"]
+    lines.extend("x%d = 1.001 * x%d + 0.001 * b" % (i + 1, i) for i in range(n))
+    lines.append("u + sin(w) = x%d" % n)
+    lines.append("u * w = b")
+    lines.append("cost = (u - 1)^2 + (w - 0.5)^2 + 0.1 * a^2")
+    return lines
+
+
+def main():
+    argParser = argparse.ArgumentParser(description=__doc__)
+    argParser.add_argument("--chain", type=int, default=500, help="length of the chain of analytic steps")
+    args = argParser.parse_args()
+
+    modelFilename = os.path.join(tempfile.mkdtemp(), "model.prob")
+    with open(modelFilename, "w") as modelFile:
+        modelFile.write("\n".join(generateModel(args.chain)))
+    refContext = Context({"u": 1.0, "w": 1.0, "cost": 0.0})
+    bounds = {"a": (0.1, 5.0), "b": (0.1, 5.0)}
+    with contextlib.redirect_stdout(io.StringIO()):
+        problem = ParsedProblem(modelFilename)
+        start = time.perf_counter()
+        result = DesignOptimizer(problem, "cost", ["a", "b"], bounds, ["u >= 0.2"], refContext=refContext).optimize()
+        optimized = time.perf_counter() - start
+
+        solves = [0]
+
+        def cost(x):
+            context = problem.defaultContext.copy()
+            context.varVals.update(a=x[0], b=x[1])
+            assert problem.solve(context, refContext)
+            solves[0] += 1
+            return context.varVals["cost"]
+
+        def margin(x):
+            context = problem.defaultContext.copy()
+            context.varVals.update(a=x[0], b=x[1])
+            assert problem.solve(context, refContext)
+            solves[0] += 1
+            return context.varVals["u"] - 0.2
+
+        start = time.perf_counter()
+        naive = scipy.optimize.minimize(cost, [1.0, 1.0], method="SLSQP", bounds=[bounds["a"], bounds["b"]],
+                                        constraints=[{"type": "ineq", "fun": margin}], tol=1e-8)
+        naiveTime = time.perf_counter() - start
+    print("design optimizer: cost %.8f at a = %.6f, b = %.6f" % (result.objective, result.design["a"], result.design["b"]))
+    print("naive:            cost %.8f at a = %.6f, b = %.6f" % (naive.fun, naive.x[0], naive.x[1]))
+    print("%-28s %8.3f s  %4d solves" % ("design optimizer", optimized, result.solves))
+    print("%-28s %8.3f s  %4d solves  (%.1fx slower)" % ("naive", naiveTime, solves[0], naiveTime / optimized))
+    assert np.isclose(result.objective, naive.fun, rtol=1e-4, atol=1e-8)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+# Parser throughput benchmark
+# Generates a large .prob model and times the line parser (probparser) against the original pyparsing grammar (legacyparser),
+# then times loading the whole model into a ParsedProblem, and measures the memory taken by the parsed expressions
+# Run from anywhere: python benchmarks/bench_parser.py [--lines N] [--legacy-lines N] [--load-lines N] [--memory-lines N]
+
+import argparse
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# The target: a 50,000 line model parsed in well under a second, i.e. under 20 us/line
+TARGET_US_PER_LINE = 20.0
+
+from expressions import ScalarVariable
+import legacyparser
+from parsedproblem import ParsedProblem
+from probparser import LineParser
+
+
+def generateModel(numLines):
+    # A model with a realistic mix of equations, initialisations, constants, comments and blank lines
+    lines = []
+    for i in range(numLines):
+        if i % 50 == 0:
+            lines.append("# Section " + str(i // 50))
+        elif i % 50 == 1:
+            lines.append("c" + str(i) + " == 2 * pi * 1.5e-3")
+        elif i % 10 == 0:
+            lines.append("u" + str(i - 10) + " := " + str(i) + ".5")
+        elif i % 25 == 0:
+            lines.append("")
+        else:
+            lines.append("v%d = 2.5*v%d + sin(w%d)^2 - 3/(u%d + 1) * cos(v%d) \"Equation %d\"  # comment" % (i, i - 1, i % 100, i - i % 10, i - 2, i))
+    return lines
+
+
+def varFinder():
+    # Variable lookup by dictionary, so that we're timing the parsers and not the problem's variable handling
+    variables = {}
+    def findVar(name):
+        if name not in variables:
+            variables[name] = ScalarVariable(name)
+        return variables[name]
+    return findVar
+
+
+def timeNewParser(lines):
+    parser = LineParser(varFinder())
+    start = time.perf_counter()
+    for line in lines:
+        parser.parseLine(line)
+    return time.perf_counter() - start
+
+
+def timeLegacyParser(lines):
+    lineParser = legacyparser.getLineParser()
+    findVar = varFinder()
+    start = time.perf_counter()
+    for line in lines:
+        parsedLine = lineParser.parseString(line)
+        if parsedLine.constraint:
+            legacyparser.parseExpr(parsedLine[0], findVar)
+            legacyparser.parseExpr(parsedLine[1], findVar)
+        elif parsedLine.varinit or parsedLine.constdef:
+            legacyparser.parseExpr(parsedLine[1], findVar)
+    return time.perf_counter() - start
+
+
+def timeLoad(lines):
+    with tempfile.NamedTemporaryFile("w", suffix=".prob", delete=False) as modelFile:
+        modelFile.write("\n".join(lines))
+    try:
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            ParsedProblem(modelFile.name)
+        return time.perf_counter() - start
+    finally:
+        os.remove(modelFile.name)
+
+
+def measureMemory(lines):
+    # Bytes of expressions (and variables) per line, for the parsed lines all kept in memory at once
+    parser = LineParser(varFinder())
+    tracemalloc.start()
+    parsedLines = [parser.parseLine(line) for line in lines]
+    (size, peak) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return size / len(lines)
+
+
+def report(name, numLines, seconds):
+    print("%-36s %8d lines %10.3f s %10.1f us/line" % (name, numLines, seconds, 1e6 * seconds / numLines))
+
+
+def main():
+    argParser = argparse.ArgumentParser(description=__doc__)
+    argParser.add_argument("--lines", type=int, default=50000, help="size of model for the line parser")
+    argParser.add_argument("--legacy-lines", type=int, default=5000, help="size of model for the (much slower) pyparsing grammar")
+    argParser.add_argument("--load-lines", type=int, default=100000, help="size of model to load into a ParsedProblem")
+    argParser.add_argument("--memory-lines", type=int, default=50000, help="size of model to measure the memory of")
+    args = argParser.parse_args()
+
+    seconds = timeNewParser(generateModel(args.lines))
+    report("probparser.LineParser", args.lines, seconds)
+    usPerLine = 1e6 * seconds / args.lines
+    if usPerLine < TARGET_US_PER_LINE:
+        print("  meets the target of %.0f us/line" % TARGET_US_PER_LINE)
+    else:
+        print("  MISSES the target of %.0f us/line, by %.1fx" % (TARGET_US_PER_LINE, usPerLine / TARGET_US_PER_LINE))
+    if args.legacy_lines:
+        report("legacyparser (pyparsing)", args.legacy_lines, timeLegacyParser(generateModel(args.legacy_lines)))
+    if args.load_lines:
+        report("ParsedProblem (parse + build problem)", args.load_lines, timeLoad(generateModel(args.load_lines)))
+    if args.memory_lines:
+        print("%-36s %8d lines %10.0f bytes/line" % ("Parsed expressions", args.memory_lines, measureMemory(generateModel(args.memory_lines))))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+# Numerical method portfolio benchmark
+# Solves some differently-shaped blocks (linear, sparse nonlinear, dense nonlinear, one variable) with scipy's default
+# hybr method alone, with the portfolio's choice of method, and with the portfolio racing its candidates
+# Run from anywhere: python benchmarks/bench_portfolio.py [--size N] [--repeats N]
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+
+from constraints import EqualityConstraint
+from expressions import ScalarVariable, FixedValue, SumExpression, ProductExpression, SinExpression
+from portfolio import Portfolio, runMethod, METHOD_HYBR
+from tape import Tape
+
+
+def generateBlocks(n):
+    v = [ScalarVariable("v" + str(i)) for i in range(n)]
+    def term(i, j, weight):
+        return ProductExpression(FixedValue(weight), v[j % n])
+    linear = [EqualityConstraint("l" + str(i), SumExpression(SumExpression(term(i, i, 4.0), term(i, i + 1, 1.0)), term(i, i + 7, -1.0)),
+                                 FixedValue(float(i))) for i in range(n)]
+    sparse = [EqualityConstraint("s" + str(i), SumExpression(term(i, i, 3.0), ProductExpression(FixedValue(0.5), SinExpression(v[(i + 1) % n]))),
+                                 FixedValue(1.0)) for i in range(n)]
+    dense = [EqualityConstraint("d" + str(i), SumExpression(term(i, i, 10.0), SinExpression(SumExpression(v[(i + 1) % 8], v[(i + 2) % 8]))),
+                                FixedValue(1.0)) for i in range(8)]
+    single = [EqualityConstraint("x", SumExpression(v[0], ProductExpression(FixedValue(0.5), SinExpression(v[0]))), FixedValue(2.0))]
+    return [("linear", linear, v), ("sparse nonlinear", sparse, v), ("dense nonlinear", dense, v[:8]), ("one variable", single, v[:1])]
+
+
+def main():
+    argParser = argparse.ArgumentParser(description=__doc__)
+    argParser.add_argument("--size", type=int, default=150, help="number of unknowns in the linear and sparse blocks")
+    argParser.add_argument("--repeats", type=int, default=5, help="number of times to solve each block")
+    args = argParser.parse_args()
+
+    for (name, constrs, variables) in generateBlocks(args.size):
+        tape = Tape(constrs)
+        slots = [tape.slotIndex[var.getName()] for var in variables]
+        values = np.zeros(len(tape.slotNames))
+        x0 = np.zeros(len(slots))
+        solvers = [("hybr only", lambda: runMethod(METHOD_HYBR, tape, values, slots, x0) + (METHOD_HYBR,))]
+        for (label, portfolio) in [("portfolio", Portfolio()), ("portfolio (racing)", Portfolio(race=True))]:
+            solvers.append((label, lambda portfolio=portfolio: portfolio.solve(name, tape, values, slots, x0)))
+        for (label, solver) in solvers:
+            start = time.perf_counter()
+            for repeat in range(args.repeats):
+                result = solver()
+            seconds = (time.perf_counter() - start) / args.repeats
+            print("%-18s %-20s %s %10.2f ms  (%s)" % (name, label, "ok    " if result[1] else "FAILED", 1e3 * seconds, result[-1]))
+
+
+if __name__ == "__main__":
+    main()
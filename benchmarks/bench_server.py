@@ -0,0 +1,84 @@
+# Solve server benchmark
+# Compares a client that starts a fresh process to load and solve a problem for each request with one that asks a solve
+# server (see solveserver.py) that already has it loaded, one request at a time and pipelined
+# Run from anywhere: python benchmarks/bench_server.py [--problem FILE] [--requests N] [--fresh N]
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+import numpy as np
+
+from solveserver import SolveServer, SolveClient
+
+FRESH_TEMPLATE = """
+import contextlib, io, sys
+sys.path.insert(0, {repo!r})
+with contextlib.redirect_stdout(io.StringIO()):
+    from probcache import loadProblem
+    p = loadProblem({problem!r})
+    p.solve(p.defaultContext.copy())
+"""
+
+
+def report(label, times):
+    times = np.array(times) * 1000.0
+    print("%-28s median %9.3f ms  p95 %9.3f ms" % (label, np.median(times), np.percentile(times, 95)))
+
+
+def main():
+    argParser = argparse.ArgumentParser(description=__doc__)
+    argParser.add_argument("--problem", default=os.path.join(REPO_DIR, "examples", "masses.prob"), help="problem file to solve")
+    argParser.add_argument("--requests", type=int, default=1000, help="number of requests to the server")
+    argParser.add_argument("--fresh", type=int, default=10, help="number of fresh processes to time")
+    args = argParser.parse_args()
+
+    times = []
+    for i in range(args.fresh):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", FRESH_TEMPLATE.format(repo=REPO_DIR, problem=args.problem)], check=True)
+        times.append(time.perf_counter() - start)
+    report("fresh process per solve", times)
+
+    path = os.path.join(tempfile.mkdtemp(), "solve.sock")
+    server = SolveServer()
+    # Keep the solver's progress messages out of the way
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    thread = threading.Thread(target=server.serveSocket, args=(path,))
+    thread.start()
+    try:
+        while not os.path.exists(path):
+            time.sleep(0.01)
+        client = SolveClient(path)
+        request = {"op": "solve", "problem": args.problem}
+        assert client.request(request)["ok"]
+        times = []
+        for i in range(args.requests):
+            start = time.perf_counter()
+            client.request(request)
+            times.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        for i in range(args.requests):
+            client.send(request)
+        for i in range(args.requests):
+            client.receive()
+        pipelined = (time.perf_counter() - start) / args.requests
+        client.request({"op": "shutdown"})
+        client.close()
+    finally:
+        thread.join()
+        sys.stdout = stdout
+    report("server, one at a time", times)
+    report("server, pipelined", [pipelined])
+
+
+if __name__ == "__main__":
+    main()
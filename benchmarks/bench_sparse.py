@@ -0,0 +1,78 @@
+# Large-block numerical solving benchmark
+# Solves a generated block of coupled constraints (each referring to three of the unknowns) with each of the sparse
+# Newton variants (sparsenewton.py) and with the dense scipy.optimize.root used for small blocks
+# Run from anywhere: python benchmarks/bench_sparse.py [--unknowns N] [--dense-limit N]
+
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+import scipy.optimize
+
+import sparsenewton
+from constraints import EqualityConstraint
+from expressions import ScalarVariable, FixedValue, SumExpression, ProductExpression, PowerExpression, SinExpression
+from tape import Tape
+
+
+def generateBlock(n):
+    # 3 v[i] + 0.3 sin(v[i+1]) + 0.2 v[i-1]^2 = 1 + 0.001 i, wrapping around
+    v = [ScalarVariable("v" + str(i)) for i in range(n)]
+    return ([EqualityConstraint("c" + str(i),
+                                SumExpression(SumExpression(ProductExpression(FixedValue(3.0), v[i]),
+                                                            ProductExpression(FixedValue(0.3), SinExpression(v[(i + 1) % n]))),
+                                              ProductExpression(FixedValue(0.2), PowerExpression(v[i - 1], FixedValue(2.0)))),
+                                FixedValue(1.0 + 0.001 * i)) for i in range(n)], v)
+
+
+def measure(function):
+    # Time one run, then trace the memory of another (tracing slows Python code down too much to time it at once)
+    start = time.perf_counter()
+    (x, success) = function()
+    seconds = time.perf_counter() - start
+    tracemalloc.start()
+    function()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return (x, success, seconds, peak)
+
+
+def main():
+    argParser = argparse.ArgumentParser(description=__doc__)
+    argParser.add_argument("--unknowns", type=int, default=2000, help="size of block")
+    argParser.add_argument("--dense-limit", type=int, default=2000, help="largest block to also solve densely")
+    args = argParser.parse_args()
+
+    (constrs, variables) = generateBlock(args.unknowns)
+    tape = Tape(constrs)
+    slots = [tape.slotIndex[var.getName()] for var in variables]
+    values = np.zeros(len(tape.slotNames))
+    x0 = np.zeros(args.unknowns)
+    methods = [(jacobianMethod + " / " + linearMethod,
+                lambda jacobianMethod=jacobianMethod, linearMethod=linearMethod: sparsenewton.solve(tape, values, slots, x0, jacobianMethod, linearMethod))
+               for jacobianMethod in [sparsenewton.JACOBIAN_REVERSE, sparsenewton.JACOBIAN_COLOURED]
+               for linearMethod in [sparsenewton.LINEAR_LU, sparsenewton.LINEAR_KRYLOV]]
+    if args.unknowns <= args.dense_limit:
+        def dense():
+            def f(x):
+                values[slots] = x
+                return tape.evaluate(values)
+            def jac(x):
+                values[slots] = x
+                return tape.jacobian(values, slots)[1]
+            result = scipy.optimize.root(f, x0, jac=jac)
+            return (result.x, result.success)
+        methods.append(("dense (scipy root)", dense))
+    for (name, function) in methods:
+        (x, success, seconds, peak) = measure(function)
+        values[slots] = x
+        print("%-22s %s %10.3f s %10.1f MB peak  max residual %.1e" % (name, "ok    " if success else "FAILED", seconds, peak / 1e6, np.max(np.abs(tape.evaluate(values)))))
+
+
+if __name__ == "__main__":
+    main()
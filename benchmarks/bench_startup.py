@@ -0,0 +1,78 @@
+# Start-up time benchmark
+# Times fresh Python processes doing progressively more work, and reports which heavy dependencies each one pulled in
+# Run from anywhere: python benchmarks/bench_startup.py [number of repeats]
+
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# A problem that can be solved analytically, so shouldn't need any numerical libraries
+EXPLICIT_MODEL = """
+F = m * a "Newton's 2nd law"
+v = u + a * t
+s = u * t + 0.5 * a * t^2
+m := 10
+a := 9.81
+u := 0
+t := 3
+"""
+
+# Modules whose import we're trying to avoid unless they're really needed
+HEAVY_MODULES = ["numpy", "scipy", "pyparsing"]
+
+# Each scenario is a snippet of code run in a fresh interpreter
+SCENARIOS = [
+    ("bare interpreter", "pass"),
+    ("import equationsolver", "import equationsolver"),
+    ("import parsedproblem", "import parsedproblem"),
+    ("parse explicit model", "from parsedproblem import ParsedProblem; ParsedProblem(MODEL)"),
+    ("parse and solve explicit model", "from parsedproblem import ParsedProblem; p = ParsedProblem(MODEL); p.solve(p.defaultContext.copy())"),
+]
+
+TIMER_TEMPLATE = """
+import contextlib, io, sys, time
+sys.path.insert(0, {repo!r})
+MODEL = {model!r}
+start = time.perf_counter()
+with contextlib.redirect_stdout(io.StringIO()):
+    {code}
+elapsed = time.perf_counter() - start
+print(elapsed, ",".join(m for m in {heavy!r} if m in sys.modules))
+"""
+
+
+def timeScenario(code, modelFilename, repeats):
+    # Time the snippet in fresh processes, returning (times in seconds including interpreter start-up, heavy modules loaded)
+    script = TIMER_TEMPLATE.format(repo=REPO_DIR, model=modelFilename, code=code, heavy=HEAVY_MODULES)
+    times = []
+    for _ in range(repeats):
+        start = _now()
+        output = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True, check=True).stdout
+        times.append(_now() - start)
+    (inProcess, loaded) = (output.split() + [""])[:2]
+    return (times, float(inProcess), loaded or "-")
+
+
+def _now():
+    import time
+    return time.perf_counter()
+
+
+def main(repeats=10):
+    with tempfile.NamedTemporaryFile("w", suffix=".prob", delete=False) as modelFile:
+        modelFile.write(EXPLICIT_MODEL)
+    try:
+        print("%-32s %12s %12s %12s  %s" % ("Scenario", "median (ms)", "min (ms)", "work (ms)", "heavy modules loaded"))
+        for (name, code) in SCENARIOS:
+            (times, inProcess, loaded) = timeScenario(code, modelFile.name, repeats)
+            print("%-32s %12.1f %12.1f %12.1f  %s" % (name, 1000 * statistics.median(times), 1000 * min(times), 1000 * inProcess, loaded))
+    finally:
+        os.remove(modelFile.name)
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10)
@@ -0,0 +1,78 @@
+# Surrogate preview benchmark
+# Simulates dragging a slider on a model - a long chain of analytic steps plus a small coupled nonlinear block - as the
+# GUI does with previews on: each move is answered by surrogate.RBFSurrogate straight away, then solved exactly and the
+# solution added to the surrogate. Compares the time to a preview with the time to an exact solve, and reports how far
+# the previews were from the exact solutions
+# Run from anywhere: python benchmarks/bench_surrogate.py [--chain N] [--moves N]
+
+import argparse
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+import numpy as np
+
+from equationsolver import Context
+from parsedproblem import ParsedProblem
+from surrogate import RBFSurrogate
+
+
+def generateModel(n):
+    # Inputs a and b; x0 = a, x[i+1] = 1.001 * x[i] + 0.001 * b; then u and w coupled nonlinearly to the end of the chain
+    lines = ["a := 1.0", "b := 1.0", "x0 = a"]
+    lines.extend("x%d = 1.001 * x%d + 0.001 * b" % (i + 1, i) for i in range(n))
+    lines.append("u + sin(w) = x%d" % n)
+    lines.append("u * w = b")
+    return lines
+
+
+def main():
+    argParser = argparse.ArgumentParser(description=__doc__)
+    argParser.add_argument("--chain", type=int, default=500, help="length of the chain of analytic steps")
+    argParser.add_argument("--moves", type=int, default=200, help="number of slider moves")
+    args = argParser.parse_args()
+
+    modelFilename = os.path.join(tempfile.mkdtemp(), "model.prob")
+    with open(modelFilename, "w") as modelFile:
+        modelFile.write("\n".join(generateModel(args.chain)))
+    # Drag a about, nudging b now and then
+    rng = np.random.default_rng(0)
+    path = np.column_stack([1.5 + 0.5 * np.sin(np.linspace(0, 6 * np.pi, args.moves)),
+                            1.0 + 0.3 * np.round(rng.uniform(-1, 1, args.moves), 1)])
+    with contextlib.redirect_stdout(io.StringIO()):
+        problem = ParsedProblem(modelFilename)
+        surrogate = RBFSurrogate(["a", "b"], ["x%d" % args.chain, "u", "w"])
+        refContext = Context({"u": 1.0, "w": 1.0})
+        (predictTime, addTime, solveTime, errors) = (0.0, 0.0, 0.0, [])
+        for (a, b) in path:
+            start = time.perf_counter()
+            preview = surrogate.predict({"a": a, "b": b})
+            predictTime += time.perf_counter() - start
+            context = problem.defaultContext.copy()
+            context.varVals.update(a=a, b=b)
+            start = time.perf_counter()
+            assert problem.solve(context, refContext)
+            solveTime += time.perf_counter() - start
+            refContext = context
+            if preview is not None:
+                errors.append(max(abs(preview[name] - context.varVals[name]) / max(abs(context.varVals[name]), 1e-12)
+                                  for name in preview))
+            start = time.perf_counter()
+            surrogate.add(context.varVals, context.varVals)
+            addTime += time.perf_counter() - start
+    errors = np.array(errors)
+    print("%-28s %10.1f us per move" % ("surrogate preview", predictTime / args.moves * 1e6))
+    print("%-28s %10.1f us per move" % ("surrogate refit (add)", addTime / args.moves * 1e6))
+    print("%-28s %10.1f us per move  (%.0fx the preview)" % ("exact solve", solveTime / args.moves * 1e6, solveTime / predictTime))
+    print("preview relative error: median %.2e, 90th percentile %.2e, last 50 moves max %.2e"
+          % (np.median(errors), np.percentile(errors, 90), errors[-50:].max()))
+
+
+if __name__ == "__main__":
+    main()
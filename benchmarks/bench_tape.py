@@ -0,0 +1,65 @@
+# Residual evaluation benchmark
+# Evaluates every constraint of a large generated model for a batch of contexts, by walking the expression trees
+# (Constraint.getResidual) and by running the problem's tape (tape.py) over the whole batch at once
+# Run from anywhere: python benchmarks/bench_tape.py [--lines N] [--batch N]
+
+import argparse
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+
+from batchsolver import evaluateResiduals
+from bench_parser import generateModel
+from equationsolver import Context
+from parsedproblem import ParsedProblem
+
+
+def loadModel(numLines):
+    with tempfile.NamedTemporaryFile("w", suffix=".prob", delete=False) as modelFile:
+        modelFile.write("\n".join(generateModel(numLines)))
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            return ParsedProblem(modelFile.name)
+    finally:
+        os.remove(modelFile.name)
+
+
+def randomContexts(problem, batchSize):
+    rng = np.random.default_rng(0)
+    names = problem.getVariableNames()
+    return [Context(dict(zip(names, rng.uniform(1.0, 2.0, len(names))))) for i in range(batchSize)]
+
+
+def main():
+    argParser = argparse.ArgumentParser(description=__doc__)
+    argParser.add_argument("--lines", type=int, default=2000, help="size of model")
+    argParser.add_argument("--batch", type=int, default=200, help="number of contexts to evaluate")
+    args = argParser.parse_args()
+
+    problem = loadModel(args.lines)
+    contexts = randomContexts(problem, args.batch)
+    constrs = problem.getTape().constrs
+    numEvaluations = len(constrs) * args.batch
+
+    start = time.perf_counter()
+    treeResiduals = np.array([[constr.getResidual(context) for constr in constrs] for context in contexts])
+    treeSeconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    tapeResiduals = evaluateResiduals(problem, contexts)
+    tapeSeconds = time.perf_counter() - start
+
+    assert np.allclose(treeResiduals, tapeResiduals)
+    for (name, seconds) in [("expression trees", treeSeconds), ("tape (batched)", tapeSeconds)]:
+        print("%-20s %8d residuals %10.3f s %10.3f us/residual" % (name, numEvaluations, seconds, 1e6 * seconds / numEvaluations))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+# Limits on how much work a solve may do, and cooperative cancellation
+# A badly-behaved block can keep a root-finder busy indefinitely, stalling a whole sweep, so a solve can be given a
+# budget of wall time, residual evaluations and iterations - both for the whole solve and for each numerical block.
+# The solver charges the budget from inside its residual and Jacobian callbacks (so a root-finder can be stopped part
+# way through) and between analytical steps; once any limit is reached, or the solve is cancelled, BudgetExceeded is
+# raised and the solve stops with status "budget exceeded" (or "cancelled")
+
+import copy
+import threading
+import time
+
+from equationsolver import STATUS_BUDGET_EXCEEDED, STATUS_CANCELLED
+
+
+class BudgetExceeded(Exception):
+    # Raised from inside a solve to stop it, with the status it ended in
+    def __init__(self, message, status=STATUS_BUDGET_EXCEEDED):
+        super(BudgetExceeded, self).__init__(message)
+        self.status = status
+
+
+class CancelToken:
+    # Shared between whatever is solving and whatever might want to stop it (e.g. a GUI's cancel button), in any thread
+    def __init__(self, parent=None):
+        # A token with a parent is cancelled along with it (but can also be cancelled on its own)
+        self.parent = parent
+        self.event = threading.Event()
+
+    def cancel(self):
+        self.event.set()
+
+    def reset(self):
+        self.event.clear()
+
+    def isCancelled(self):
+        return self.event.is_set() or (self.parent is not None and self.parent.isCancelled())
+
+
+class SolveBudget:
+    """
+    The limits for a solve - any left as None aren't limited
+    A budget only holds the limits, so can be shared by many solves; each solve keeps its own count (see start())
+    """
+    def __init__(self, maxSeconds=None, maxEvaluations=None, maxIterations=None,
+                 blockSeconds=None, blockEvaluations=None, blockIterations=None, cancelToken=None, poll=None):
+        """
+        :param maxSeconds, maxEvaluations, maxIterations: limits for the whole solve
+        :param blockSeconds, blockEvaluations, blockIterations: limits for each block of constraints solved numerically
+        :param cancelToken: CancelToken that stops the solve when cancelled
+        :param poll: function called every so often while solving (e.g. to let a GUI handle a click on its cancel button)
+        """
+        self.maxSeconds = maxSeconds
+        self.maxEvaluations = maxEvaluations
+        self.maxIterations = maxIterations
+        self.blockSeconds = blockSeconds
+        self.blockEvaluations = blockEvaluations
+        self.blockIterations = blockIterations
+        self.cancelToken = cancelToken
+        self.poll = poll
+
+    def start(self):
+        # Start counting a solve against the budget
+        return BudgetTracker(self)
+
+    def linkedCopy(self):
+        # A copy of this budget with a cancel token of its own (still cancelled along with this budget's), so that one
+        # solve using it can be cancelled without cancelling every other solve sharing this budget
+        budget = copy.copy(self)
+        budget.cancelToken = CancelToken(parent=self.cancelToken)
+        return budget
+
+    def __repr__(self):
+        limits = ["%s %s" % (name, value) for (name, value) in sorted(vars(self).items())
+                  if value is not None and name not in ("cancelToken", "poll")]
+        return "<SolveBudget: " + (", ".join(limits) or "unlimited") + ">"
+
+
+class BudgetTracker:
+    # How much of a budget one solve has used so far
+    # Safe to charge from several threads at once (e.g. methods racing each other, see portfolio.py)
+    POLL_INTERVAL = 0.05
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.lock = threading.Lock()
+        self.startTime = time.perf_counter()
+        self.evaluations = 0
+        self.iterations = 0
+        self.lastPoll = self.startTime
+        self.startBlock()
+
+    def startBlock(self):
+        # Start counting a new numerical block
+        with self.lock:
+            self.blockStartTime = time.perf_counter()
+            self.blockEvaluations = 0
+            self.blockIterations = 0
+
+    def charge(self, evaluations=0, iterations=0):
+        # Count some work, then stop the solve (by raising BudgetExceeded) if that's used up the budget
+        with self.lock:
+            self.evaluations += evaluations
+            self.blockEvaluations += evaluations
+            self.iterations += iterations
+            self.blockIterations += iterations
+        self.check()
+
+    def check(self):
+        budget = self.budget
+        now = time.perf_counter()
+        if budget.poll is not None and now - self.lastPoll >= self.POLL_INTERVAL:
+            self.lastPoll = now
+            budget.poll()
+        if budget.cancelToken is not None and budget.cancelToken.isCancelled():
+            raise BudgetExceeded("cancelled", STATUS_CANCELLED)
+        for (used, limit, what) in [(now - self.startTime, budget.maxSeconds, "seconds"),
+                                    (self.evaluations, budget.maxEvaluations, "residual evaluations"),
+                                    (self.iterations, budget.maxIterations, "iterations"),
+                                    (now - self.blockStartTime, budget.blockSeconds, "seconds in one block"),
+                                    (self.blockEvaluations, budget.blockEvaluations, "residual evaluations in one block"),
+                                    (self.blockIterations, budget.blockIterations, "iterations in one block")]:
+            if limit is not None and used > limit:
+                raise BudgetExceeded("budget exceeded: more than " + str(limit) + " " + what)
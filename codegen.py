@@ -0,0 +1,344 @@
+# Generation of standalone Python solver modules from problems
+# For a fixed choice of inputs, the order a problem is solved in never changes, so it can be written out once as plain
+# Python: straight-line assignments for the constraints solved analytically (each one inverted symbolically, just as
+# the expressions' setValue methods invert them at solve time), consistency checks for those with nothing left to
+# solve, and for each block that has to be solved numerically, generated residual and (symbolically differentiated)
+# Jacobian functions, solved by a small Newton's method. The module only needs the standard library - no expression
+# objects, contexts, parser, numpy or scipy - so it imports instantly and runs at about the speed of hand-written code.
+# The plan is taken from solving the problem once with the given inputs (see SolveResult.plan), whose solution is
+# also the starting point for the numerical blocks.
+
+import re
+
+from equationsolver import BLOCK_ANALYTIC, BLOCK_CHECKED
+from expressions import ScalarVariable, Variable, SumExpression, DifferenceExpression, ProductExpression, \
+    QuotientExpression, PowerExpression, SinExpression, CosExpression, TanExpression
+
+_binaryOperators = {
+    SumExpression: "+",
+    DifferenceExpression: "-",
+    ProductExpression: "*",
+    QuotientExpression: "/",
+    PowerExpression: "**"
+}
+_unaryFunctions = {
+    SinExpression: "math.sin",
+    CosExpression: "math.cos",
+    TanExpression: "math.tan"
+}
+_inverseFunctions = {
+    SinExpression: "math.asin",
+    CosExpression: "math.acos",
+    TanExpression: "math.atan"
+}
+
+# The start of every generated module: what's needed to solve the numerical blocks
+MODULE_HEADER = '''\
+import math
+
+TOLERANCE = 1e-10
+MAX_ITERATIONS = 50
+
+
+class SolveError(ValueError):
+    # Raised when the model can't be solved with the inputs given
+    pass
+
+
+def _close(a, b):
+    return abs(a - b) <= 1e-9 * max(1.0, abs(a), abs(b))
+
+
+def _linsolve(matrix, rhs):
+    # Gaussian elimination with partial pivoting, returning None if the matrix is singular
+    n = len(rhs)
+    rows = [list(row) + [value] for (row, value) in zip(matrix, rhs)]
+    for column in range(n):
+        pivot = max(range(column, n), key=lambda row: abs(rows[row][column]))
+        if rows[pivot][column] == 0.0:
+            return None
+        (rows[column], rows[pivot]) = (rows[pivot], rows[column])
+        for row in range(column + 1, n):
+            factor = rows[row][column] / rows[column][column]
+            if factor != 0.0:
+                rows[row] = [a - factor * b for (a, b) in zip(rows[row], rows[column])]
+    x = [0.0] * n
+    for row in range(n - 1, -1, -1):
+        x[row] = (rows[row][n] - sum(rows[row][k] * x[k] for k in range(row + 1, n))) / rows[row][row]
+    return x
+
+
+def _norm(values):
+    return math.sqrt(sum(value * value for value in values))
+
+
+def _newton(residuals, jacobian, x, args, name):
+    # Damped Newton's method, as in sparsenewton.py
+    r = residuals(x, *args)
+    for iteration in range(MAX_ITERATIONS):
+        norm = _norm(r)
+        if not math.isfinite(norm):
+            break
+        if max(abs(value) for value in r) <= TOLERANCE:
+            return x
+        step = _linsolve(jacobian(x, *args), [-value for value in r])
+        if step is None:
+            break
+        if all(abs(s) <= 4.0 * 2.220446049250313e-16 * max(1.0, abs(xi)) for (s, xi) in zip(step, x)):
+            return x
+        fraction = 1.0
+        while True:
+            trial = [xi + fraction * s for (xi, s) in zip(x, step)]
+            try:
+                newR = residuals(trial, *args)
+                newNorm = _norm(newR)
+            except (ArithmeticError, ValueError):
+                newNorm = math.inf
+            if newNorm <= (1.0 - 1e-4 * fraction) * norm or fraction < 1e-4:
+                break
+            fraction /= 2.0
+        if not math.isfinite(newNorm):
+            break
+        (x, r) = (trial, newR)
+    if max(abs(value) for value in r) <= TOLERANCE:
+        return x
+    raise SolveError("couldn't solve " + name + " numerically")
+'''
+
+
+def product(a, b):
+    # Code for a * b, leaving out factors of one
+    return b if a == "1.0" else (a if b == "1.0" else a + " * " + b)
+
+
+def tupleCode(items):
+    return "(" + ", ".join(items) + ("," if len(items) == 1 else "") + ")"
+
+
+class CodeGenerator:
+    """
+    Writes a problem's solution, for one choice of inputs, as Python source code
+    """
+    def __init__(self, problem, inputs=None, refContext=False):
+        """
+        :param inputs: dict of input values by name, on top of the problem's default context; every variable with a
+            value is an input of the generated module, and its value here the input's default
+        :param refContext: starting points for solving numerically while working out the plan (see Problem.solve)
+        """
+        self.problem = problem
+        context = problem.defaultContext.copy()
+        context.varVals.update(inputs or {})
+        variables = problem.getVariables()
+        self.variableNames = problem.getVariableNames()
+        self.inputNames = [name for name in self.variableNames if context.varVals.get(name) is not None]
+        self.defaults = {name: float(context.varVals[name]) for name in self.inputNames}
+        self.result = problem.solve(context, refContext)
+        if not self.result:
+            raise ValueError("Can't generate code for " + problem.name + ": it doesn't solve completely with these inputs (" +
+                             self.result.status + ")" + (": " + self.result.diagnosis if self.result.diagnosis else ""))
+        self.constrsByName = {constr.getName(): constr for constr in problem.constrs}
+        # Python identifiers for the variables
+        self.identifiers = {}
+        taken = set()
+        for name in variables:
+            identifier = "v_" + re.sub(r"\W", "_", name)
+            while identifier in taken:
+                identifier += "_"
+            taken.add(identifier)
+            self.identifiers[name] = identifier
+
+    def nameOf(self, var, nameOf):
+        return nameOf(var) if nameOf else var.getName()
+
+    def exprCode(self, expr, nameOf):
+        # Python code for the value of an expression
+        exprType = type(expr)
+        if exprType in _binaryOperators:
+            return "(" + self.exprCode(expr.argA, nameOf) + " " + _binaryOperators[exprType] + " " + self.exprCode(expr.argB, nameOf) + ")"
+        elif exprType in _unaryFunctions:
+            return _unaryFunctions[exprType] + "(" + self.exprCode(expr.arg, nameOf) + ")"
+        elif isinstance(expr, ScalarVariable):
+            return self.identifiers[self.nameOf(expr, nameOf)]
+        elif isinstance(expr, Variable):
+            # Constants and fixed values
+            return repr(float(expr.value))
+        raise ValueError("Can't generate code for " + repr(expr))
+
+    def contains(self, expr, name, nameOf):
+        # Whether the variable called name appears in an expression
+        if isinstance(expr, ScalarVariable):
+            return self.nameOf(expr, nameOf) == name
+        elif expr.isComposite():
+            return any(self.contains(child, name, nameOf) for child in expr.getChildren())
+        return False
+
+    def invertCode(self, expr, valueCode, name, nameOf):
+        """
+        Python code for the value of the variable called name, which appears once in expr, given code for expr's value
+        (the same inversions as the expressions' setValue methods)
+        """
+        exprType = type(expr)
+        if isinstance(expr, ScalarVariable):
+            return valueCode
+        elif exprType in _inverseFunctions:
+            return self.invertCode(expr.arg, _inverseFunctions[exprType] + "(" + valueCode + ")", name, nameOf)
+        elif exprType not in _binaryOperators:
+            raise ValueError("Can't generate code for " + repr(expr))
+        inA = self.contains(expr.argA, name, nameOf)
+        (unknown, other) = (expr.argA, expr.argB) if inA else (expr.argB, expr.argA)
+        otherCode = self.exprCode(other, nameOf)
+        if exprType == SumExpression:
+            code = valueCode + " - " + otherCode
+        elif exprType == DifferenceExpression:
+            code = valueCode + " + " + otherCode if inA else otherCode + " - " + valueCode
+        elif exprType == ProductExpression:
+            code = valueCode + " / " + otherCode
+        elif exprType == QuotientExpression:
+            code = valueCode + " * " + otherCode if inA else otherCode + " / " + valueCode
+        elif inA:
+            code = valueCode + " ** (1 / " + otherCode + ")"
+        else:
+            code = "math.log(" + valueCode + ") / math.log(" + otherCode + ")"
+        return self.invertCode(unknown, "(" + code + ")", name, nameOf)
+
+    def derivativeCode(self, expr, name, nameOf):
+        # Python code for the derivative of an expression with respect to the variable called name (None if zero)
+        exprType = type(expr)
+        if isinstance(expr, ScalarVariable):
+            return "1.0" if self.nameOf(expr, nameOf) == name else None
+        elif isinstance(expr, Variable):
+            return None
+        elif exprType in _unaryFunctions:
+            da = self.derivativeCode(expr.arg, name, nameOf)
+            if da is None:
+                return None
+            a = self.exprCode(expr.arg, nameOf)
+            if exprType == SinExpression:
+                return "(" + product("math.cos(" + a + ")", da) + ")"
+            elif exprType == CosExpression:
+                return "(-" + product("math.sin(" + a + ")", da) + ")"
+            return "(" + da + " / math.cos(" + a + ") ** 2)"
+        da = self.derivativeCode(expr.argA, name, nameOf)
+        db = self.derivativeCode(expr.argB, name, nameOf)
+        if da is None and db is None:
+            return None
+        (a, b) = (self.exprCode(expr.argA, nameOf), self.exprCode(expr.argB, nameOf))
+        if exprType == SumExpression:
+            terms = [da, db]
+        elif exprType == DifferenceExpression:
+            terms = [da, None if db is None else "-" + db]
+        elif exprType == ProductExpression:
+            terms = [None if da is None else product(da, b), None if db is None else product(a, db)]
+        elif exprType == QuotientExpression:
+            terms = [None if da is None else da + " / " + b, None if db is None else "-" + product(a, db) + " / (" + b + " * " + b + ")"]
+        else:
+            terms = [None if da is None else product(b + " * " + a + " ** (" + b + " - 1)", da),
+                     None if db is None else product(a + " ** " + b + " * math.log(" + a + ")", db)]
+        return "(" + " + ".join(term for term in terms if term is not None) + ")"
+
+    def sideNames(self, constr):
+        # Names of the variables in a constraint
+        (lhs, rhs, nameOf) = constr.getSides()
+        names = set()
+        stack = [lhs, rhs]
+        while stack:
+            expr = stack.pop()
+            if isinstance(expr, ScalarVariable):
+                names.add(self.nameOf(expr, nameOf))
+            elif expr.isComposite():
+                stack.extend(expr.getChildren())
+        return names
+
+    def blockFunctions(self, index, constrs, unknowns):
+        # Source of the residual and Jacobian functions of a numerical block, and the names of their other arguments
+        known = sorted(set().union(*[self.sideNames(constr) for constr in constrs]) - set(unknowns))
+        params = ", ".join(["x"] + [self.identifiers[name] for name in known])
+        unpack = "    " + tupleCode([self.identifiers[name] for name in unknowns]) + " = x\n"
+        residuals = []
+        jacobian = []
+        for constr in constrs:
+            (lhs, rhs, nameOf) = constr.getSides()
+            residuals.append("        " + self.exprCode(lhs, nameOf) + " - " + self.exprCode(rhs, nameOf) + ",  # " + constr.getName())
+            row = []
+            for name in unknowns:
+                (dl, dr) = (self.derivativeCode(lhs, name, nameOf), self.derivativeCode(rhs, name, nameOf))
+                row.append(dl + " - " + dr if dl and dr else (dl or ("-" + dr if dr else "0.0")))
+            jacobian.append("        [" + ", ".join(row) + "],")
+        source = ("def _residuals" + str(index) + "(" + params + "):\n" + unpack + "    return [\n" + "\n".join(residuals) + "\n    ]\n\n\n" +
+                  "def _jacobian" + str(index) + "(" + params + "):\n" + unpack + "    return [\n" + "\n".join(jacobian) + "\n    ]\n")
+        return (source, known)
+
+    def generate(self):
+        # The source of the module
+        functions = []
+        body = []
+        for name in self.inputNames:
+            body.append(self.identifiers[name] + " = float(values[" + repr(name) + "])")
+        for block in self.result.plan:
+            constrs = [self.constrsByName[name] for name in block.constrs]
+            if block.kind == BLOCK_CHECKED:
+                (lhs, rhs, nameOf) = constrs[0].getSides()
+                body.append("if not _close(" + self.exprCode(lhs, nameOf) + ", " + self.exprCode(rhs, nameOf) + "):")
+                body.append("    raise SolveError(" + repr(constrs[0].getName() + " doesn't hold") + ")")
+            elif block.kind == BLOCK_ANALYTIC:
+                name = block.variables[0]
+                (lhs, rhs, nameOf) = constrs[0].getSides()
+                (unknownSide, otherSide) = (lhs, rhs) if self.contains(lhs, name, nameOf) else (rhs, lhs)
+                body.append(self.identifiers[name] + " = " + self.invertCode(unknownSide, self.exprCode(otherSide, nameOf), name, nameOf) +
+                            "  # " + constrs[0].getName())
+            else:
+                index = len(functions)
+                unknowns = list(block.variables)
+                (source, known) = self.blockFunctions(index, constrs, unknowns)
+                functions.append(source)
+                start = "[" + ", ".join(repr(float(self.result.values[name])) for name in unknowns) + "]"
+                args = tupleCode([self.identifiers[name] for name in known])
+                body.append(tupleCode([self.identifiers[name] for name in unknowns]) + " = _newton(_residuals" + str(index) +
+                            ", _jacobian" + str(index) + ", " + start + ", " + args + ", " + repr(", ".join(block.constrs)) + ")")
+        outputs = ",\n".join("        " + repr(name) + ": " + (self.identifiers[name] if name in self.identifiers and
+                             (name in self.defaults or self.result.values.get(name) is not None) else "None") for name in self.variableNames)
+        lines = ["# Standalone solver for " + self.problem.name + ", generated by codegen.py - regenerate rather than edit it",
+                 "# Inputs: " + ", ".join(self.inputNames), "# Only needs the standard library", "",
+                 MODULE_HEADER, "",
+                 "INPUTS = " + repr(tuple(self.inputNames)),
+                 "DEFAULTS = " + repr(self.defaults),
+                 "VARIABLES = " + repr(tuple(self.variableNames)), "", ""]
+        lines.extend(function + "\n" for function in functions)
+        lines.append('''def solve(inputs=None):
+    """
+    Solve the model
+    :param inputs: dict of input values by name (any not given take their values from DEFAULTS)
+    :return: dict of every variable's value by name
+    """
+    values = DEFAULTS if inputs is None else dict(DEFAULTS, **inputs)
+    if len(values) != len(DEFAULTS):
+        raise SolveError("not inputs: " + ", ".join(sorted(set(values) - set(DEFAULTS))))
+    try:''')
+        lines.extend("        " + line for line in body or ["pass"])
+        lines.append('''    except SolveError:
+        raise
+    except (ArithmeticError, ValueError) as err:
+        raise SolveError(str(err))
+    return {
+''' + outputs + '''
+    }
+''')
+        return "\n".join(lines)
+
+
+def generateModule(problem, inputs=None, refContext=False):
+    """
+    Generate a standalone Python module that solves a problem for one choice of inputs (see CodeGenerator)
+    The module has a function solve(inputs=None), taking a dict of input values and returning a dict of every
+    variable's value, and raising its SolveError if the model can't be solved
+    :return: the module's source code
+    """
+    return CodeGenerator(problem, inputs, refContext).generate()
+
+
+def writeModule(problem, filename, inputs=None, refContext=False):
+    # Generate a module (see generateModule) and save it
+    source = generateModule(problem, inputs, refContext)
+    with open(filename, "w") as f:
+        f.write(source)
+    return filename
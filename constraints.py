@@ -1,13 +1,17 @@
-from NIbase import addDescVarOrRecurse
+from NIbase import addDescVarOrRecurse, allTrue
 from abc import abstractmethod
 from abc import ABCMeta
 import math
-import numpy as np
+import sys
 
 __author__ = 'David Wyatt'
 
 
 class Constraint(metaclass=ABCMeta):
+    # Problems can have very many constraints (e.g. one per object), so they have no per-instance dict
+    # Subclasses must declare __slots__ too
+    __slots__ = ("name",)
+
     def __init__(self, name, *exprs):
         self.name = name
 
@@ -19,6 +23,11 @@ class Constraint(metaclass=ABCMeta):
     def getTextFormula(self):
         pass
 
+    @abstractmethod
+    def getResidual(self, context):
+        # How far the constraint is from holding - zero when it holds, or None if it can't be evaluated yet
+        pass
+
     def numExprs(self):
         return len(self.getExprs())
 
@@ -44,6 +53,8 @@ class Constraint(metaclass=ABCMeta):
 
 
 class EqualityConstraint(Constraint):
+    __slots__ = ("lhs", "rhs")
+
     def __init__(self, name, lhs, rhs):
         self.lhs = lhs
         self.rhs = rhs
@@ -61,7 +72,7 @@ class EqualityConstraint(Constraint):
                 self.rhs.setValue(self.lhs.getValue(context), context)
             else:
                 # Values on both sides - check if they're equal...
-                if abs(self.lhs.getValue(context) - self.rhs.getValue(context)) <= 10*np.finfo(float).eps:
+                if allTrue(abs(self.lhs.getValue(context) - self.rhs.getValue(context)) <= 10*sys.float_info.epsilon):
                     # Everything's fine, just continue
                     pass
                 else:
@@ -69,6 +80,17 @@ class EqualityConstraint(Constraint):
                     return False
         return True
 
+    def getSides(self):
+        # The two sides of the equation, and a function giving the name each variable has in a context (None for the variable's own name)
+        return (self.lhs, self.rhs, None)
+
+    def getResidual(self, context):
+        lhs = self.lhs.getValue(context)
+        rhs = self.rhs.getValue(context)
+        if lhs is None or rhs is None:
+            return None
+        return lhs - rhs
+
     def __repr__(self):
         return "<EqualityConstraint " + self.getName() + ": lhs " + repr(self.lhs) + ", rhs " + repr(self.rhs) + ">"
 
@@ -0,0 +1,219 @@
+# Design optimisation: finding the inputs that minimise (or maximise) a variable, within bounds and subject to
+# inequality constraints, rather than hunting for them by hand with the GUI's sliders
+# scipy.optimize.minimize (SLSQP by default) chooses the designs to try, and each one is evaluated by solving the
+# problem with it as the inputs. What keeps that affordable for large models:
+# * every solve after the first follows the first one's plan (see Problem.solvePlan), rather than working out the
+#   order to solve the constraints in again
+# * each solve's numerical blocks start from the previous design's solution (a warm start), which is usually close
+# * the gradients of the objective and of every constraint with respect to the design variables come from one adjoint
+#   solve each, sharing a single factorisation of the constraints' Jacobian (see autodiff.gradients), rather than from
+#   finite differences needing a solve per design variable
+# Run with: python designoptimizer.py model.prob (--minimize NAME | --maximize NAME) --vary NAME[=LOW:HIGH]...
+#           [--constraint "FORMULA <= FORMULA"]... [--set NAME=VALUE]...
+
+import argparse
+import collections
+import contextlib
+import os
+import re
+import sys
+
+import numpy as np
+import scipy.optimize
+
+from autodiff import getMetric, gradients
+from equationsolver import STATUS_BUDGET_EXCEEDED, STATUS_CANCELLED
+from expressions import DifferenceExpression
+
+DEFAULT_METHOD = "SLSQP"
+
+# The outcome of an optimisation: whether it converged (and the optimiser's message), the best design found (dict of
+# the design variables' values by name), the objective there, the solution there (a Context), the optimiser's iterations
+# and the number of times the problem was solved
+DesignResult = collections.namedtuple("DesignResult", ["success", "message", "design", "objective", "context", "iterations", "solves"])
+
+
+class DesignError(Exception):
+    # The problem couldn't be solved at a design the optimiser tried, or the solve was stopped
+    pass
+
+
+def parseInequality(problem, text):
+    """
+    An inequality constraint, e.g. "stress <= 200" or "a.W + b.W >= W_min", with a formula on each side
+    :return: an expression that must be >= 0 for the constraint to hold
+    """
+    parts = re.split(r"(<=|>=)", text)
+    if len(parts) != 3:
+        raise ValueError("a constraint must have one <= or >= in it, not " + repr(text))
+    (lhs, operator, rhs) = (getMetric(problem, parts[0].strip()), parts[1], getMetric(problem, parts[2].strip()))
+    return DifferenceExpression(rhs, lhs) if operator == "<=" else DifferenceExpression(lhs, rhs)
+
+
+class DesignOptimizer:
+    """
+    Minimises or maximises a metric of a problem over some of its inputs (see the top of this file)
+    """
+    def __init__(self, problem, objective, designVars, bounds=None, constraints=(), maximize=False, inputs=None,
+                 refContext=False, budget=None):
+        """
+        :param objective: the metric to optimise - a variable name, formula or expression (see autodiff.getMetric)
+        :param designVars: names of the input variables to vary
+        :param bounds: dict of (lower, upper) bounds of design variables, by name - either may be None for no bound
+        :param constraints: inequality constraints, as strings like "stress <= 200" (see parseInequality)
+        :param maximize: maximise the objective, rather than minimise it
+        :param inputs: dict of values of other variables, on top of the problem's default values
+        :param refContext: starting points for numerical solving at the first design
+        :param budget: optional budgets.SolveBudget for each solve; running out of it, or cancelling it, stops the optimisation
+        """
+        self.problem = problem
+        self.designVars = list(designVars)
+        unknown = sorted(set(self.designVars) - set(problem.getVariables()))
+        if unknown:
+            raise ValueError("unknown design variable(s): " + ", ".join(unknown))
+        self.bounds = dict(bounds or {})
+        self.metrics = [getMetric(problem, objective)] + [parseInequality(problem, text) for text in constraints]
+        self.constraintTexts = list(constraints)
+        self.sign = -1.0 if maximize else 1.0
+        self.baseContext = problem.defaultContext.copy()
+        self.baseContext.varVals.update(inputs or {})
+        # Every variable with a value before solving is an input, as far as the gradients are concerned
+        self.inputs = [name for name in problem.getVariables()
+                       if name in self.designVars or self.baseContext.varVals.get(name) is not None]
+        self.refContext = refContext
+        self.budget = budget
+        # The plan of the first solve, followed by the rest
+        self.plan = None
+        self.solves = 0
+        # The last design solved for, as (design array, solution context, metric values), and the metrics' gradients there
+        self.last = None
+        self.lastGradients = None
+
+    def evaluate(self, x):
+        """
+        Solve the problem at a design, unless it was the last one solved for
+        :param x: the design variables' values, in the order of designVars
+        :return: (the solution, as a Context, array of the values of the objective and then each constraint expression)
+        """
+        x = np.array(x, dtype=float)
+        if self.last is not None and np.array_equal(x, self.last[0]):
+            return self.last[1:]
+        context = self.baseContext.copy()
+        context.varVals.update(zip(self.designVars, x.tolist()))
+        if self.plan is None:
+            result = self.problem.solve(context, self.refContext, self.budget)
+        else:
+            result = self.problem.solvePlan(self.plan, context, self.refContext, self.budget)
+        self.solves += 1
+        if result.status in (STATUS_BUDGET_EXCEEDED, STATUS_CANCELLED):
+            raise DesignError("stopped: " + result.diagnosis)
+        if not result:
+            raise DesignError("couldn't solve the problem (" + result.status + ") with " + self.describe(x))
+        values = [metric.getValue(context) for metric in self.metrics]
+        if any(value is None for value in values):
+            raise DesignError("couldn't evaluate the objective and constraints with " + self.describe(x))
+        if self.plan is None:
+            self.plan = result.plan
+        # Warm start the next solve from this one
+        self.refContext = context
+        values = np.array(values, dtype=float)
+        self.last = (x, context, values)
+        self.lastGradients = None
+        return (context, values)
+
+    def getGradients(self, x):
+        # Gradients of the objective and each constraint expression with respect to the design variables, as a 2D array
+        (context, values) = self.evaluate(x)
+        if self.lastGradients is None:
+            self.lastGradients = np.array([[gradient[name] for name in self.designVars]
+                                           for gradient in gradients(self.problem, context, self.metrics, self.inputs)])
+        return self.lastGradients
+
+    def describe(self, x):
+        return ", ".join(name + " = " + str(value) for (name, value) in zip(self.designVars, x))
+
+    def optimize(self, start=None, method=DEFAULT_METHOD, tolerance=1e-8, maxIterations=100):
+        """
+        Find the best design
+        :param start: dict of starting values of the design variables (defaults to their values in the problem's default
+            context, or the inputs)
+        :param method: the scipy.optimize.minimize method - only some (e.g. SLSQP, trust-constr) handle constraints
+        :return: DesignResult
+        """
+        start = dict(start or {})
+        x0 = []
+        for name in self.designVars:
+            value = start.get(name, self.baseContext.varVals.get(name))
+            if value is None:
+                raise ValueError("no starting value for design variable " + name)
+            x0.append(value)
+        constraints = [{"type": "ineq", "fun": lambda x, i=i: self.evaluate(x)[1][i], "jac": lambda x, i=i: self.getGradients(x)[i]}
+                       for i in range(1, len(self.metrics))]
+        bounds = [self.bounds.get(name, (None, None)) for name in self.designVars]
+        iterations = [0]
+
+        def countIteration(*args):
+            iterations[0] += 1
+
+        try:
+            optimum = scipy.optimize.minimize(lambda x: self.sign * self.evaluate(x)[1][0], np.array(x0, dtype=float),
+                                              jac=lambda x: self.sign * self.getGradients(x)[0], method=method,
+                                              bounds=bounds, constraints=constraints, tol=tolerance,
+                                              options={"maxiter": maxIterations}, callback=countIteration)
+            (success, message, x) = (bool(optimum.success), str(optimum.message), optimum.x)
+        except DesignError as err:
+            print("Error! Optimisation stopped:", err)
+            if self.last is None:
+                return DesignResult(False, str(err), None, None, None, iterations[0], self.solves)
+            (success, message, x) = (False, str(err), self.last[0])
+        (context, values) = self.evaluate(x)
+        return DesignResult(success, message, dict(zip(self.designVars, x.tolist())), float(values[0]), context,
+                            iterations[0], self.solves)
+
+
+def parseAssignment(text):
+    # NAME=VALUE, for the command line
+    (name, sep, value) = text.partition("=")
+    if not sep:
+        raise argparse.ArgumentTypeError("expected NAME=VALUE, not " + repr(text))
+    return (name.strip(), float(value))
+
+
+def parseDesignVar(text):
+    # NAME, or NAME=LOW:HIGH with either bound optional, for the command line
+    (name, sep, bounds) = text.partition("=")
+    if not sep:
+        return (name.strip(), (None, None))
+    (low, colon, high) = bounds.partition(":")
+    if not colon:
+        raise argparse.ArgumentTypeError("expected NAME=LOW:HIGH, not " + repr(text))
+    return (name.strip(), (float(low) if low.strip() else None, float(high) if high.strip() else None))
+
+
+if __name__ == "__main__":
+    from probcache import loadProblem
+    argParser = argparse.ArgumentParser(description="Eutactic design optimiser: minimises or maximises a variable over some inputs")
+    argParser.add_argument("problem", help="problem file")
+    goal = argParser.add_mutually_exclusive_group(required=True)
+    goal.add_argument("--minimize", metavar="METRIC", help="variable or formula to minimise")
+    goal.add_argument("--maximize", metavar="METRIC", help="variable or formula to maximise")
+    argParser.add_argument("--vary", type=parseDesignVar, action="append", required=True, metavar="NAME[=LOW:HIGH]",
+                           help="a design variable, optionally with bounds (either may be left out)")
+    argParser.add_argument("--constraint", action="append", default=[], metavar="\"A <= B\"", help="an inequality constraint")
+    argParser.add_argument("--set", type=parseAssignment, action="append", default=[], metavar="NAME=VALUE", help="an input value")
+    argParser.add_argument("--method", default=DEFAULT_METHOD, help="scipy.optimize.minimize method")
+    argParser.add_argument("--verbose", action="store_true", help="show solving progress")
+    args = argParser.parse_args()
+    with contextlib.redirect_stdout(sys.stdout if args.verbose else open(os.devnull, "w")):
+        problem = loadProblem(args.problem)
+        optimizer = DesignOptimizer(problem, args.maximize or args.minimize, [name for (name, bounds) in args.vary],
+                                    dict(args.vary), args.constraint, args.maximize is not None, dict(args.set))
+        result = optimizer.optimize(method=args.method)
+    print(("Optimum found" if result.success else "Not converged") + ": " + result.message)
+    if result.design is not None:
+        for (name, value) in result.design.items():
+            print("  %-24s %.10g" % (name, value))
+        print("  %-24s %.10g" % (args.maximize or args.minimize, result.objective))
+        for (text, metric) in zip(args.constraint, optimizer.metrics[1:]):
+            print("  %-24s margin %.6g" % (text, metric.getValue(result.context)))
+    print(result.iterations, "iterations,", result.solves, "solves")
@@ -0,0 +1,185 @@
+# Structural degree-of-freedom analysis, for finding out whether a choice of inputs can be solved before trying to
+# Works purely on which variables appear in which constraints (the incidence graph), not on their values:
+# each constraint can determine at most one unknown, so a maximum matching of constraints to unknowns shows how many
+# unknowns can be determined, and the Dulmage-Mendelsohn decomposition of the graph shows which:
+# * unknowns that can be reached from an unmatched unknown by alternating paths are free (under-constrained)
+# * constraints that can be reached from an unmatched constraint are over-constrained (redundant, or conflicting,
+#   depending on the values - structure alone can't tell which)
+# * everything else is exactly determined
+# Toggling one input changes the maximum matching by at most one, so it's kept up to date with a single augmenting
+# path search per toggle, rather than being recomputed
+
+import collections
+
+from equationsolver import Context
+
+
+class DOFReport:
+    # The outcome of a degree-of-freedom analysis
+    def __init__(self, determined, free, overconstrained, missingInputs, excessConstraints):
+        # Names of the unknowns the constraints would determine, and of those they wouldn't
+        self.determined = determined
+        self.free = free
+        # Names of the constraints that are redundant or conflicting with the others (structurally over-constrained)
+        self.overconstrained = overconstrained
+        # How many more inputs are needed, and how many constraints too many there are for the unknowns
+        self.missingInputs = missingInputs
+        self.excessConstraints = excessConstraints
+
+    def isWellConstrained(self):
+        return self.missingInputs == 0 and self.excessConstraints == 0
+
+    def summary(self):
+        # One-line description, e.g. for a status bar
+        if self.isWellConstrained():
+            return "Well constrained: all " + str(len(self.determined)) + " unknowns determined"
+        parts = []
+        if self.missingInputs:
+            parts.append(str(self.missingInputs) + " more input(s) needed (free: " + ", ".join(sorted(self.free)) + ")")
+        if self.excessConstraints:
+            parts.append(str(self.excessConstraints) + " constraint(s) too many (among: " + ", ".join(sorted(self.overconstrained)) + ")")
+        return "; ".join(parts)
+
+    def __repr__(self):
+        return "<DOFReport: " + self.summary() + ">"
+
+
+class DOFAnalyzer:
+    """
+    Structural analysis of which of a problem's variables a set of inputs would determine
+    Inputs can be toggled one at a time (e.g. as the GUI's "Input?" boxes are clicked), and the counts of missing inputs
+    and excess constraints are up to date after each toggle; getReport() gives the full picture
+    """
+    def __init__(self, problem, inputs=None, constrs=None):
+        """
+        :param inputs: names of the input variables (defaults to those with a value in the problem's default context)
+        :param constrs: the constraints to analyse (defaults to all the problem's constraints)
+        """
+        self.constrs = list(problem.constrs if constrs is None else constrs)
+        # The variables each constraint refers to (by name, as contexts know them), and the constraints each variable is in
+        self.varsOfConstr = [sorted(set(var.getName() for var in constr.getUndefinedExprs(Context()))) for constr in self.constrs]
+        self.constrsOfVar = {name: [] for name in problem.getVariables()}
+        for (index, names) in enumerate(self.varsOfConstr):
+            for name in names:
+                self.constrsOfVar.setdefault(name, []).append(index)
+        if inputs is None:
+            inputs = [name for name in self.constrsOfVar if problem.defaultContext.varVals.get(name) is not None]
+        self.inputs = set(name for name in inputs if name in self.constrsOfVar)
+        # The matching: the unknown each constraint determines, and the constraint determining each unknown
+        self.varOfConstr = [None] * len(self.constrs)
+        self.constrOfVar = {}
+        for index in range(len(self.constrs)):
+            self.augmentFromConstr(index)
+
+    def isInput(self, name):
+        return name in self.inputs
+
+    def setInput(self, name, isInput):
+        # Make a variable an input (or an unknown), updating the matching
+        if name not in self.constrsOfVar or isInput == (name in self.inputs):
+            return
+        if isInput:
+            self.inputs.add(name)
+            index = self.constrOfVar.pop(name, None)
+            if index is not None:
+                # The constraint that determined it may be able to determine something else instead
+                self.varOfConstr[index] = None
+                self.augmentFromConstr(index)
+        else:
+            self.inputs.discard(name)
+            self.augmentFromVar(name)
+
+    def getMissingInputs(self):
+        # Number of unknowns that no constraint is left to determine
+        return len(self.constrsOfVar) - len(self.inputs) - len(self.constrOfVar)
+
+    def getExcessConstraints(self):
+        # Number of constraints with no unknown left to determine
+        return len(self.constrs) - len(self.constrOfVar)
+
+    def augmentFromConstr(self, start):
+        # Try to match an unmatched constraint, by finding an alternating path to an unmatched unknown
+        reachedFrom = {}
+        queue = collections.deque([start])
+        seen = {start}
+        while queue:
+            index = queue.popleft()
+            for name in self.varsOfConstr[index]:
+                if name in self.inputs or name in reachedFrom:
+                    continue
+                reachedFrom[name] = index
+                other = self.constrOfVar.get(name)
+                if other is None:
+                    # Flip the matching along the path back to the start
+                    while name is not None:
+                        index = reachedFrom[name]
+                        previous = self.varOfConstr[index]
+                        self.varOfConstr[index] = name
+                        self.constrOfVar[name] = index
+                        name = previous
+                    return True
+                if other not in seen:
+                    seen.add(other)
+                    queue.append(other)
+        return False
+
+    def augmentFromVar(self, start):
+        # Try to match an unmatched unknown, by finding an alternating path to an unmatched constraint
+        reachedFrom = {}
+        queue = collections.deque([start])
+        seen = {start}
+        while queue:
+            name = queue.popleft()
+            for index in self.constrsOfVar[name]:
+                if index in reachedFrom:
+                    continue
+                reachedFrom[index] = name
+                other = self.varOfConstr[index]
+                if other is None:
+                    while index is not None:
+                        name = reachedFrom[index]
+                        previous = self.constrOfVar.get(name)
+                        self.constrOfVar[name] = index
+                        self.varOfConstr[index] = name
+                        index = previous
+                    return True
+                if other not in seen:
+                    seen.add(other)
+                    queue.append(other)
+        return False
+
+    def getFreeVars(self):
+        # Unknowns reachable by alternating paths from an unmatched unknown - i.e. those the constraints leave free
+        free = set(name for name in self.constrsOfVar if name not in self.inputs and name not in self.constrOfVar)
+        queue = collections.deque(free)
+        while queue:
+            name = queue.popleft()
+            for index in self.constrsOfVar[name]:
+                matched = self.varOfConstr[index]
+                if matched is not None and matched not in free:
+                    free.add(matched)
+                    queue.append(matched)
+        return free
+
+    def getUnderconstrained(self, free):
+        # Indices of the constraints that only link free variables (given getFreeVars()), so can't be solved yet
+        return set(self.constrOfVar[name] for name in free if name in self.constrOfVar)
+
+    def getOverconstrained(self):
+        # Indices of the constraints reachable by alternating paths from an unmatched constraint
+        over = set(index for (index, name) in enumerate(self.varOfConstr) if name is None)
+        queue = collections.deque(over)
+        while queue:
+            index = queue.popleft()
+            for name in self.varsOfConstr[index]:
+                matched = self.constrOfVar.get(name)
+                if matched is not None and matched not in over:
+                    over.add(matched)
+                    queue.append(matched)
+        return over
+
+    def getReport(self):
+        free = self.getFreeVars()
+        determined = set(name for name in self.constrsOfVar if name not in self.inputs and name not in free)
+        overconstrained = [self.constrs[index].getName() for index in sorted(self.getOverconstrained())]
+        return DOFReport(determined, free, overconstrained, self.getMissingInputs(), self.getExcessConstraints())
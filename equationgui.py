@@ -1,4 +1,4 @@
-import csv
+import concurrent.futures
 import io
 import os
 import sys
@@ -7,14 +7,23 @@ import numpy as np
 import pyqtgraph as pg
 from PySide.QtCore import *
 from PySide.QtGui import *
-from pydot import Dot, Node, Edge
 
 from InfiniteRangeSlider import InfiniteRangeSlider
+from budgets import SolveBudget, CancelToken
+from dofanalyzer import DOFAnalyzer
 from equationsolver import ScalarVariable, Context
-from parsedproblem import ParsedProblem, testfilename
+from parsedproblem import testfilename
+from probcache import loadProblem
+from resultexport import writerForFilename
+from surrogate import RBFSurrogate
 
 __author__ = 'David Wyatt'
 
+# Longest a single solve from the GUI may take before giving up, in seconds
+GUI_SOLVE_SECONDS = 30
+# How often to check whether a solve running in the background has finished, in milliseconds
+SOLVE_POLL_MS = 20
+
 # Code from StackOverflow
 # To capture stdout and redirect to a text field
 # http://stackoverflow.com/questions/8356336/how-to-capture-output-of-pythons-interpreter-and-show-in-a-text-widget
@@ -32,6 +41,19 @@ class EquationGui(QMainWindow):
     def __init__(self, probFileName):
         super(EquationGui, self).__init__()
         self.probfilename = probFileName
+        # Lets the cancel button stop a solve part way through (see solveProblem)
+        self.cancelToken = CancelToken()
+        self.solving = False
+        # Solves run in a background thread, so the GUI stays responsive; the one running is (future, problem, context,
+        # input names), checked on by a timer (see checkSolve)
+        self.solveExecutor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.solveJob = None
+        # Whether the inputs changed during the running solve, so it needs solving again when it finishes
+        self.solveAgain = False
+        self.solveTimer = QTimer(self)
+        self.solveTimer.timeout.connect(self.checkSolve)
+        # Fitted to the solutions found so far for the current inputs, to preview solutions while solving (see previewSolution)
+        self.surrogate = None
 
         # Install the custom output stream
         sys.stdout = EmittingStream()
@@ -45,6 +67,9 @@ class EquationGui(QMainWindow):
     def __del__(self):
         # Restore sys.stdout
         sys.stdout = sys.__stdout__
+        # Stop any solve still running
+        self.cancelToken.cancel()
+        self.solveExecutor.shutdown(wait=False)
 
     def initUI(self):
         self.setWindowTitle("eutactic GUI")
@@ -60,9 +85,9 @@ class EquationGui(QMainWindow):
         openAction.setStatusTip('Open problem file')
         openAction.triggered.connect(self.loadProblemFromFile)
 
-        exportCSVAction = QAction(QIcon('save.png'), '&Export CSV of solutions', self)
+        exportCSVAction = QAction(QIcon('save.png'), '&Export solutions', self)
         exportCSVAction.setShortcut('Ctrl+E')
-        exportCSVAction.setStatusTip('Export CSV of solutions')
+        exportCSVAction.setStatusTip('Export solutions as CSV, NumPy or Parquet')
         exportCSVAction.triggered.connect(self.exportSolutionsCSV)
 
         reloadProblemAction = QAction('&Reload problem', self)
@@ -157,12 +182,23 @@ class EquationGui(QMainWindow):
         solveControlLayout.addWidget(solveButton)
         solveButton.pressed.connect(self.solveProblem)
 
+        # Cancel button, to stop a solve that's taking too long
+        cancelButton = QPushButton("Cancel", self)
+        solveControlLayout.addWidget(cancelButton)
+        cancelButton.pressed.connect(self.cancelToken.cancel)
+
         # Enable autosolving checkbox
         self.autosolveCB = QCheckBox("Autosolve?", self)
         self.autosolveCB.setCheckState(Qt.Checked)
         self.autosolveCB.setSizePolicy(QSizePolicy.Fixed,QSizePolicy.Fixed)
         solveControlLayout.addWidget(self.autosolveCB)
 
+        # Enable previewing checkbox: show approximate values straight away while solving (see previewSolution)
+        self.previewCB = QCheckBox("Preview?", self)
+        self.previewCB.setCheckState(Qt.Checked)
+        self.previewCB.setSizePolicy(QSizePolicy.Fixed,QSizePolicy.Fixed)
+        solveControlLayout.addWidget(self.previewCB)
+
         ######
         # Parser/solver outputs, captured in a widget
         outputWidget = QWidget()
@@ -265,15 +301,18 @@ class EquationGui(QMainWindow):
         # Clear the stdout window
         self.clearOutput()
 
-        # Parse the file into a Problem
-        self.problem = ParsedProblem(self.probfilename)
+        # Parse the file into a Problem (or fetch it from the cache if it hasn't changed)
+        self.problem = loadProblem(self.probfilename)
 
         # Construct a dict of all variables in problem, sorted by name
         # Filter by the ones that are actually variables
-        self.varDict = {expr.name: expr for expr in filter(lambda expr: isinstance(expr, ScalarVariable), self.problem.exprs)}
+        self.varDict = self.problem.getVariables()
         # And a list of all the variable names, sorted alphabetically case-insensitively
         self.varNameList = sorted(self.varDict.keys(), key=lambda s: s.lower())
 
+        # Structural analysis of the chosen inputs, kept up to date as they're toggled (see updateTableInputState)
+        self.dofAnalyzer = DOFAnalyzer(self.problem, [])
+
         # Update bits of the UI with details of the Problem's variables
         self.populateVarTable(self.problem.defaultContext)
         self.updateTableInputState(None)
@@ -282,6 +321,12 @@ class EquationGui(QMainWindow):
         self.clearSolutions()
         # Clear the previous reference context (used for providing a first-pass for numerical solutions)
         self.refContext = False
+        # And the surrogate fitted to the previous problem's solutions
+        self.surrogate = None
+        # A solve of the previous problem still running is no use now (see checkSolve)
+        if self.solving:
+            self.cancelToken.cancel()
+            self.solveAgain = False
 
         # Set the lists of variables for the graph axes
         self.varPlotXAxisMenu.clear()
@@ -327,6 +372,8 @@ class EquationGui(QMainWindow):
             #self.varTable.cellWidget(i, 1).setValue(varValue)
             # Set up table to resolve if value is changed
             spinner.valueChanged.connect(lambda x: self.solveProblem() if self.autosolveCB.isChecked() else None)
+            # And preview the solution while the slider is dragged
+            spinner.valueTracking.connect(lambda x, varName=self.varNameList[i]: self.previewSolution({varName: x}) if self.previewCB.isChecked() else None)
 
         # Connect events from the whole table to update the editability of entries in the table
         self.varTable.itemClicked.connect(self.updateTableInputState)
@@ -340,6 +387,8 @@ class EquationGui(QMainWindow):
         for i in range(self.varTable.rowCount()):
             isInput = self.varTable.item(i,1).checkState()
             #print(isInput)
+            # (Does nothing unless the row has actually changed)
+            self.dofAnalyzer.setInput(self.varTable.item(i, 0).text(), isInput == Qt.CheckState.Checked)
             #flags = self.varTable.item(i, 1).flags()
             if isInput == Qt.CheckState.Checked:
                 #flags |= Qt.ItemIsEditable
@@ -353,12 +402,16 @@ class EquationGui(QMainWindow):
                 pass
             #self.varTable.item(i, 1).setFlags(flags)
             #print(bool(flags & Qt.ItemIsEnabled), bool(flags & Qt.ItemIsEditable))
+        # Say straight away whether the inputs as chosen can be solved, rather than waiting for a solve to fail
+        self.statusBar().showMessage(self.dofAnalyzer.getReport().summary())
         self.show()
 
-    def solveProblem(self):
-        #print("Solving...")
-        # Create a new context with values from value table
-        solveContext = Context()
+    def getInputContext(self, overrides=None):
+        # Create a new context with values from value table, and the names of the inputs in it
+        # overrides is an optional dict of values to use instead of the table's, by variable name
+        overrides = overrides or {}
+        inputContext = Context()
+        inputNames = []
         for i in range(self.varTable.rowCount()):
             varName = self.varTable.item(i, 0).text()
             # Only use those variables marked as "Input"
@@ -368,27 +421,93 @@ class EquationGui(QMainWindow):
                 #    varVal = None
                 #else:
                 #    varVal = float(varValStr)
-                varVal = self.varTable.cellWidget(i, 2).value()
+                varVal = overrides.get(varName, self.varTable.cellWidget(i, 2).value())
                 if varVal == np.nan:
                     varVal = None
                 #print(str(self.exprs[varName]))
-                self.varDict[varName].setValue(varVal, solveContext)
+                self.varDict[varName].setValue(varVal, inputContext)
+                inputNames.append(varName)
             else:
-                self.varDict[varName].setValue(None, solveContext)
+                self.varDict[varName].setValue(None, inputContext)
+        return (inputContext, inputNames)
+
+    def getSurrogate(self, inputNames):
+        # The surrogate for these inputs - starting a new one if the inputs have changed since the last
+        if self.surrogate is None or self.surrogate.inputNames != inputNames:
+            self.surrogate = RBFSurrogate(inputNames, [varName for varName in self.varNameList if varName not in inputNames])
+        return self.surrogate
+
+    def previewSolution(self, overrides=None):
+        # Show approximate values of the other variables straight away, from the surrogate fitted to the solutions found so
+        # far for the same inputs, marked as approximate until the exact solution replaces them
+        (inputContext, inputNames) = self.getInputContext(overrides)
+        approxVals = self.getSurrogate(inputNames).predict(inputContext.varVals)
+        if approxVals is None:
+            return
+        for i in range(self.varTable.rowCount()):
+            varName = self.varTable.item(i, 0).text()
+            if varName in approxVals:
+                self.varTable.cellWidget(i, 2).blockSignals(True)
+                self.varTable.cellWidget(i, 2).setValue(approxVals[varName])
+                self.varTable.cellWidget(i, 2).blockSignals(False)
+                self.varTable.cellWidget(i, 2).setApproximate(True)
+        self.statusBar().showMessage("Approximate values, from " + str(len(self.surrogate)) + " solution(s) - solving...")
+
+    def solveProblem(self):
+        # Only one solve runs at a time: if one's running already, solve again with the new inputs once it's finished
+        if self.previewCB.isChecked():
+            self.previewSolution()
+        if self.solving:
+            self.solveAgain = True
+            return
+        #print("Solving...")
+        (solveContext, inputNames) = self.getInputContext()
         #print(solveContext)
-        # Solve
-        self.problem.solve(solveContext, self.refContext)
-        # Re-update table with values after solution
-        self.storeSolutionVals(solveContext)
+        # Solve, in the background
+        self.cancelToken.reset()
+        budget = SolveBudget(maxSeconds=GUI_SOLVE_SECONDS, cancelToken=self.cancelToken)
+        self.solving = True
+        future = self.solveExecutor.submit(self.problem.solve, solveContext, self.refContext, budget)
+        self.solveJob = (future, self.problem, solveContext, inputNames)
+        self.solveTimer.start(SOLVE_POLL_MS)
+
+    def checkSolve(self):
+        # Called by the timer while a solve is running in the background, to pick up its result once it's finished
+        (future, problem, solveContext, inputNames) = self.solveJob
+        if not future.done():
+            return
+        self.solveTimer.stop()
+        self.solving = False
+        self.solveJob = None
+        try:
+            result = future.result()
+        except Exception as err:
+            print("Error! Solve failed:", err)
+            result = None
+        # (Ignoring the result if another problem's been loaded since)
+        if result is not None and problem is self.problem:
+            self.storeSolve(solveContext, inputNames, result)
+        if self.solveAgain:
+            self.solveAgain = False
+            self.solveProblem()
+        else:
+            self.statusBar().showMessage(self.dofAnalyzer.getReport().summary())
+
+    def storeSolve(self, solveContext, inputNames, result):
+        # Re-update table with values after solution (unless the inputs have changed since, and it's about to be solved again)
+        self.storeSolutionVals(solveContext, result.status, updateTable=not self.solveAgain)
         #print("Solved, in theory")
         # Store the solution context as a first-pass for future numerical solutions if necessary
         self.refContext = solveContext
+        # And refine the surrogate with it
+        if result:
+            self.getSurrogate(inputNames).addSolution(solveContext)
 
-    def storeSolutionVals(self, context):
+    def storeSolutionVals(self, context, status, updateTable=True):
         # Temporarily disable events from table while we update its contents
         #self.varTable.blockSignals(True)
         # Update the table of variables in the problem
-        for i in range(self.varTable.rowCount()):
+        for i in range(self.varTable.rowCount() if updateTable else 0):
             varName = self.varTable.item(i, 0).text()
             #self.varTable.item(i, 1).setText(str(self.varDict[varName].getValue(context)))
             # Temporarily disable events from table while we update its contents
@@ -396,11 +515,14 @@ class EquationGui(QMainWindow):
             self.varTable.cellWidget(i, 2).setValue(self.varDict[varName].getValue(context))
             # Reenable events
             self.varTable.cellWidget(i, 2).blockSignals(False)
+            # The exact value replaces any preview
+            self.varTable.cellWidget(i, 2).setApproximate(False)
         # Reenable events
         #self.varTable.blockSignals(False)
         # Store the variable values in a "database"
         solnDict = {varName: self.varDict[varName].getValue(context) for varName in self.varNameList}
         self.solutionVals.append(solnDict)
+        self.solutionStatuses.append(status)
         self.updateSolutionsTable()
         self.updateSolnsGraph()
 
@@ -422,6 +544,7 @@ class EquationGui(QMainWindow):
     def clearSolutions(self):
         # Reset the stored database of solutions
         self.solutionVals = []
+        self.solutionStatuses = []
 
         # Clear the table
         self.resetSolutionsTable()
@@ -505,6 +628,7 @@ class EquationGui(QMainWindow):
         self.glw.show()
 
     def addNodesForChildren(self, g, expr, parent):
+        from pydot import Node, Edge
         if expr.isComposite():
             # If it's its own composite expression
             # Add a node
@@ -527,6 +651,8 @@ class EquationGui(QMainWindow):
                 pass
 
     def draw(self, prob, targetFile):
+        # pydot is only needed for drawing, so don't import it until then
+        from pydot import Dot, Node
         # Do the graphing stuff here...
         # Root graph
         g = Dot(graph_type="digraph", nodesep=2, overlap=False)
@@ -545,15 +671,19 @@ class EquationGui(QMainWindow):
         g.write_png(targetFile, prog="neato")
 
     def exportSolutionsCSV(self):
-        fname = QFileDialog.getSaveFileName(parent=self, caption='Export solutions as CSV', dir=os.path.splitext(self.probfilename)[0], filter="*.csv")
+        fname = QFileDialog.getSaveFileName(parent=self, caption='Export solutions', dir=os.path.splitext(self.probfilename)[0], filter="*.csv;;*.npy;;*.npz;;*.parquet")
         #print(fname)
         # TODO Prompt before overwriting existing file
         if fname[0]:
-            with open(fname[0], 'w', newline='') as csvfile:
-                writer = csv.DictWriter(csvfile, fieldnames=self.varNameList)
-                writer.writeheader()
-                for soln in self.solutionVals:
-                    writer.writerow(soln)
+            # The writer is chosen by file extension - fall back on the selected filter if none was typed
+            filename = fname[0]
+            if not os.path.splitext(filename)[1]:
+                filename += fname[1].lstrip("*")
+            try:
+                with writerForFilename(filename, self.varNameList) as writer:
+                    writer.writeRows(zip(self.solutionVals, self.solutionStatuses))
+            except (ImportError, ValueError) as err:
+                print("Error exporting solutions:", err)
 
 if __name__=="__main__":
     # Create a Qt application
@@ -1,14 +1,51 @@
 # Numerical infrastructure
 # David Wyatt, 3 March 2015
 
+import collections
+import threading
+import time
+import types
+
 from constraints import *
 from expressions import *
-import scipy.optimize
-import numpy as np
+from symboltable import SymbolTable
+# N.B. numpy and scipy are only imported when they're first needed (for numerical solving),
+# so that problems which can be solved analytically don't pay for importing them
 
 VERBOSE = False
+# Largest block of constraints whose Jacobian rank is checked before numerical solving (it takes an SVD)
+MAX_RANK_CHECK_SIZE = 500
 __author__ = 'David Wyatt'
 
+# Possible outcomes of a solve
+STATUS_SOLVED = "solved"
+STATUS_FAILED = "failed"
+# Under-constrained, but everything that could be determined was (see SolveResult.freeVars)
+STATUS_PARTIAL = "partial"
+# Stopped part way through by a SolveBudget running out, or by being cancelled (see budgets.py)
+STATUS_BUDGET_EXCEEDED = "budget exceeded"
+STATUS_CANCELLED = "cancelled"
+# The index of each status in this list is its code in binary result files, so only ever append to it
+STATUSES = [STATUS_SOLVED, STATUS_FAILED, STATUS_PARTIAL, STATUS_BUDGET_EXCEEDED, STATUS_CANCELLED]
+# The status of a constraint the solve never got to (or left, as it only links free variables)
+STATUS_UNSOLVED = "unsolved"
+
+# Kinds of block in a solve's plan: a constraint with no unknowns checked for consistency, a constraint solved
+# analytically for its one unknown, or constraints solved numerically together
+BLOCK_CHECKED = "checked"
+BLOCK_ANALYTIC = "analytic"
+BLOCK_NUMERIC = "numeric"
+
+# One step of a solve's plan: the names of its constraints and of the variables it solved for, its status (one of
+# STATUSES), the numerical method that solved it (see portfolio.py, None if analytic) and how long it took, in seconds
+PlanBlock = collections.namedtuple("PlanBlock", ["kind", "constrs", "variables", "status", "method", "seconds"])
+
+# The method reported for blocks of array contexts solved by batched Newton iteration (see Problem.findBatchRoots)
+METHOD_BATCH_NEWTON = "batch newton"
+
+# Guards the lazily-made parts of problems (tapes and portfolios) shared by concurrent solves
+_lazyLock = threading.Lock()
+
 class Context:
     # A context is a set of variable-value bindings
     # The keys for the variable values are the variable names
@@ -40,22 +77,117 @@ class Context:
     def copy(self):
         return Context(varVals = self.varVals)
 
+    def getArraySize(self):
+        # If any values are arrays, with one element per instance (e.g. when solving an objects.NIObjectArray),
+        # the number of instances, else None
+        for val in self.varVals.values():
+            if getattr(val, "ndim", 0) > 0:
+                return len(val)
+        return None
+
+    def getInstance(self, i):
+        # A context of plain values for just one instance of an array context
+        return Context({name: (val[i] if getattr(val, "ndim", 0) > 0 else val) for (name, val) in self.varVals.items()})
+
+
+
+class SolveResult:
+    """
+    The outcome of one solve (see Problem.solve)
+    Immutable, so it can be handed between threads freely; true if the problem was solved completely
+    """
+    __slots__ = ("status", "values", "plan", "constrStatuses", "freeVars", "diagnosis", "seconds")
+
+    def __init__(self, status, values, plan, constrStatuses, freeVars=(), diagnosis=None, seconds=0.0):
+        """
+        :param status: one of STATUSES
+        :param values: dict of every variable's value (None if it wasn't determined), by name
+        :param plan: sequence of PlanBlocks, in the order they were solved
+        :param constrStatuses: dict of each constraint's status (that of the block it was in, or STATUS_UNSOLVED), by name
+        :param freeVars: names of the variables left undetermined by a partial solve
+        :param diagnosis: why a block couldn't be solved numerically, or why the solve was stopped, if either is why it failed
+        :param seconds: how long the whole solve took
+        """
+        for (name, value) in [("status", status), ("values", types.MappingProxyType(dict(values))), ("plan", tuple(plan)),
+                              ("constrStatuses", types.MappingProxyType(dict(constrStatuses))),
+                              ("freeVars", tuple(freeVars)), ("diagnosis", diagnosis), ("seconds", seconds)]:
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("SolveResult is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError("SolveResult is immutable")
+
+    def __reduce__(self):
+        # Pickle through the constructor (e.g. to send results between processes), as the attributes can't be set
+        return (SolveResult, (self.status, dict(self.values), self.plan, dict(self.constrStatuses), self.freeVars, self.diagnosis, self.seconds))
+
+    def __bool__(self):
+        return self.status == STATUS_SOLVED
+
+    def getContext(self):
+        # The solution as a (new) context
+        return Context(self.values)
+
+    def getMethods(self):
+        # The numerical method that solved each numerical block, by the block's constraint names
+        return {block.constrs: block.method for block in self.plan if block.kind == BLOCK_NUMERIC}
+
+    def __repr__(self):
+        return "<SolveResult: " + self.status + ", " + str(len(self.plan)) + " blocks in " + str(round(self.seconds, 6)) + " s>"
+
+
+class SolveState:
+    # What one solve has done so far - kept out of the Problem, so that it can be solved many times at once
+    def __init__(self, tracker=None):
+        # Charged for the solve's work (see budgets.py), if it has a budget
+        self.tracker = tracker
+        self.startTime = time.perf_counter()
+        self.plan = []
+        self.status = STATUS_FAILED
+        self.freeVars = []
+        self.diagnosis = None
+
+    def addBlock(self, kind, constrs, undefVars, succeeded, method, startTime):
+        names = tuple(sorted(set(var.getName() for var in undefVars)))
+        status = STATUS_SOLVED if succeeded else STATUS_FAILED
+        self.plan.append(PlanBlock(kind, tuple(constr.getName() for constr in constrs), names, status, method, time.perf_counter() - startTime))
+
+    def getResult(self, problem, context):
+        constrStatuses = dict.fromkeys((constr.getName() for constr in problem.constrs), STATUS_UNSOLVED)
+        for block in self.plan:
+            for name in block.constrs:
+                constrStatuses[name] = block.status
+        return SolveResult(self.status, context.varVals, self.plan, constrStatuses, self.freeVars, self.diagnosis,
+                           time.perf_counter() - self.startTime)
 
 
 class Problem:
     def __init__(self, name):
         self.name = name
         self.exprs = set()
+        # Named expressions (variables and constants), for lookup by name
+        self.symbols = SymbolTable()
         self.constrs = set()
-        self.sequenced = False
         self.defaultContext = Context({})
+        # Distributions of input variables' values for Monte Carlo runs (see montecarlo.py), by name
+        self.distributions = {}
+        # Tape of all the constraints' residuals, made when first needed (see getTape)
+        self.tape = None
+        # Chooses the method for each block solved numerically, and remembers which worked (see portfolio.py)
+        # N.B. Made when first needed, so that problems which solve analytically don't import scipy
+        self.portfolio = None
 
     def addExpression(self, expr):
         if expr.isComposite():
             self.addExprs(*expr.getChildren())
-        else:
+        elif expr not in self.exprs:
+            # Only take the default value from expressions new to this problem - once it's here, its default lives in the default context
             self.exprs.add(expr)
             self.defaultContext.setValue(expr, expr.value)
+            if not isinstance(expr, FixedValue):
+                self.symbols.define(expr.getName(), expr)
 
     def addExprs(self, *exprs):
         for expr in exprs:
@@ -63,6 +195,7 @@ class Problem:
 
     def addConstr(self, constr):
         self.constrs.add(constr)
+        self.tape = None
         self.addExprs(*constr.getExprs())
 
     def addConstrs(self, *constrs):
@@ -73,71 +206,182 @@ class Problem:
         self.addExprs(*obj.variables)
         self.addConstrs(*obj.constrs)
 
-    def solve(self, context=False, refContext=False):
+    def getVariableNames(self):
+        # Names of all the (non-constant) variables in the problem, sorted alphabetically case-insensitively
+        return sorted(self.getVariables().keys(), key=lambda s: s.lower())
+
+    def getVariables(self):
+        # Dict of all the (non-constant) variables in the problem, keyed by name
+        return self.symbols.filter(ScalarVariable)
+
+    def getTape(self):
+        # The residuals of all the problem's constraints, as a tape (see tape.py) - e.g. for checking many solutions at once
+        with _lazyLock:
+            if self.tape is None:
+                from tape import Tape
+                self.tape = Tape(list(self.constrs))
+            return self.tape
+
+    def getPortfolio(self):
+        # The choice of methods for numerical solving (see portfolio.py) - set self.portfolio to configure it, e.g. to race methods
+        with _lazyLock:
+            if self.portfolio is None:
+                from portfolio import Portfolio
+                self.portfolio = Portfolio()
+            return self.portfolio
+
+    def solve(self, context=False, refContext=False, budget=None):
         """
         Iteratively attempt to assign values to every undefined ScalarValue
         Try to sequence constrs first to solve in the right order
+        N.B. Solving doesn't change the problem (everything about the solve is in the result it returns), so one problem
+        can be solved in many threads at once, each with its own context
 
-        :param context: The context to work in (defaults to the default context)
+        :param context: The context to work in, which the solution is written into (defaults to a copy of the default context)
         :param refContext: A reference context with reference values for the variables (used if numerical solution is needed, as starting points for the iteration)
-        :return: True if a solution was successfully found, else False
+        :param budget: optional budgets.SolveBudget limiting how long the solve may take, or letting it be cancelled
+        :return: SolveResult, which is True if a solution was successfully found, else False
+        """
+        from budgets import BudgetExceeded
+        context = context or self.defaultContext.copy()
+        state = SolveState(budget.start() if budget is not None else None)
+        try:
+            state.status = self.runSolve(context, refContext, state)
+        except BudgetExceeded as err:
+            print("Stopped solving:", err)
+            state.status = err.status
+            state.diagnosis = str(err)
+        return state.getResult(self, context)
+
+    def solvePlan(self, plan, context=False, refContext=False, budget=None):
         """
+        Solve by following the plan of an earlier solve with the same inputs (but not necessarily the same input values),
+        skipping the work of finding the order to solve the constraints in - e.g. for the many solves of an optimisation
+        Falls back to solve() if the plan doesn't fit, i.e. different variables have values in context than the plan expects
+
+        :param plan: sequence of PlanBlocks, from the SolveResult of a solve that solved completely
+        :return: SolveResult (see solve)
+        """
+        from budgets import BudgetExceeded
+        context = context or self.defaultContext.copy()
+        steps = self.getPlanSteps(plan, context)
+        if steps is None:
+            print("The plan doesn't fit these inputs - solving from scratch")
+            return self.solve(context, refContext, budget)
+        state = SolveState(budget.start() if budget is not None else None)
+        try:
+            state.status = STATUS_SOLVED
+            for (kind, constrs, names) in steps:
+                if state.tracker is not None:
+                    state.tracker.check()
+                startTime = time.perf_counter()
+                undefVars = set(var for constr in constrs for var in constr.getUndefinedExprs(context))
+                if kind == BLOCK_NUMERIC:
+                    method = self.numSolve(constrs, context, undefVars, refContext, state.tracker)
+                    succeeded = bool(method)
+                else:
+                    method = None
+                    # Checked and analytic blocks are single constraints, each solved for its one unknown (if any)
+                    succeeded = constrs[0].propagate(context)
+                # A step can "succeed" without giving its variables values, e.g. outside a function's domain
+                succeeded = succeeded and all(context.varVals.get(name) is not None for name in names)
+                state.addBlock(kind, constrs, undefVars, succeeded, method, startTime)
+                if state.plan[-1].status != STATUS_SOLVED:
+                    print("Error! Failed to solve " + str(list(state.plan[-1].constrs)) + " following the plan")
+                    state.status = STATUS_FAILED
+                    break
+        except BudgetExceeded as err:
+            print("Stopped solving:", err)
+            state.status = err.status
+            state.diagnosis = str(err)
+        return state.getResult(self, context)
+
+    def getPlanSteps(self, plan, context):
+        # The constraints of each block of a plan, as (kind, constraints, variable names) - or None if the plan isn't
+        # for a complete solve of this problem with the same variables given values as in context
+        constrsByName = {constr.getName(): constr for constr in self.constrs}
+        if len(constrsByName) != len(self.constrs):
+            # Constraint names aren't unique, so the plan's can't be matched up with them
+            return None
+        solvedNames = set(name for block in plan for name in block.variables)
+        known = set(name for (name, value) in context.varVals.items() if value is not None)
+        if solvedNames & known or set(self.getTape().slotNames) - solvedNames - known:
+            return None
+        try:
+            steps = [(block.kind, [constrsByName[name] for name in block.constrs], block.variables) for block in plan]
+        except KeyError:
+            return None
+        if set(constr for (kind, constrs, names) in steps for constr in constrs) != self.constrs:
+            return None
+        return steps
+
+    def runSolve(self, context, refContext, state):
+        # The body of solve, returning the status it ended in; it may be stopped part way through by state.tracker
+        # (if not None) raising BudgetExceeded
         print("********Solving")
-        context = context or self.defaultContext
-        # The sequence constraints were solved in, for future reference
-        self.solveseq = []
+        tracker = state.tracker
         tempconstrlist = list(self.constrs)
-        # Whether we've encountered a failure or not
+        unsolved = set(tempconstrlist)
+        # Which constraints each variable appears in, so that when a variable is solved for, only the constraints it
+        # appears in need looking at again, rather than every constraint - so sequencing takes time proportional to the
+        # size of the problem
+        constrsOfVar = {}
+        for constr in tempconstrlist:
+            for var in set(constr.getUndefinedExprs(Context())):
+                constrsOfVar.setdefault(var.getName(), []).append(constr)
+        # Constraints waiting to be looked at
+        queue = collections.deque(tempconstrlist)
+        queued = set(tempconstrlist)
         # Loop while there are still unsolved constraints
-        while (len(tempconstrlist) > 0):
-            # Beginning of pass
-            foundANewConstr = False
-            #print("****Start solve loop")
-            # Loop over all constraints
-            for constr in list(tempconstrlist):
+        while (len(unsolved) > 0):
+            while queue:
+                constr = queue.popleft()
+                queued.discard(constr)
+                if tracker is not None:
+                    tracker.check()
+                startTime = time.perf_counter()
                 undefVars = constr.getUndefinedExprs(context)
                 if len(undefVars) == 0:
                     # Fully constrained => check it's consistent
                     #print("Checking full-constrained constraint for consistency:", constr.getName())
                     result = constr.propagate(context)
+                    state.addBlock(BLOCK_CHECKED, [constr], undefVars, result, None, startTime)
                     if not(result):
-                        break
+                        return STATUS_FAILED
                     print("Checked \"" + constr.getName() + "\" and found it to be consistent")
-                    # Admin
-                    tempconstrlist.remove(constr)
-                    self.solveseq.append(constr)
-                    foundANewConstr = True
                 elif len(undefVars) == 1:
                     # Next easiest case is if only 1 undefined expression
                     #print("Propagating constraint:", constr.getName())
                     # Actually solve this constraint!
                     result = constr.propagate(context)
+                    state.addBlock(BLOCK_ANALYTIC, [constr], undefVars, result, None, startTime)
                     if not(result):
-                        break
-                    # Admin
-                    tempconstrlist.remove(constr)
-                    self.solveseq.append(constr)
+                        return STATUS_FAILED
                     print("Solved \"" + constr.getName() + "\" analytically to give " + str(undefVars[0].getName()) + " = " + str(context.getValue(undefVars[0])))
-                    foundANewConstr = True
                 elif len(set(undefVars)) == 1: # use set() to remove duplicates
                     undefVarsSet = set(undefVars)
                     # Look out for cases where we have multiple copies of the same variable in a constraint!
                     #print("Detected a constraint where there are multiple copies of the same variable:", constr.getName(), constr.getTextFormula(), "(Variable: " + str(undefVars[0].getName()), ")")
                     print("Solving \"" + constr.getName() + "\" numerically due to multiple occurrences of " + undefVars[0].getName() + "...")
-                    result = self.numSolve([constr], context, undefVarsSet, refContext)
-                    if not(result):
-                        break
-                    # Admin
-                    tempconstrlist.remove(constr)
-                    self.solveseq.append(constr)
+                    method = self.numSolve([constr], context, undefVarsSet, refContext, tracker)
+                    state.addBlock(BLOCK_NUMERIC, [constr], undefVarsSet, method, method, startTime)
+                    if not(method):
+                        return STATUS_FAILED
                     print("Solved \"" + constr.getName() + "\" numerically to give " + str(undefVars[0].getName()) + " = " + str(context.getValue(undefVars[0])))
-                    foundANewConstr = True
                 else:
                     # Genuinely multiple undefined variables
-                    # So leave it to the end...
-                    pass
-                # End of loop over all constraints
-            if foundANewConstr == False:
+                    # So leave it until one of them is solved for (or to the end...)
+                    continue
+                # Admin
+                unsolved.remove(constr)
+                # Look again at the unsolved constraints that the newly-solved variables appear in
+                for var in set(undefVars):
+                    for other in constrsOfVar.get(var.getName(), ()):
+                        if other in unsolved and other not in queued:
+                            queue.append(other)
+                            queued.add(other)
+            if len(unsolved) > 0:
+                tempconstrlist = [constr for constr in tempconstrlist if constr in unsolved]
                 print("No more constraints to solve one-var-at-a-time. " + str(len(tempconstrlist)) + " remaining constraints:")
                 for txt in [constr.getName() + ": " + constr.getTextFormula() for constr in tempconstrlist]:
                     print(txt)
@@ -148,64 +392,237 @@ class Problem:
                 print(str(len(allUndefVars)) + " remaining undefined variables:", [var.getName() for var in allUndefVars])
                 if numConstrs >= len(allUndefVars):
                     print("Number of remaining constraints >= number of undefined variables => try solving numerically!")
-                    result = self.numSolve(tempconstrlist, context, allUndefVars, refContext)
-                    if not(result):
-                        print("Error solving remaining constraints numerically - giving up.")
-                        return False
-                    print("Solved " + str([constr.getName() for constr in tempconstrlist]) + " numerically to give " + str([var.getName() + "=" + str(context.getValue(var)) for var in allUndefVars]))
-                    tempconstrlist.clear()
+                    return self.solveBlock(tempconstrlist, context, allUndefVars, refContext, state)
                 else:
-                    print("Number of remaining constraints <= number of undefined variables => giving up.")
-                    # TODO We may still be able to solve a subset of the equations...
-                    return False
-        self.sequenced = True
-        return True
+                    print("Number of remaining constraints < number of undefined variables => solving what can be determined")
+                    return self.solveDeterminedPart(tempconstrlist, context, refContext, state)
+        return STATUS_SOLVED
+
+    def solveBlock(self, constrs, context, undefVars, refContext, state):
+        # Solve a block of constraints numerically, together, after checking it can be - returning the status it ended in
+        startTime = time.perf_counter()
+        state.diagnosis = self.diagnoseBlock(constrs, context, undefVars, refContext)
+        if state.diagnosis is not None:
+            print("Error! Can't solve " + str([constr.getName() for constr in constrs]) + " numerically: " + state.diagnosis)
+            state.addBlock(BLOCK_NUMERIC, constrs, undefVars, False, None, startTime)
+            return STATUS_FAILED
+        method = self.numSolve(constrs, context, undefVars, refContext, state.tracker)
+        state.addBlock(BLOCK_NUMERIC, constrs, undefVars, method, method, startTime)
+        if not method:
+            print("Error solving " + str([constr.getName() for constr in constrs]) + " numerically - giving up.")
+            return STATUS_FAILED
+        print("Solved " + str([constr.getName() for constr in constrs]) + " numerically to give " + str([var.getName() + "=" + str(context.getValue(var)) for var in undefVars]))
+        return STATUS_SOLVED
+
+    def solveDeterminedPart(self, constrs, context, refContext, state):
+        """
+        Solve as much of an under-constrained set of constraints as can be determined, leaving the rest undefined
+        Structural analysis (see dofanalyzer.py) splits off the constraints that link only free variables; the rest
+        are solved numerically together, and the free variables are recorded in state.freeVars
+
+        :return: STATUS_PARTIAL if the determined part was solved, else STATUS_FAILED
+        """
+        from dofanalyzer import DOFAnalyzer
+        inputs = [name for (name, value) in context.varVals.items() if value is not None]
+        analyzer = DOFAnalyzer(self, inputs, constrs)
+        free = analyzer.getFreeVars()
+        underconstrained = analyzer.getUnderconstrained(free)
+        determined = [constr for (index, constr) in enumerate(analyzer.constrs) if index not in underconstrained]
+        if determined:
+            undefVars = set([var for constr in determined for var in constr.getUndefinedExprs(context)])
+            print("Solving the determined part numerically: " + str([constr.getName() for constr in determined]))
+            if self.solveBlock(determined, context, undefVars, refContext, state) != STATUS_SOLVED:
+                return STATUS_FAILED
+        state.freeVars = sorted(free, key=lambda s: s.lower())
+        print("Partially solved - these variables are still free (need more inputs):", state.freeVars)
+        return STATUS_PARTIAL
+
+    def diagnoseBlock(self, constrs, context, undefVars, refContext=False):
+        """
+        Find out whether a block of constraints can't be solved numerically for its undefined variables, so that hopeless
+        blocks are rejected straight away, rather than after the root-finder has used up all its iterations
+        Structurally (see dofanalyzer.py), every variable must be determined by exactly one of the constraints;
+        numerically, their Jacobian must have full rank at the starting point (or, failing that, at a random point nearby)
+
+        :return: None if the block looks solvable, else a description of what's wrong with it
+        """
+        from dofanalyzer import DOFAnalyzer
+        names = set(var.getName() for var in undefVars)
+        inputs = [name for (name, value) in context.varVals.items() if value is not None]
+        analyzer = DOFAnalyzer(self, inputs, constrs)
+        free = sorted(analyzer.getFreeVars() & names, key=lambda s: s.lower())
+        if free:
+            return "structurally singular - nothing determines " + ", ".join(free)
+        over = analyzer.getOverconstrained()
+        if over:
+            return "overdetermined - " + str(analyzer.getExcessConstraints()) + " constraint(s) too many among " + \
+                   ", ".join(analyzer.constrs[index].getName() for index in sorted(over))
+        if context.getArraySize() is None and len(names) <= MAX_RANK_CHECK_SIZE:
+            return self.diagnoseRank(constrs, context, list(undefVars), refContext)
+        return None
+
+    def diagnoseRank(self, constrs, context, masterVarList, refContext=False):
+        # Check the constraints' Jacobian with respect to the variables has full rank, returning a description if not
+        import numpy as np
+        from tape import Tape, TapeError
+        try:
+            tape = Tape(constrs)
+            slots = [tape.slotIndex[var.getName()] for var in masterVarList]
+        except (TapeError, KeyError):
+            return None
+        values = tape.getValues(context)
+        values[slots] = self.getStartValues(masterVarList, refContext)
+        rng = np.random.default_rng(0)
+        for attempt in range(2):
+            jacobian = tape.reverseJacobian(values)[1][:, slots].toarray()
+            if np.all(np.isfinite(jacobian)):
+                (u, s, vt) = np.linalg.svd(jacobian)
+                rank = int(np.sum(s > s.max(initial=0.0) * max(jacobian.shape) * np.finfo(float).eps))
+                if rank == len(slots):
+                    return None
+            else:
+                rank = None
+            # Singular here might just be bad luck with the starting point, so try somewhere else before giving up
+            values[slots] += rng.uniform(-1.0, 1.0, len(slots)) * np.maximum(1.0, np.abs(values[slots]))
+        if rank is None:
+            # Couldn't tell - leave it to the root-finder
+            return None
+        dependent = [constr.getName() for (constr, weight) in zip(constrs, u[:, rank]) if abs(weight) > 1e-8]
+        return "numerically singular (rank " + str(rank) + " of " + str(len(slots)) + ") - these constraints depend on each other: " + ", ".join(dependent)
+
+    def getStartValues(self, masterVarList, refContext=False):
+        # Starting values for numerically solving for some variables: from the reference context if there is one, else 0
+        import numpy as np
+        if refContext:
+            return np.array([refContext.getValue(var) for var in masterVarList], dtype=float)
+        return np.zeros(len(masterVarList))
 
-    def numSolve(self, constrs, context, undefVars, refContext = False):
+    def numSolve(self, constrs, context, undefVars, refContext = False, tracker=None):
+        import numpy as np
         #print("++++++++++++++++++++++++")
-        # Solve one or more constraints by numerical optimisation
-        # The first thing is to construct f(x) from each constraint, which will be LHS - RHS
-        f_exprs = [DifferenceExpression(constr.lhs, constr.rhs) for constr in constrs]
-        print("  Formula(e) whose roots are to be found:")
-        [print("  " + f_expr.getTextFormula()) for f_expr in f_exprs]
+        # Solve one or more constraints by numerical optimisation, returning the method that solved them (None if none did)
+        # The function whose roots are to be found is each constraint's residual, i.e. LHS - RHS
+        print("  Constraint(s) to be solved:")
+        [print("  " + constr.getTextFormula()) for constr in constrs]
         #print("Using SciPy leastsq.")
         # First we need to define a vector of the free variables
         # To do this, make a list of all the undefined variables, which will be the "master" list defining the variable order
         masterVarList = list(undefVars)
+        arraySize = context.getArraySize()
+        if arraySize is not None:
+            # The context holds a whole array of instances (see objects.NIObjectArray and montecarlo.py)
+            # Solve them all at once by batched Newton iteration where possible, then fall back to solving each instance
+            # it couldn't in turn
+            # Instances that can't be solved at all are left as NaN (and the block fails), so the caller can tell which
+            # they were (see montecarlo.py)
+            (results, converged) = self.findBatchRoots(constrs, context, masterVarList, refContext, arraySize, tracker)
+            method = METHOD_BATCH_NEWTON
+            failed = 0
+            for i in np.flatnonzero(~converged):
+                instanceContext = context.getInstance(i)
+                instanceRefContext = refContext.getInstance(i) if refContext else False
+                instanceMethod = self.findRoots(constrs, instanceContext, masterVarList, instanceRefContext, VERBOSE, tracker)
+                if instanceMethod:
+                    method = instanceMethod
+                    results[:, i] = [instanceContext.getValue(var) for var in masterVarList]
+                else:
+                    print("Error solving instance", i, "numerically")
+                    results[:, i] = np.nan
+                    failed += 1
+            [context.setValue(var, values) for (var, values) in zip(masterVarList, results)]
+            if failed:
+                print("  Couldn't solve", failed, "of", arraySize, "instances numerically")
+                return None
+            print("  Solved", arraySize, "instances numerically (" + str(int(converged.sum())), "all at once)")
+            return method
+        return self.findRoots(constrs, context, masterVarList, refContext, tracker=tracker)
+
+    def findBatchRoots(self, constrs, context, masterVarList, refContext, arraySize, tracker=None):
+        # Solve every instance of an array context at once, as far as possible (see sparsenewton.solveBatch)
+        # Returns (array of the variables' values, with a column per instance, boolean array of which instances converged)
+        import numpy as np
+        from tape import Tape, TapeError
+        try:
+            tape = Tape(constrs)
+            slots = [tape.slotIndex[var.getName()] for var in masterVarList]
+        except (TapeError, KeyError):
+            tape = None
+        if tape is None or tape.numConstrs != len(slots):
+            return (np.full((len(masterVarList), arraySize), np.nan), np.zeros(arraySize, dtype=bool))
+        import sparsenewton
+        x0 = np.zeros((len(masterVarList), arraySize))
+        if refContext:
+            for (row, var) in enumerate(masterVarList):
+                value = refContext.getValue(var)
+                x0[row] = np.nan if value is None else value
+
+        def shouldStop():
+            if tracker is not None:
+                tracker.charge(evaluations=1, iterations=1)
+            return False
+
+        if tracker is not None:
+            tracker.startBlock()
+        return sparsenewton.solveBatch(tape, tape.getValues(context, arraySize), slots, x0, shouldStop=shouldStop)
+
+    def findRoots(self, constrs, context, masterVarList, refContext=False, verbose=True, tracker=None):
+        # Find values of the variables in masterVarList that make every constraint's residual zero, and record them in context
+        # Returns the method that found them (see portfolio.py), or None if none did
+        # (tracker, if given, is charged for every residual evaluation and iteration - see budgets.py)
+        import numpy as np
+        import scipy.optimize
+        from tape import Tape, TapeError
         # Now we need a function that will return values (to be set to 0) when fed a vector of variable values
-        # To start with, make a function that takes such a vector and makes it into a dictionary, linking each value with its corresponding variable
-        dictgen = lambda x: {(entry[0], entry[1]) for entry in zip(masterVarList, x)}
-        # Now make a lambda expression that is actually the objective function evaluation when given a vector of var values
-        f = lambda x: [f_expr.getValue(context.extendWithValues(dictgen(x))) for f_expr in f_exprs]
+        # Where possible, compile the constraints into a tape (see tape.py), which evaluates them much more quickly than
+        # walking their expression trees, and gives the Jacobian in a single batched pass
+        try:
+            tape = Tape(constrs)
+            slots = [tape.slotIndex[var.getName()] for var in masterVarList]
+        except (TapeError, KeyError):
+            tape = None
+        if tape is None:
+            # To start with, make a function that takes such a vector and makes it into a dictionary, linking each value with its corresponding variable
+            dictgen = lambda x: {(entry[0], entry[1]) for entry in zip(masterVarList, x)}
+            # Now make a lambda expression that is actually the objective function evaluation when given a vector of var values
+            def f(x):
+                if tracker is not None:
+                    tracker.charge(evaluations=1)
+                return [constr.getResidual(context.extendWithValues(dictgen(x))) for constr in constrs]
         # Now the call to leastsq...
         # The problem is, we need to supply a set of starting values for the iteration
         # And if the values we supply happen to be singular values of the equation, we'll be stuck! Oh dear.
         # result = scipy.optimize.leastsq(f, np.zeros(len(masterVarList)))
         # As a workaround, pass in starting values which can come from e.g. the previous solution
-        if refContext:
-            undefVarRefVals = np.array([refContext.getValue(var) for var in masterVarList])
-        else:
-            undefVarRefVals = np.zeros(len(masterVarList))
-        print("  Initial guess for var vals: ", list(zip([v.getName() for v in masterVarList], undefVarRefVals)))
+        undefVarRefVals = self.getStartValues(masterVarList, refContext)
+        if verbose: print("  Initial guess for var vals: ", list(zip([v.getName() for v in masterVarList], undefVarRefVals)))
         ######################################
         # The call to the optimiser!
         if VERBOSE: print("Optimising...")
-        result = scipy.optimize.root(f, undefVarRefVals)
+        if tracker is not None:
+            tracker.startBlock()
+        if tape is not None:
+            # Use whichever method suits the block (see portfolio.py)
+            key = (tuple(sorted(constr.getName() for constr in constrs)), tuple(sorted(var.getName() for var in masterVarList)))
+            (resultX, success, method) = self.getPortfolio().solve(key, tape, tape.getValues(context), slots, undefVarRefVals, VERBOSE, tracker)
+            if verbose and success: print("  Solved by method:", method)
+        else:
+            result = scipy.optimize.root(f, undefVarRefVals)
+            (resultX, success, method) = (result.x, result.success, "hybr")
+            if VERBOSE:
+                print("All results from root-finding:", result)
         #######################################
-        if VERBOSE:
-            print("All results from root-finding:", result)
-        print("  Numerical result:", str(result.x))
+        if verbose: print("  Numerical result:", str(resultX))
         #print("+++++++++++++++++++++++++")
-        if any([np.isnan(x) for x in result.x]):
+        if any([np.isnan(x) for x in resultX]):
             print("Error! Some of the results from numerical solving were NaN - check and resolve (perhaps from a different starting point)")
-            return False
-        elif not result.success:
+            return None
+        elif not success:
             print("An unknown error occurred in root-finding...")
-            return False
+            return None
         else:
             # Record the returned values
-            [context.setValue(e[0], e[1]) for e in zip(masterVarList, result.x)]
-            return True
+            [context.setValue(e[0], e[1]) for e in zip(masterVarList, resultX)]
+            return method
 
     def __repr__(self):
         return "<Problem: variables " + repr(self.exprs) + ", constraints " + repr(self.constrs) + ">"
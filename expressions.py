@@ -1,32 +1,67 @@
 from abc import abstractmethod
 from abc import ABCMeta
 from functools import total_ordering
-import math
+import itertools
 
-from NIbase import addDescVarOrRecurse
+from NIbase import addDescVarOrRecurse, allTrue, applyFunction
 
 __author__ = 'David'
 
+# Integer ids for expressions, used for hashing and equality instead of comparing names
+# Named (non-composite) expressions with the same name share an id, so are equal, as before; every composite expression
+# has its own id, so is only equal to itself
+_nodeIds = itertools.count()
+_nameIds = {}
+
+def internName(name):
+    nodeId = _nameIds.get(name)
+    if nodeId is None:
+        nodeId = _nameIds.setdefault(name, next(_nodeIds))
+    return nodeId
+
 @total_ordering
 class Expression(metaclass=ABCMeta):
-    def __init__(self, name, childexprs=[]):
-        self.name = name
-        self.childExprs = childexprs
+    # N.B. Expressions are kept compact (no per-instance dict) as large problems have very many of them
+    # Subclasses must declare __slots__ too
+    __slots__ = ("_id",)
 
     def getName(self):
         return self.name
 
+    def getId(self):
+        # Assigned on first use rather than on construction (and not pickled, as ids are only meaningful within a process)
+        try:
+            return self._id
+        except AttributeError:
+            self._id = self.makeId()
+            return self._id
+
+    def makeId(self):
+        return internName(self.getName())
+
     def __eq__(self, other):
-        return self.getName() == other.getName()
+        return isinstance(other, Expression) and self.getId() == other.getId()
 
     def __lt__(self, other):
         return self.getName() < other.getName()
 
     def __hash__(self):
-        return hash(self.getName())
+        return self.getId()
+
+    def __getstate__(self):
+        state = {}
+        for cls in type(self).__mro__:
+            for slot in cls.__dict__.get("__slots__", ()):
+                if slot != "_id" and hasattr(self, slot):
+                    state[slot] = getattr(self, slot)
+        return state
+
+    def __setstate__(self, state):
+        for (slot, value) in state.items():
+            setattr(self, slot, value)
 
     def getChildren(self):
-        return self.childExprs
+        return []
 
     @abstractmethod
     def __repr__(self):
@@ -49,8 +84,10 @@ class Expression(metaclass=ABCMeta):
         pass
 
 class Variable(Expression):
+    __slots__ = ("name", "value")
+
     def __init__(self, name, value):
-        super(Variable, self).__init__(name)
+        self.name = name
         self.value = value
 
     def getValue(self, context):
@@ -64,6 +101,8 @@ class Variable(Expression):
 
 # A standard scalar variable
 class ScalarVariable(Variable):
+    __slots__ = ()
+
     def __init__(self, name, value=None):
         super(ScalarVariable, self).__init__(name, value)
 
@@ -81,13 +120,15 @@ class ScalarVariable(Variable):
         context.setValue(self, value)
 
     def getUndefinedExprs(self, context):
-        return [] if self.getValue(context) else [self]
+        return [] if self.getValue(context) is not None else [self]
 
     def copy(self):
         return ScalarVariable(name=self.name, value=self.value)
 
 # A constant - something with a name and a fixed numerical value that cannot change
 class Constant(Variable):
+    __slots__ = ()
+
     def __repr__(self):
         return "<Constant: name " + self.name + ", value " + str(self.value) + ">"
 
@@ -96,8 +137,14 @@ class Constant(Variable):
         pass
         # TODO Throw an error at this point?
 
+    def copy(self):
+        # Constants never change, so can be shared
+        return self
+
 # A slight shortcut for when you really need a hard-coded value!
 class FixedValue(Variable):
+    __slots__ = ()
+
     def __init__(self, value):
         super(FixedValue, self).__init__(str(value), value)
 
@@ -109,12 +156,33 @@ class FixedValue(Variable):
         pass
         # TODO Throw an error at this point?
 
+    def copy(self):
+        return self
+
 ###################################################################################
 # Composite expressions
 
 class CompositeExpression(Expression):
-    def __init__(self, name, childexprs=[]):
-        super(CompositeExpression, self).__init__(name, childexprs)
+    # The name of a composite expression is its text formula, only worked out when it's first needed (e.g. for display)
+    __slots__ = ("_name",)
+
+    @property
+    def name(self):
+        try:
+            return self._name
+        except AttributeError:
+            self._name = self.getTextFormula()
+            return self._name
+
+    def makeId(self):
+        return next(_nodeIds)
+
+    def forgetName(self):
+        # Called when an argument is replaced, as the text formula will have changed
+        try:
+            del self._name
+        except AttributeError:
+            pass
 
     def isComposite(self):
         return True
@@ -128,15 +196,24 @@ class CompositeExpression(Expression):
 ###################################################################################
 # Unary (1 argument)
 class UnaryExpression(CompositeExpression):
+    __slots__ = ("arg",)
+
     def __init__(self, arg):
-        self.setArg(arg)
-        super(UnaryExpression, self).__init__(self.getTextFormula(), [self.arg])
+        self.arg = arg
 
     def getTextFormula(self):
         return self.operatorTxt + "(" + self.arg.name + ")"
 
     def setArg(self, expr):
         self.arg = expr
+        self.forgetName()
+
+    def getChildren(self):
+        return [self.arg]
+
+    def copy(self):
+        # Copy the whole tree, so that its variables can be replaced (see objects.NIObject)
+        return type(self)(self.arg.copy())
 
     def getDescendantVarsAndSetters(self):
         """
@@ -149,84 +226,80 @@ class UnaryExpression(CompositeExpression):
         return returnVal
 
 class SinExpression(UnaryExpression):
-    def __init__(self, arg):
-        self.operatorTxt = "sin"
-        super(SinExpression, self).__init__(arg)
+    __slots__ = ()
+    operatorTxt = "sin"
 
     def __repr__(self):
         return "<SinExpression: arg " + repr(self.arg) + ">"
 
     def getValue(self, context):
         if self.arg.getValue(context) is not None:
-            print("Getting value for sine expression: " + str(math.sin(self.arg.getValue(context))))
-            return math.sin(self.arg.getValue(context))
+            return applyFunction("sin", self.arg.getValue(context))
         else:
             return None
 
     def setValue(self, value, context):
-        if self.arg.getValue(context):
-            if value == math.sin(self.arg.getValue(context)):
+        if self.arg.getValue(context) is not None:
+            if allTrue(value == applyFunction("sin", self.arg.getValue(context))):
                 pass # but overconstrained
             else:
                 print("Error! " + self.name + " is overconstrained")
         else:
             # Check for domain error
-            if -1 <= value <= 1:
-                self.arg.setValue(math.asin(value), context)
+            if allTrue((-1 <= value) & (value <= 1)):
+                self.arg.setValue(applyFunction("asin", value), context)
             else:
                 print("Error! " + self.name + " set to value outside function domain (" + str(value) + ")")
 
 class CosExpression(UnaryExpression):
-    def __init__(self, arg):
-        self.operatorTxt = "cos"
-        super(CosExpression, self).__init__(arg)
+    __slots__ = ()
+    operatorTxt = "cos"
 
     def __repr__(self):
         return "<CosExpression: arg " + repr(self.arg) + ">"
 
     def getValue(self, context):
         if self.arg.getValue(context) is not None:
-            return math.cos(self.arg.getValue(context))
+            return applyFunction("cos", self.arg.getValue(context))
         else:
             return None
 
     def setValue(self, value, context):
-        if self.arg.getValue(context):
-            if value == math.cos(self.arg.getValue(context)):
+        if self.arg.getValue(context) is not None:
+            if allTrue(value == applyFunction("cos", self.arg.getValue(context))):
                 pass # but overconstrained
             else:
                 print("Error! " + self.name + " is overconstrained")
         else:
             # Check for domain error
-            if -1 <= value <= 1:
-                self.arg.setValue(math.acos(value), context)
+            if allTrue((-1 <= value) & (value <= 1)):
+                self.arg.setValue(applyFunction("acos", value), context)
             else:
                 print("Error! " + self.name + " set to value outside function domain (" + str(value) + ")")
 
 class TanExpression(UnaryExpression):
-    def __init__(self, arg):
-        self.operatorTxt = "tan"
-        super(TanExpression, self).__init__(arg)
+    __slots__ = ()
+    operatorTxt = "tan"
 
     def __repr__(self):
         return "<TanExpression: arg " + repr(self.arg) + ">"
 
     def getValue(self, context):
         if self.arg.getValue(context) is not None:
-            return math.tan(self.arg.getValue(context))
+            return applyFunction("tan", self.arg.getValue(context))
         else:
             return None
 
     def setValue(self, value, context):
-        if self.arg.getValue(context):
-            if value == math.tan(self.arg.getValue(context)):
+        if self.arg.getValue(context) is not None:
+            if allTrue(value == applyFunction("tan", self.arg.getValue(context))):
                 pass # but overconstrained
             else:
                 print("Error! " + self.name + " is overconstrained")
         else:
             # Check for domain error
             #if -1 <= value <= 1:
-                self.arg.setValue(math.atan(value), context)
+                self.arg.setValue(applyFunction("atan", value), context)
             #else:
             #    print("Error! " + self.name + " set to value outside function domain (" + str(value) + ")")
 
@@ -234,16 +307,26 @@ class TanExpression(UnaryExpression):
 ####################################################################################
 # Binary (2 arguments)
 class BinaryExpression(CompositeExpression):
+    __slots__ = ("argA", "argB")
+
     def __init__(self, argA, argB):
-        self.setArgA(argA)
-        self.setArgB(argB)
-        super(BinaryExpression, self).__init__(self.getTextFormula(), [self.argA, self.argB])
+        self.argA = argA
+        self.argB = argB
 
     def setArgA(self, expr):
         self.argA = expr
+        self.forgetName()
 
     def setArgB(self, expr):
         self.argB = expr
+        self.forgetName()
+
+    def getChildren(self):
+        return [self.argA, self.argB]
+
+    def copy(self):
+        # Copy the whole tree, so that its variables can be replaced (see objects.NIObject)
+        return type(self)(self.argA.copy(), self.argB.copy())
 
     def getTextFormula(self):
         return "(" + self.argA.name + " " + self.operatorSymbol + " " + self.argB.name + ")"
@@ -260,9 +343,8 @@ class BinaryExpression(CompositeExpression):
         return returnVal
 
 class SumExpression(BinaryExpression):
-    def __init__(self, addandA, addandB):
-        self.operatorSymbol = '+'
-        super(SumExpression, self).__init__(addandA, addandB)
+    __slots__ = ()
+    operatorSymbol = '+'
 
     def __repr__(self):
         return "<SumExpression: addand A " + repr(self.argA) + ", addand B " + repr(self.argB) + ">"
@@ -276,24 +358,23 @@ class SumExpression(BinaryExpression):
     def setValue(self, value, context):
         a = self.argA.getValue(context)
         b = self.argB.getValue(context)
-        if a:
-            if b: # a,b
-                if value==a+b:
+        if a is not None:
+            if b is not None: # a,b
+                if allTrue(value == a+b):
                     pass # but overconstrained
                 else:
                     print("Error! " + self.name + " is overconstrained")
             else: # a => b
                 self.argB.setValue(value-a, context)
         else:
-            if b: #b => a
+            if b is not None: #b => a
                 self.argA.setValue(value-b, context)
             else: # neither => can't do anything
                 pass
 
 class DifferenceExpression(BinaryExpression):
-    def __init__(self, addand, subtractand):
-        self.operatorSymbol = '-'
-        super(DifferenceExpression, self).__init__(addand, subtractand)
+    __slots__ = ()
+    operatorSymbol = '-'
 
     def __repr__(self):
         return "<DifferenceExpression: addand " + repr(self.argA) + ", subtractand " + repr(self.argB) + ">"
@@ -307,24 +388,23 @@ class DifferenceExpression(BinaryExpression):
     def setValue(self, value, context):
         a = self.argA.getValue(context)
         b = self.argB.getValue(context)
-        if a:
-            if b: # a,b
-                if value==a-b:
+        if a is not None:
+            if b is not None: # a,b
+                if allTrue(value == a-b):
                     pass # but overconstrained
                 else:
                     print("Error! " + self.name + " is overconstrained")
             else: # a => b
                 self.argB.setValue(a-value, context)
         else:
-            if b: #b => a
+            if b is not None: #b => a
                 self.argA.setValue(value+b, context)
             else: # neither => can't do anything
                 pass
 
 class ProductExpression(BinaryExpression):
-    def __init__(self, multiplicanda, multiplicandb):
-        self.operatorSymbol = '*'
-        super(ProductExpression, self).__init__(multiplicanda, multiplicandb)
+    __slots__ = ()
+    operatorSymbol = '*'
 
     def __repr__(self):
         return "<ProductExpression: multiplicand A " + repr(self.argA) + ", multiplicand B " + repr(self.argB) + ">"
@@ -338,24 +418,23 @@ class ProductExpression(BinaryExpression):
     def setValue(self, value, context):
         a = self.argA.getValue(context)
         b = self.argB.getValue(context)
-        if a:
-            if b: # a,b
-                if value==a*b:
+        if a is not None:
+            if b is not None: # a,b
+                if allTrue(value == a*b):
                     pass # but overconstrained
                 else:
                     print("Error! " + self.name + " is overconstrained")
             else: # a => b
                 self.argB.setValue(value/a, context)
         else:
-            if b: #b => a
+            if b is not None: #b => a
                 self.argA.setValue(value/b, context)
             else: # neither => can't do anything
                 pass
 
 class QuotientExpression(BinaryExpression):
-    def __init__(self, numerator, denominator):
-        self.operatorSymbol = '/'
-        super(QuotientExpression, self).__init__(numerator, denominator)
+    __slots__ = ()
+    operatorSymbol = '/'
 
     def __repr__(self):
         return "<QuotientExpression: numerator " + repr(self.argA) + ", denominator " + repr(self.argB) + ">"
@@ -369,24 +448,23 @@ class QuotientExpression(BinaryExpression):
     def setValue(self, value, context):
         n = self.argA.getValue(context)
         d = self.argB.getValue(context)
-        if n:
-            if d: # a,b
-                if value==n/d:
+        if n is not None:
+            if d is not None: # a,b
+                if allTrue(value == n/d):
                     pass # but overconstrained
                 else:
                     print("Error! " + self.name + " is overconstrained")
             else: # n => d
                 self.argB.setValue(n/value, context)
         else:
-            if d: #d => n
+            if d is not None: #d => n
                 self.argA.setValue(value*d, context)
             else: # neither => can't do anything
                 pass
 
 class PowerExpression(BinaryExpression):
-    def __init__(self, base, exponent):
-        self.operatorSymbol = '^'
-        super(PowerExpression, self).__init__(base, exponent)
+    __slots__ = ()
+    operatorSymbol = '^'
 
     def __repr__(self):
         return "<PowerExpression: base " + repr(self.argA) + ", exponent " + repr(self.argB) + ">"
@@ -400,16 +478,16 @@ class PowerExpression(BinaryExpression):
     def setValue(self, value, context):
         base = self.argA.getValue(context)
         exp = self.argB.getValue(context)
-        if base:
-            if exp: # a,b
-                if value==base**exp:
+        if base is not None:
+            if exp is not None: # a,b
+                if allTrue(value == base**exp):
                     pass # but overconstrained
                 else:
                     print("Error! " + self.name + " is overconstrained")
             else: # base => exp
-                self.argB.setValue(math.ln(value)/math.ln(base), context)
+                self.argB.setValue(applyFunction("log", value)/applyFunction("log", base), context)
         else:
-            if exp: #exp => base
+            if exp is not None: #exp => base
                 self.argA.setValue(value**(1/exp), context) # TODO allow multiple solutions...
             else: # neither => can't do anything
                 pass
@@ -0,0 +1,129 @@
+# The original pyparsing-based grammar for .prob files
+# No longer used for loading problems (see probparser), but kept as a reference point for benchmarks/bench_parser.py
+# N.B. Unlike probparser, this grammar has no operator precedence: binary operators group to the right, so a*b+c = a*(b+c)
+
+from expressions import FixedValue, Constant
+from probparser import constantMap, binaryOperatorMap, unaryOperatorMap
+
+# The master line parser, which is only built (along with the rest of the grammar) the first time a file is parsed
+# Importing pyparsing and building the grammar is a noticeable part of start-up time, so don't pay for it unless we need it
+_lineParser = None
+
+def getLineParser():
+    global _lineParser
+    if _lineParser is None:
+        _lineParser = buildLineParser()
+    return _lineParser
+
+def buildLineParser():
+    from pyparsing import Word, alphas, nums, Literal, CaselessLiteral, Optional, Combine, ZeroOrMore, Group, Forward, \
+        restOfLine, CaselessKeyword, Or, QuotedString, Keyword, alphanums
+
+    # Parser definition
+    # From http://eikke.com/pyparsing-introduction-bnf-to-code/6/index.html
+    # And pyparsing's fourfn
+
+    # Various elementary token definitions
+    point = Literal(".")
+    e = CaselessLiteral("E")
+    lPar = Literal('(').suppress()
+    rPar = Literal(')').suppress()
+    quot = Literal('\"').suppress()
+    equals = Literal('=').suppress()
+    assign = Literal(':=').suppress()
+    constassign = Literal('==').suppress()
+    signedDigitString = Word("+-" + nums, nums)
+    fNumber = Combine(signedDigitString + Optional(point + Optional(Word(nums))) + Optional(e + signedDigitString))
+    varName = Word( alphas+"_", alphanums+"_" )
+    equationName = QuotedString(quoteChar="\"")
+    # What word to use to include another file's contents?
+    # http://en.wikipedia.org/wiki/Comparison_of_programming_languages_%28syntax%29#Libraries
+    # Python: import
+    # OpenSCAD: include (also use, but that's slightly different)
+    # C etc: #include
+    # LaTeX: \input, \include
+    # Java: import
+    # Modelica: import
+    # OK, let's go for import then...
+    importkeyword = Keyword("import").suppress()
+
+    # Constants
+    constant = Or([CaselessKeyword(constantName) for constantName in constantMap])
+    constant.setParseAction(lambda s, l, t: [constantMap[t[0]]])
+
+    # Parse numbers into floats straight away
+    fNumber.setParseAction(lambda s, l, t: [float(t[0])])
+
+    # Binary operators
+    binaryOperator = Word('+-*/^', exact=1) # N.B. To-the-power-of is ^ in this grammar at the moment - TODO make it accept Python syntax **
+    # Now make binary operators get turned into classes straight away
+    binaryOperator.setParseAction(lambda s, l, t: [binaryOperatorMap[t[0]]])
+
+    # Likewise for unary operators
+    unaryOperator = Or([CaselessKeyword(funcname) for funcname in unaryOperatorMap])
+    unaryOperator.setParseAction(lambda s, l, t: [unaryOperatorMap[t[0]]])
+
+    # Comments
+    comment = '#' + restOfLine
+
+    # Now, main structure of expression-parser
+    expr = Forward()
+    # atom is a number, variable, parenthesised expression or unary operator
+    atom = constant | fNumber | Group(lPar + expr + rPar) | Group(unaryOperator + lPar + Group(expr) + rPar) | varName
+    # Expr is an atom plus a succession of binary operators and expressions
+    expr << atom + ZeroOrMore(binaryOperator + Group(expr))
+    # Constraint is two expressions separated by an equals, possibly with an equation name at the end
+    constraint = Group(expr) + equals + Group(expr) + Optional(equationName)
+    # Variable initialisation is a variable name with ":=" and an expression
+    varinit = varName + assign + Group(expr)
+    # Constant definition is like varinit but with a "=="
+    constantdef = varName + constassign + Group(expr)
+    # Import command is import(filename) TODO
+    importfilename = QuotedString(quoteChar="\"")
+    importcommand = importkeyword + lPar + importfilename + rPar
+
+    # Master line parser - optional to allow for blank lines
+    lineParser = Optional(constraint("constraint") | varinit("varinit") | constantdef("constdef") | importcommand("importcommand"))
+    lineParser.ignore(comment)
+    return lineParser
+
+
+def parseExpr(exprS, findVar):
+    from pyparsing import ParseResults
+    #print("Parsing", exprS)
+    # Roots of recursion:
+    # If it's a number, return a FixedValue
+    if isinstance(exprS, float):
+        return FixedValue(exprS)
+    # If it's a constant, just return that
+    elif isinstance(exprS, Constant):
+        return exprS
+    # If it's a string, return a variable of that name
+    elif isinstance(exprS, str):
+        # Attempt to obtain the corresponding variable if it exists already
+        # Probably too clunky a way to do it...
+        #print("Need to find/make ScalarVariable for: " + exprS)
+        return findVar(exprS)
+    elif isinstance(exprS, ParseResults):
+        # It's another chunk of parsing!
+        # Now it depends on the length
+        # Hopefully the length of this will be either 1 or 3
+        # If it's 1 it's a variable or number
+        # So just recurse
+        if len(exprS) == 1:
+            return parseExpr(exprS[0], findVar)
+        # If it's 2 it's a unary expression
+        elif len(exprS) == 2:
+            op = parseExpr(exprS[1], findVar)
+            return exprS[0](op)
+        # If it's 3 it's a binary expression
+        elif len(exprS) == 3:
+            op1 = parseExpr(exprS[0], findVar)
+            op2 = parseExpr(exprS[2], findVar)
+            return exprS[1](op1, op2)
+        else:
+            # Should never get here!
+            print("Error parsing multi-part expression:", exprS)
+    else:
+        # Or here!
+        print("Error parsing expression:", exprS)
@@ -0,0 +1,436 @@
+# Monte Carlo uncertainty propagation: distributions of outputs from distributions of inputs
+# Input variables are given distributions (in a .prob file with e.g. `x ~ normal(10, 0.5)`, or through the API), and
+# samples of them are pushed through the solver a batch at a time: each batch is one solve of an array context, with
+# one element per sample, so analytic steps work on whole arrays and numerical blocks are solved for every sample at
+# once by batched Newton iteration (see sparsenewton.solveBatch). Only running statistics and quantile sketches of the
+# outputs are kept, so memory doesn't grow with the number of samples (unless the samples themselves are asked for).
+# Samples come from inverting each distribution's cumulative distribution function at uniform random numbers, which are
+# either plain pseudo-random or Latin hypercube (stratified within each batch). The random numbers for each variable
+# only depend on the seed, the variable's name and the batch, so they're common random numbers: two runs with the same
+# seed (e.g. of two versions of a design) sample each input identically, even if they have different inputs otherwise.
+
+from abc import ABCMeta, abstractmethod
+import os
+import re
+import zlib
+
+import numpy as np
+import scipy.special
+
+from equationsolver import STATUS_SOLVED, STATUS_BUDGET_EXCEEDED, STATUS_CANCELLED, BLOCK_NUMERIC
+
+SAMPLING_RANDOM = "random"
+SAMPLING_LHS = "lhs"
+SAMPLINGS = [SAMPLING_RANDOM, SAMPLING_LHS]
+DEFAULT_BATCH_SIZE = 10000
+# Number of centroids a quantile sketch keeps (roughly) - more is more accurate
+DEFAULT_COMPRESSION = 200
+
+
+class Distribution(metaclass=ABCMeta):
+    # The distribution of an input variable's values
+    @abstractmethod
+    def ppf(self, u):
+        # The inverse of the cumulative distribution function (percent point function), for an array of probabilities
+        pass
+
+    def median(self):
+        return float(self.ppf(np.array([0.5]))[0])
+
+
+class Normal(Distribution):
+    def __init__(self, mean, sd):
+        if not sd > 0:
+            raise ValueError("a normal distribution's standard deviation must be positive")
+        self.mean = float(mean)
+        self.sd = float(sd)
+
+    def ppf(self, u):
+        return self.mean + self.sd * scipy.special.ndtri(u)
+
+    def __repr__(self):
+        return "<Normal: mean " + str(self.mean) + ", sd " + str(self.sd) + ">"
+
+
+class Uniform(Distribution):
+    def __init__(self, low, high):
+        if not high > low:
+            raise ValueError("a uniform distribution's upper limit must be above its lower limit")
+        self.low = float(low)
+        self.high = float(high)
+
+    def ppf(self, u):
+        return self.low + (self.high - self.low) * u
+
+    def __repr__(self):
+        return "<Uniform: " + str(self.low) + " to " + str(self.high) + ">"
+
+
+class LogNormal(Distribution):
+    # The logarithm of the value is normally distributed, with mean mu and standard deviation sigma
+    def __init__(self, mu, sigma):
+        if not sigma > 0:
+            raise ValueError("a lognormal distribution's sigma must be positive")
+        self.mu = float(mu)
+        self.sigma = float(sigma)
+
+    def ppf(self, u):
+        return np.exp(self.mu + self.sigma * scipy.special.ndtri(u))
+
+    def __repr__(self):
+        return "<LogNormal: mu " + str(self.mu) + ", sigma " + str(self.sigma) + ">"
+
+
+class Empirical(Distribution):
+    # Resampling from a set of observed values, each equally likely
+    def __init__(self, values, source=None):
+        """
+        :param values: the observed values
+        :param source: where they came from (e.g. a filename), for reference
+        """
+        values = np.asarray(values, dtype=float).ravel()
+        self.values = np.sort(values[np.isfinite(values)])
+        if not len(self.values):
+            raise ValueError("an empirical distribution needs at least one value" + (" (none in " + source + ")" if source else ""))
+        self.source = source
+
+    @classmethod
+    def fromFile(cls, filename):
+        # Every number in a text file (e.g. one per line, or a column of a CSV file), skipping anything else, e.g. headers
+        values = []
+        with open(filename, 'r') as file:
+            for token in re.split(r"[\s,;]+", file.read()):
+                try:
+                    values.append(float(token))
+                except ValueError:
+                    pass
+        return cls(values, filename)
+
+    def ppf(self, u):
+        n = len(self.values)
+        return self.values[np.minimum((np.asarray(u) * n).astype(int), n - 1)]
+
+    def __repr__(self):
+        return "<Empirical: " + str(len(self.values)) + " values" + (" from " + self.source if self.source else "") + ">"
+
+
+# The distributions available in .prob files, by name
+DISTRIBUTIONS = {"normal": Normal, "uniform": Uniform, "lognormal": LogNormal, "empirical": Empirical}
+
+
+def makeDistribution(kind, args, directory=""):
+    """
+    Make a distribution from a .prob file line `name ~ kind(args)`
+    :param args: the arguments - numbers, or for an empirical distribution the name of a file of values
+    :param directory: the directory an empirical distribution's filename is relative to
+    :raise ValueError: if the distribution or its arguments aren't valid
+    """
+    if kind not in DISTRIBUTIONS:
+        raise ValueError("unknown distribution " + kind + " (should be one of: " + ", ".join(sorted(DISTRIBUTIONS)) + ")")
+    if kind == "empirical":
+        if len(args) != 1 or not isinstance(args[0], str):
+            raise ValueError("empirical takes the name of a file of values")
+        try:
+            return Empirical.fromFile(os.path.join(directory, args[0]))
+        except OSError as err:
+            raise ValueError("can't read values for empirical distribution: " + str(err))
+    if len(args) != 2 or any(isinstance(arg, str) for arg in args):
+        raise ValueError(kind + " takes two numbers")
+    return DISTRIBUTIONS[kind](*args)
+
+
+def uniformSamples(seed, name, batchIndex, count, sampling=SAMPLING_LHS):
+    # Uniform random numbers in (0, 1) for one variable in one batch - the same for the same seed, name and batch
+    rng = np.random.default_rng([seed, zlib.crc32(name.encode("utf-8")), batchIndex])
+    if sampling == SAMPLING_LHS:
+        # One in each of count equal strata, in random order
+        u = (rng.permutation(count) + rng.random(count)) / count
+    else:
+        u = rng.random(count)
+    # Keep clear of 0 and 1, where e.g. a normal distribution's values are infinite
+    return np.clip(u, np.finfo(float).tiny, np.nextafter(1.0, 0.0))
+
+
+class RunningStats:
+    # Count, mean, variance, minimum and maximum of a stream of values, updated a batch at a time
+    # Batches are combined by Chan et al.'s parallel form of Welford's algorithm, which stays accurate over millions of values
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        # Sum of squared differences from the mean
+        self.m2 = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+
+    def add(self, values):
+        values = np.asarray(values, dtype=float)
+        if len(values):
+            batch = RunningStats()
+            batch.count = len(values)
+            batch.mean = float(values.mean())
+            batch.m2 = float(((values - batch.mean) ** 2).sum())
+            batch.min = float(values.min())
+            batch.max = float(values.max())
+            self.merge(batch)
+
+    def merge(self, other):
+        total = self.count + other.count
+        if total == 0:
+            return
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / total
+        self.m2 += other.m2 + delta ** 2 * self.count * other.count / total
+        self.count = total
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def variance(self):
+        # The sample variance
+        return self.m2 / (self.count - 1) if self.count > 1 else np.nan
+
+    def std(self):
+        return np.sqrt(self.variance())
+
+    def __repr__(self):
+        return "<RunningStats: " + str(self.count) + " values, mean " + str(self.mean) + ", variance " + str(self.variance()) + ">"
+
+
+class QuantileSketch:
+    """
+    Approximate quantiles of a stream of values in bounded memory - a merging t-digest (Dunning and Ertl)
+    The values are summarised as a sorted list of weighted centroids, around `compression` of them, which are smallest
+    towards the tails, so that e.g. the 1st and 99th percentiles are about as accurate as the median
+    """
+    def __init__(self, compression=DEFAULT_COMPRESSION):
+        self.compression = compression
+        self.means = np.empty(0)
+        self.weights = np.empty(0)
+        self.min = np.inf
+        self.max = -np.inf
+
+    def add(self, values):
+        values = np.asarray(values, dtype=float)
+        if len(values):
+            self.min = min(self.min, float(values.min()))
+            self.max = max(self.max, float(values.max()))
+            self.compress(np.concatenate([self.means, values]), np.concatenate([self.weights, np.ones(len(values))]))
+
+    def merge(self, other):
+        if len(other.weights):
+            self.min = min(self.min, other.min)
+            self.max = max(self.max, other.max)
+            self.compress(np.concatenate([self.means, other.means]), np.concatenate([self.weights, other.weights]))
+
+    def compress(self, means, weights):
+        # Merge neighbouring centroids that fall in the same unit interval of the scale function
+        # k(q) = compression * (asin(2q - 1) / pi + 1/2), whose intervals are narrowest near q = 0 and q = 1
+        order = np.argsort(means, kind="stable")
+        (means, weights) = (means[order], weights[order])
+        cumulative = np.cumsum(weights)
+        q = (cumulative - weights / 2.0) / cumulative[-1]
+        groups = np.floor(self.compression * (np.arcsin(2.0 * q - 1.0) / np.pi + 0.5))
+        starts = np.flatnonzero(np.concatenate([[True], groups[1:] != groups[:-1]]))
+        self.weights = np.add.reduceat(weights, starts)
+        self.means = np.add.reduceat(means * weights, starts) / self.weights
+
+    def quantile(self, q):
+        """
+        :param q: probability, or array of them, between 0 and 1
+        :return: the approximate quantile(s), interpolated between the centroids (NaN if there are no values yet)
+        """
+        if not len(self.weights):
+            return np.full(np.shape(q), np.nan) if np.ndim(q) else np.nan
+        cumulative = np.cumsum(self.weights)
+        positions = (cumulative - self.weights / 2.0) / cumulative[-1]
+        return np.interp(q, np.concatenate([[0.0], positions, [1.0]]), np.concatenate([[self.min], self.means, [self.max]]))
+
+    def __len__(self):
+        return len(self.weights)
+
+
+class MonteCarloResult:
+    """
+    Statistics of each output variable over the samples solved so far
+    Samples that couldn't be solved are counted in failures, and left out of the statistics
+    """
+    def __init__(self, outputs, compression=DEFAULT_COMPRESSION, keepSamples=False):
+        self.outputs = list(outputs)
+        self.stats = {name: RunningStats() for name in self.outputs}
+        self.sketches = {name: QuantileSketch(compression) for name in self.outputs}
+        # Number of samples taken, and how many of them couldn't be solved
+        self.count = 0
+        self.failures = 0
+        # STATUS_SOLVED, unless the run was stopped part way through by its budget or by being cancelled
+        self.status = STATUS_SOLVED
+        # Every sample's values, by output, a batch per array (NaN where a sample wasn't solved) - if they're being kept
+        self.batches = {name: [] for name in self.outputs} if keepSamples else None
+
+    def add(self, values, solved):
+        """
+        Add a batch of samples
+        :param values: dict of each variable's values, as arrays (or single values, if the same for every sample)
+        :param solved: boolean array of which samples were solved
+        """
+        count = len(solved)
+        self.count += count
+        self.failures += int(count - solved.sum())
+        for name in self.outputs:
+            value = values.get(name)
+            batch = np.broadcast_to(np.asarray(np.nan if value is None else value, dtype=float), (count,))
+            good = batch[solved & np.isfinite(batch)]
+            self.stats[name].add(good)
+            self.sketches[name].add(good)
+            if self.batches is not None:
+                self.batches[name].append(np.where(solved, batch, np.nan))
+
+    def mean(self, name):
+        return self.stats[name].mean
+
+    def variance(self, name):
+        return self.stats[name].variance()
+
+    def std(self, name):
+        return self.stats[name].std()
+
+    def quantile(self, name, q):
+        return self.sketches[name].quantile(q)
+
+    def getSamples(self, name):
+        # Every sample's value of an output, in the order they were taken (only if the run was asked to keep them)
+        if self.batches is None:
+            raise ValueError("samples weren't kept - run with keepSamples=True")
+        return np.concatenate(self.batches[name]) if self.batches[name] else np.empty(0)
+
+    def summary(self):
+        # A table of each output's statistics, as text
+        lines = ["%-24s %12s %12s %12s %12s %12s" % ("variable", "mean", "std", "5%", "median", "95%")]
+        for name in self.outputs:
+            (low, median, high) = self.quantile(name, [0.05, 0.5, 0.95])
+            lines.append("%-24s %12.6g %12.6g %12.6g %12.6g %12.6g" % (name, self.mean(name), self.std(name), low, median, high))
+        lines.append(str(self.count) + " samples, " + str(self.failures) + " failed" + ("" if self.status == STATUS_SOLVED else ", stopped: " + self.status))
+        return "\n".join(lines)
+
+    def __repr__(self):
+        return "<MonteCarloResult: " + str(self.count) + " samples, " + str(self.failures) + " failed, " + str(len(self.outputs)) + " outputs>"
+
+
+class MonteCarlo:
+    """
+    Propagates distributions of a problem's inputs through it, to give distributions of its outputs
+    """
+    def __init__(self, problem, distributions=None, inputs=None, refContext=False):
+        """
+        :param distributions: dict of Distributions of input variables, by name, on top of the problem's own
+            (Problem.distributions, e.g. from `~` lines in its .prob file)
+        :param inputs: dict of fixed values of other variables, on top of the problem's default values (None makes a
+            variable an output)
+        :param refContext: starting points for numerical solving (see Problem.solve)
+        """
+        self.problem = problem
+        self.distributions = dict(problem.distributions)
+        self.distributions.update(distributions or {})
+        if not self.distributions:
+            raise ValueError("no input variables have distributions")
+        unknown = sorted(set(self.distributions) - set(problem.getVariables()))
+        if unknown:
+            raise ValueError("distributions given for unknown variable(s): " + ", ".join(unknown))
+        self.baseContext = problem.defaultContext.copy()
+        self.baseContext.varVals.update(inputs or {})
+        self.refContext = refContext
+
+    def sampleInputs(self, seed, batchIndex, count, sampling=SAMPLING_LHS):
+        # One batch of samples of every input with a distribution, as a dict of arrays by name
+        return {name: distribution.ppf(uniformSamples(seed, name, batchIndex, count, sampling))
+                for (name, distribution) in sorted(self.distributions.items())}
+
+    def solveSamples(self, samples, count, budget=None):
+        """
+        Solve for a batch of samples at once
+        :param samples: dict of the inputs' values, as arrays of length count
+        :return: (dict of variables' values, as arrays with NaN for samples that weren't solved, boolean array of which
+            samples were solved, the status the run has to stop with - None to carry on)
+        """
+        context = self.baseContext.copy()
+        context.varVals.update(samples)
+        result = self.problem.solve(context, self.refContext, budget)
+        if result:
+            return (context.varVals, np.ones(count, dtype=bool), None)
+        if result.status in (STATUS_BUDGET_EXCEEDED, STATUS_CANCELLED):
+            return ({}, np.zeros(count, dtype=bool), result.status)
+        # Some of the samples can't be solved (e.g. they're outside the model's domain)
+        # If that was in a numerical block, the samples it couldn't solve were left NaN, so solve the others again
+        # without them; otherwise, find out which they are by solving each half of the batch separately
+        block = result.plan[-1] if result.plan else None
+        if block is not None and block.kind == BLOCK_NUMERIC and block.variables:
+            bad = np.zeros(count, dtype=bool)
+            for name in block.variables:
+                value = context.varVals.get(name)
+                bad |= ~np.isfinite(np.broadcast_to(np.asarray(np.nan if value is None else value, dtype=float), (count,)))
+            if bad.all():
+                return ({}, np.zeros(count, dtype=bool), None)
+            if bad.any():
+                return self.solveParts(samples, count, [np.flatnonzero(~bad)], budget)
+        if count == 1:
+            return ({}, np.zeros(count, dtype=bool), None)
+        return self.solveParts(samples, count, [np.arange(count // 2), np.arange(count // 2, count)], budget)
+
+    def solveParts(self, samples, count, parts, budget=None):
+        # Solve some subsets of a batch of samples separately (see solveSamples), giving the results for the whole batch
+        values = {}
+        solved = np.zeros(count, dtype=bool)
+        for part in parts:
+            (partValues, partSolved, stop) = self.solveSamples({name: value[part] for (name, value) in samples.items()}, len(part), budget)
+            solved[part] = partSolved
+            for (name, value) in partValues.items():
+                if value is not None:
+                    values.setdefault(name, np.full(count, np.nan))[part] = value
+            if stop is not None:
+                return (values, solved, stop)
+        return (values, solved, None)
+
+    def runBatches(self, samples, outputs=None, sampling=SAMPLING_LHS, seed=0, batchSize=DEFAULT_BATCH_SIZE,
+                   keepSamples=False, budget=None, compression=DEFAULT_COMPRESSION):
+        """
+        Run the samples a batch at a time, giving the statistics so far after each batch (see run)
+        :return: generator of the MonteCarloResult (the same one each time, updated)
+        """
+        if sampling not in SAMPLINGS:
+            raise ValueError("unknown sampling " + repr(sampling) + " (should be one of: " + ", ".join(SAMPLINGS) + ")")
+        # A problem that can't be solved at the inputs' medians is very unlikely to be solvable for any samples, so
+        # don't go on to find that out the slow way
+        context = self.baseContext.copy()
+        context.varVals.update({name: distribution.median() for (name, distribution) in self.distributions.items()})
+        check = self.problem.solve(context, self.refContext, budget)
+        if not check:
+            raise ValueError("can't solve the problem with its inputs at their medians (" + check.status + ")")
+        result = MonteCarloResult(self.problem.getVariableNames() if outputs is None else outputs, compression, keepSamples)
+        for (batchIndex, start) in enumerate(range(0, samples, batchSize)):
+            count = min(batchSize, samples - start)
+            (values, solved, stop) = self.solveSamples(self.sampleInputs(seed, batchIndex, count, sampling), count, budget)
+            if stop is not None:
+                result.status = stop
+                yield result
+                return
+            result.add(values, solved)
+            yield result
+
+    def run(self, samples, outputs=None, sampling=SAMPLING_LHS, seed=0, batchSize=DEFAULT_BATCH_SIZE,
+            keepSamples=False, budget=None, compression=DEFAULT_COMPRESSION):
+        """
+        Sample the inputs and solve for every sample, a batch at a time
+        :param samples: number of samples
+        :param outputs: names of the variables to keep statistics of (defaults to every variable)
+        :param sampling: SAMPLING_LHS (Latin hypercube, within each batch) or SAMPLING_RANDOM
+        :param seed: seed for the random numbers - runs with the same seed and batch size sample each input identically
+        :param keepSamples: also keep every sample's values (see MonteCarloResult.getSamples), rather than just statistics
+        :param budget: optional budgets.SolveBudget for each batch's solve; running out of it, or cancelling it, stops
+            the run, with the statistics of the batches before
+        :return: MonteCarloResult
+        """
+        result = None
+        batches = self.runBatches(samples, outputs, sampling, seed, batchSize, keepSamples, budget, compression)
+        for result in batches:
+            pass
+        if result is None:
+            result = MonteCarloResult(self.problem.getVariableNames() if outputs is None else outputs, compression, keepSamples)
+        return result
@@ -4,69 +4,263 @@
 # Each NIobject has local variables, which can take various values, and local equations/constraints, which always hold but only refer to that object's variables
 # It also has a link to its parent class, and a name
 # TODO Make it possible for an object to have child objects
-from constraints import EqualityConstraint
-from equationsolver import Problem
+from constraints import Constraint, EqualityConstraint
+from equationsolver import Problem, STATUS_FAILED
 from expressions import ScalarVariable
-from tests import test_objects
 
 __author__ = 'David Wyatt'
 
 # An NIclass is basically the template for an NIobject - it has a list of variables that each object of that class inherits, and likewise constraints
+# The class' variables and constraints are shared by all its objects (rather than copied), so mustn't be changed once it has any
 class NIClass:
     def __init__(self, name, vars, constrs):
         self.name = name
         # Store a list of variables associated with the class
         self.variables = vars
         self.constrs = constrs
+        # Each variable's position ("slot") in the list, by name
+        self.slots = {var.name: slot for (slot, var) in enumerate(vars)}
+        # The non-composite expressions in each constraint, as (slot, expression) with slot None for anything that
+        # isn't a class variable (e.g. fixed values)
+        self.constrLeaves = [[(self.slots.get(var.name) if isinstance(var, ScalarVariable) else None, var)
+                              for (var, setter) in constr.getDescendantVarsAndSetters()] for constr in constrs]
 
     def __repr__(self):
         return "<NIClass: name " + self.name + ", variables " + repr(self.variables) + ", constraints " + repr(self.constrs) + ">"
 
 
 class NIObject:
+    # An instance of an NIClass
+    # Holds nothing but its name and the values of its variables - its variables and constraints are views of the
+    # class' ones (ObjectVariable and BoundConstraint), made as they're asked for
+    # N.B. Each call to constrs makes new constraint views, so only add an object to a problem once
+    __slots__ = ("name", "niclass", "values")
+
     def __init__(self, name, niclass):
         self.niclass = niclass
         self.name = name
-        self.variables = []
-        [self.addVar(var.copy()) for var in self.niclass.variables]
-        self.varnamesdict = {var.name: var for var in self.variables}
-        self.constrs = []
-        for classconstr in self.niclass.constrs:
-            # Need to copy the class' constraints but replace the class' variables with the corresponding instance variables
-            # First copy the constraint and add to list
-            newconstr = classconstr.copy()
-            self.constrs.append(newconstr)
-            # Override the constraint's getName with a function that prepends this object's name
-            newconstr.getName = lambda: self.getChildObjName(newconstr)
-            # Now iterate through every non-composite expression
-            for (var, varSetFunc) in newconstr.getDescendantVarsAndSetters():
-                # Check if it refers to a class variable
-                if var in self.niclass.variables:
-                    # If so replace it
-                    # Find the corresponding instance variable
-                    varToReplaceWith = self.varnamesdict[var.name]
-                    # And slot this in in place of the class variable...
-                    varSetFunc(varToReplaceWith)
-
-    def addVar(self, var):
-        self.variables.append(var)
-        # Override the variable's getName with a function that prepends this object's name
-        # Let's see if this works...
-        var.getName = lambda: self.getChildObjName(var)
+        # Default value of each of the class' variables, by slot
+        self.values = [var.value for var in niclass.variables]
+
+    @property
+    def variables(self):
+        return [ObjectVariable(self, slot) for slot in range(len(self.values))]
+
+    @property
+    def constrs(self):
+        return [BoundConstraint(self, index) for index in range(len(self.niclass.constrs))]
 
     def getChildObjName(self, childObj):
         return self.name + "." + childObj.name
 
     def __repr__(self):
-        return "<NIObject: name " + self.name + ", class " + repr(self.niclass) + ", variables " + repr(self.variables) + ", constraints " + repr(self.constrs) + ">"
+        return "<NIObject: name " + self.name + ", class " + self.niclass.name + ", values " + repr(self.values) + ">"
 
     def getVar(self, varname):
-        if varname in self.varnamesdict:
-            return self.varnamesdict[varname]
+        if varname in self.niclass.slots:
+            return ObjectVariable(self, self.niclass.slots[varname])
         else:
             return None
 
 
+class ObjectVariable(ScalarVariable):
+    # One of an object's variables: a (object, slot) pair, named and valued on demand from the object and its class
+    __slots__ = ("obj", "slot")
+
+    def __init__(self, obj, slot):
+        self.obj = obj
+        self.slot = slot
+
+    @property
+    def name(self):
+        return self.obj.niclass.variables[self.slot].name
+
+    @property
+    def value(self):
+        return self.obj.values[self.slot]
+
+    @value.setter
+    def value(self, value):
+        self.obj.values[self.slot] = value
+
+    def getName(self):
+        return self.obj.name + "." + self.name
+
+    def __getstate__(self):
+        # Only the binding - the name and value come from the object
+        return {"obj": self.obj, "slot": self.slot}
+
+    def __repr__(self):
+        return "<ObjectVariable: name " + self.getName() + ", value " + str(self.value) + ">"
+
+
+class ObjectContext:
+    # View of a context in which an object's class variables stand for that object's variables,
+    # so that the class' constraints can be evaluated for the object
+    __slots__ = ("context", "prefix", "slots")
+
+    def __init__(self, context, obj):
+        self.context = context
+        self.prefix = obj.name + "."
+        self.slots = obj.niclass.slots
+
+    def getKey(self, var):
+        name = var.getName()
+        if name in self.slots:
+            return self.prefix + name
+        return name
+
+    def getValue(self, var):
+        return self.context.varVals.get(self.getKey(var))
+
+    def setValue(self, var, value):
+        self.context.varVals[self.getKey(var)] = value
+
+
+class BoundConstraint(Constraint):
+    # One of an object's constraints: the class' constraint, evaluated in terms of the object's variables
+    __slots__ = ("obj", "index")
+
+    def __init__(self, obj, index):
+        self.obj = obj
+        self.index = index
+
+    @property
+    def constr(self):
+        return self.obj.niclass.constrs[self.index]
+
+    @property
+    def name(self):
+        return self.constr.getName()
+
+    def getName(self):
+        return self.obj.getChildObjName(self)
+
+    def __getstate__(self):
+        # Only the binding - the name comes from the class' constraint (and, being a property, can't be restored)
+        return {"obj": self.obj, "index": self.index}
+
+    def __setstate__(self, state):
+        for (slot, value) in state.items():
+            setattr(self, slot, value)
+
+    def __repr__(self):
+        return "<BoundConstraint " + self.getName() + ">"
+
+    def getTextFormula(self):
+        return self.obj.name + ": " + self.constr.getTextFormula()
+
+    def getExprs(self):
+        return [var if slot is None else ObjectVariable(self.obj, slot) for (slot, var) in self.obj.niclass.constrLeaves[self.index]]
+
+    def getUndefinedExprs(self, context):
+        slots = self.obj.niclass.slots
+        return [ObjectVariable(self.obj, slots[var.name]) if var.name in slots else var
+                for var in self.constr.getUndefinedExprs(ObjectContext(context, self.obj))]
+
+    def propagate(self, context):
+        return self.constr.propagate(ObjectContext(context, self.obj))
+
+    def getResidual(self, context):
+        return self.constr.getResidual(ObjectContext(context, self.obj))
+
+    def getSides(self):
+        (lhs, rhs, nameOf) = self.constr.getSides()
+        return (lhs, rhs, ObjectContext(None, self.obj).getKey)
+
+    def copy(self):
+        # Nothing to copy - it's only a view of the class' constraint
+        return self
+
+
+# An NIObjectArray is many objects of the same class (e.g. a fleet of identical parts), stored as the class itself plus
+# an array of values per variable, rather than as separate copies of every variable and constraint
+# The class' constraints are solved once for all the instances at a time, with numpy arrays as the variables' values
+# N.B. numpy is only imported here, so that problems without object arrays don't need it
+class NIObjectArray:
+    def __init__(self, name, niclass, count):
+        import numpy as np
+        self.niclass = niclass
+        self.name = name
+        self.count = count
+        # The class' constraints make up a template problem, in terms of the class' own variables
+        self.template = Problem(name + " (template for " + niclass.name + ")")
+        self.template.addConstrs(*niclass.constrs)
+        self.template.addExprs(*niclass.variables)
+        # Values of each variable for each instance, with NaN for values still to be found
+        self.values = {}
+        for var in niclass.variables:
+            self.values[var.name] = np.full(count, np.nan if var.value is None else var.value, dtype=float)
+        # Outcome of the last solve for each instance
+        self.statuses = [None] * count
+
+    def __repr__(self):
+        return "<NIObjectArray: name " + self.name + ", class " + repr(self.niclass) + ", " + str(self.count) + " instances>"
+
+    def __len__(self):
+        return self.count
+
+    def getInstanceName(self, i):
+        return self.name + "[" + str(i) + "]"
+
+    def setValues(self, varname, values):
+        """
+        Set the value of a variable for every instance
+        :param values: a single value for all instances or a sequence of one value per instance (None or NaN to solve for it)
+        """
+        import numpy as np
+        self.values[varname][:] = np.nan if values is None else np.asarray(values, dtype=float)
+
+    def getValues(self, varname):
+        # Array of the value of a variable for every instance (NaN where not known)
+        return self.values[varname]
+
+    def getInstanceContext(self, i):
+        # Context holding the values of just one instance
+        import numpy as np
+        context = self.template.defaultContext.copy()
+        for var in self.niclass.variables:
+            value = self.values[var.name][i]
+            context.setValue(var, None if np.isnan(value) else float(value))
+        return context
+
+    def solve(self, refContext=False):
+        """
+        Solve every instance
+        Instances are grouped by which of their variables are known, and each group is solved in one go, with an
+        array of values for each variable - so the constraints are sequenced once per group rather than once per instance
+        Any constraints that have to be solved numerically are solved instance by instance
+
+        :param refContext: reference values for numerical solving (see Problem.solve), shared by every instance
+        :return: True if every instance was solved, else False
+        """
+        import numpy as np
+        varnames = [var.name for var in self.niclass.variables]
+        known = ~np.isnan(np.array([self.values[name] for name in varnames]).reshape(len(varnames), self.count))
+        # Find the distinct patterns of known variables, and which instances have each
+        (patterns, groupOfInstance) = np.unique(known.T, axis=0, return_inverse=True)
+        groupOfInstance = groupOfInstance.reshape(-1)
+        allSolved = True
+        for (groupIndex, pattern) in enumerate(patterns):
+            instances = np.flatnonzero(groupOfInstance == groupIndex)
+            context = self.template.defaultContext.copy()
+            for (var, isKnown) in zip(self.niclass.variables, pattern):
+                context.setValue(var, self.values[var.name][instances] if isKnown else None)
+            result = self.template.solve(context, refContext)
+            if not result:
+                allSolved = False
+            status = result.status
+            if status != STATUS_FAILED:
+                # (Partial solves still have values for some of the variables)
+                for var in self.niclass.variables:
+                    value = context.getValue(var)
+                    if value is not None:
+                        self.values[var.name][instances] = value
+            for i in instances:
+                self.statuses[i] = status
+        return allSolved
+
+
 
 class ObjectTestProblem(Problem):
     def __init__(self):
@@ -90,4 +284,5 @@ class ObjectTestProblem(Problem):
 
 
 if __name__ == "__main__":
+    from tests import test_objects
     test_objects()
\ No newline at end of file
@@ -1,106 +1,57 @@
-import math
 #from numpy.dual import solve
 from constraints import EqualityConstraint
-from equationsolver import Problem, Context
-from pyparsing import Word, alphas, nums, Literal, CaselessLiteral, Optional, Combine, ZeroOrMore, Group, Forward, \
-    ParseResults, restOfLine, CaselessKeyword, Or, printables, QuotedString, Keyword, alphanums
-from expressions import FixedValue, ProductExpression, SumExpression, PowerExpression, ScalarVariable, \
-    DifferenceExpression, QuotientExpression, TanExpression, CosExpression, SinExpression, Constant
-import six
+from equationsolver import Problem
+from expressions import ScalarVariable, Constant
+from objects import NIClass, NIObject, ObjectVariable, BoundConstraint
+from probparser import LineParser, ProbSyntaxError
+from symboltable import SymbolTable
 import os
-import inspect
+import threading
 __author__ = 'David Wyatt'
 
-# An attempt to use pyparsing to parse a problem out of a text file
+# Parsing of problems out of text files
 
 
 testfilename = "examples/test.prob"
-# Parser definition
-# From http://eikke.com/pyparsing-introduction-bnf-to-code/6/index.html
-# And pyparsing's fourfn
-
-# Various elementary token definitions
-point = Literal(".")
-e = CaselessLiteral("E")
-lPar = Literal('(').suppress()
-rPar = Literal(')').suppress()
-quot = Literal('\"').suppress()
-equals = Literal('=').suppress()
-assign = Literal(':=').suppress()
-constassign = Literal('==').suppress()
-signedDigitString = Word("+-" + nums, nums)
-fNumber = Combine(signedDigitString + Optional(point + Optional(Word(nums))) + Optional(e + signedDigitString))
-varName = Word( alphas+"_", alphanums+"_" )
-equationName = QuotedString(quoteChar="\"")
-# What word to use to include another file's contents?
-# http://en.wikipedia.org/wiki/Comparison_of_programming_languages_%28syntax%29#Libraries
-# Python: import
-# OpenSCAD: include (also use, but that's slightly different)
-# C etc: #include
-# LaTeX: \input, \include
-# Java: import
-# Modelica: import
-# OK, let's go for import then...
-importkeyword = Keyword("import").suppress()
-
-# Constants
-constantMap = {
-  "pi": Constant("pi", math.pi),
-  "e": Constant("e", math.e)
-}
-constant = Or([CaselessKeyword(constantName) for constantName in constantMap])
-constant.setParseAction(lambda s, l, t: [constantMap[t[0]]])
-
-# Parse numbers into floats straight away
-fNumber.setParseAction(lambda s, l, t: [float(t[0])])
-
-# Binary operators
-binaryOperator = Word('+-*/^', exact=1) # N.B. To-the-power-of is ^ in this grammar at the moment - TODO make it accept Python syntax **
-# Define mapping from binary operator symbols to composite expression classes
-binaryOperatorMap = {
-    '+': SumExpression,
-    '-': DifferenceExpression,
-    '*': ProductExpression,
-    '/': QuotientExpression,
-    '^': PowerExpression
-}
-# Now make binary operators get turned into classes straight away
-binaryOperator.setParseAction(lambda s, l, t: [binaryOperatorMap[t[0]]])
-
-# Likewise for unary operators
-unaryOperatorMap = {
-    'sin': SinExpression,
-    'cos': CosExpression,
-    'tan': TanExpression
-}
-unaryOperator = Or([CaselessKeyword(funcname) for funcname in unaryOperatorMap])
-unaryOperator.setParseAction(lambda s, l, t: [unaryOperatorMap[t[0]]])
-
-# Comments
-comment = '#' + restOfLine
-
-# Now, main structure of expression-parser
-expr = Forward()
-# atom is a number, variable, parenthesised expression or unary operator
-atom = constant | fNumber | Group(lPar + expr + rPar) | Group(unaryOperator + lPar + Group(expr) + rPar) | varName
-# Expr is an atom plus a succession of binary operators and expressions
-expr << atom + ZeroOrMore(binaryOperator + Group(expr))
-# Constraint is two expressions separated by an equals, possibly with an equation name at the end
-constraint = Group(expr) + equals + Group(expr) + Optional(equationName)
-# Variable initialisation is a variable name with ":=" and an expression
-varinit = varName + assign + Group(expr)
-# Constant definition is like varinit but with a "=="
-constantdef = varName + constassign + Group(expr)
-# Import command is import(filename) TODO
-importfilename = QuotedString(quoteChar="\"")
-importcommand = importkeyword + lPar + importfilename + rPar
-
-# Master line parser - optional to allow for blank lines
-lineParser = Optional(constraint("constraint") | varinit("varinit") | constantdef("constdef") | importcommand("importcommand"))
-lineParser.ignore(comment)
+
+# Process-wide cache of parsed modules (i.e. imported .prob files), keyed by absolute path
+# Each file is only parsed once per process, however many problems import it and by however many routes;
+# importing it again just adds the already-parsed constants, variables and equations to the importing problem
+_moduleCache = {}
+_moduleCacheLock = threading.RLock()
+
+def getModule(filename, importChain=()):
+    """
+    Get the parsed contents of a .prob file for importing, parsing it only if it isn't cached or has changed on disk
+    :param importChain: the files currently being parsed that led to this import (to detect circular imports)
+    :return: a ParsedProblem for the file
+    """
+    path = os.path.abspath(filename)
+    with _moduleCacheLock:
+        if path in _moduleCache:
+            (stamps, module) = _moduleCache[path]
+            if stamps == _sourceStamps(module.sourceFiles):
+                return module
+        module = ParsedProblem(path, importChain)
+        _moduleCache[path] = (_sourceStamps(module.sourceFiles), module)
+        return module
+
+def clearModuleCache():
+    with _moduleCacheLock:
+        _moduleCache.clear()
+
+def _sourceStamps(filenames):
+    stamps = []
+    for filename in filenames:
+        try:
+            stat = os.stat(filename)
+            stamps.append((stat.st_mtime_ns, stat.st_size))
+        except OSError:
+            stamps.append(None)
+    return stamps
 
 class ParsedProblem(Problem):
-    def __init__(self, filename):
+    def __init__(self, filename, importChain=()):
         super(ParsedProblem, self).__init__("Problem from file: " + os.path.abspath(filename))
         #os.chdir(os.path.dirname(os.path.abspath(__file__)))
         #sname=inspect.getframeinfo(inspect.currentframe()).filename
@@ -108,138 +59,353 @@ class ParsedProblem(Problem):
         #spath=inspect.getabsfile()
         #print("Changing path to ", spath)
         #os.chdir(spath)
-        self.parse_file(filename, set())
-        self.print()
+        # Every file that went into this problem (the file itself and anything it imports), as absolute paths
+        self.sourceFiles = []
+        # What each line of the file added to the problem, in order, so that it can be replayed into problems importing this one
+        # Each item is ("constr", constraint), ("expr", expression), ("default", variable, value), ("import", module),
+        # ("alias", name, module), ("class", niclass), ("object", niobject) or ("distribution", name, distribution)
+        self.items = []
+        # Modules (i.e. other ParsedProblems) that have been imported into this one, directly or indirectly, and
+        # (module, alias) for those imported under an alias
+        self.importedModules = set()
+        # Copies of this problem's contents for importing under an alias, by alias (see getAliasedCopy)
+        self.aliasedCopies = {}
+        # Classes defined in (or imported into) this problem, by name
+        self.classes = {}
+        self.parse_file(filename, tuple(importChain) + (os.path.abspath(filename),))
+        # Only print the whole problem for the top-level file, not for every import
+        if not importChain:
+            self.print()
 
-    def parse_file(self, filename, previous_files):
+    def parse_file(self, filename, importChain):
         print("------------------------------------------")
         print("Parsing", filename)
-        previous_files.add(filename)
+        self.sourceFiles.append(os.path.abspath(filename))
+        lineParser = LineParser(self.findVar)
+        # The class currently being defined, if any, and a parser that finds variables in its scope
+        classBuilder = None
         with open(filename, 'r') as file:
             i = 1
-            for line in file.readlines():
+            for line in file:
                 # print("Trying to parse:",line)
-                parsedLine = lineParser.parseString(line)
+                try:
+                    parsedLine = (classBuilder.lineParser if classBuilder else lineParser).parseLine(line)
+                except ProbSyntaxError as err:
+                    print("Error! Syntax error at line", str(i), "column", str(err.column + 1), "of", filename + ":", err)
+                    parsedLine = None
                 # print(parsedLine)
-                if parsedLine.constraint:
+                if parsedLine is None:
+                    # Blank line, comment or error
+                    pass
+                elif classBuilder:
+                    # Inside a class definition
+                    if parsedLine[0] == "end":
+                        niclass = classBuilder.build()
+                        self.classes[niclass.name] = niclass
+                        self.items.append(("class", niclass))
+                        classBuilder = None
+                    else:
+                        try:
+                            if not classBuilder.addLine(parsedLine, i):
+                                print("Error! Only equations and variable initialisations are allowed inside a class, at line", str(i))
+                        except ProbSyntaxError as err:
+                            print("Error! Syntax error at line", str(i), "of", filename + ":", err)
+                elif parsedLine[0] == "class":
+                    classBuilder = ClassBuilder(parsedLine[1], self)
+                elif parsedLine[0] == "end":
+                    print("Error! Closing brace outside a class definition at line", str(i))
+                elif parsedLine[0] == "object":
+                    (className, name, params) = parsedLine[1:]
+                    if className in self.classes:
+                        self.addInstance(NIObject(name, self.classes[className]), params, i)
+                    else:
+                        print("Error! Unknown class", className, "at line", str(i))
+                elif parsedLine[0] == "constraint":
                     # Equality constraint definition
-                    # Now we need to turn these into expressions...
-                    lhs = self.parseExpr(parsedLine[0])
-                    rhs = self.parseExpr(parsedLine[1])
-
-                    if len(parsedLine) == 2:
+                    (lhs, rhs, title) = parsedLine[1:]
+                    if title is None:
                         constr = EqualityConstraint("Line " + str(i), lhs, rhs)
-                    elif len(parsedLine) == 3:  # Assume length is only 3 if we have a constraint title
-                        constr = EqualityConstraint(str(parsedLine[2]), lhs, rhs)
+                    else:
+                        constr = EqualityConstraint(title, lhs, rhs)
 
                     # print(constr)
                     self.addConstr(constr)
-                elif parsedLine.varinit:
+                    self.items.append(("constr", constr))
+                elif parsedLine[0] == "varinit":
                     # Variable initialisation line
                     # Find the variable (or make one if it doesn't exist already)
-                    var = self.findVar(parsedLine[0])
-                    # Parse the expression on the RHS
-                    value_expr = self.parseExpr(parsedLine[1])
-                    # See if we can get the value from a None context!
-                    testval = value_expr.getValue(None)
-                    # If we didn't get a None value returned:
-                    if testval:
-                        # Set the default value of the variable, which will be copied into every context it's used in!
-                        var.value = testval
+                    try:
+                        var = self.findVar(parsedLine[1])
+                    except ProbSyntaxError as err:
+                        print("Error! Syntax error at line", str(i), "of", filename + ":", err)
                     else:
-                        print("Error in variable initialisation on line: ", str(i), parsedLine)
-                    # Regardless, add the variable to the problem (in case it's new)
-                    self.addExpression(var)
-                elif parsedLine.constdef:
+                        value_expr = parsedLine[2]
+                        # See if we can get the value from a None context!
+                        testval = value_expr.getValue(None)
+                        # Regardless, add the variable to the problem (in case it's new)
+                        self.addExpression(var)
+                        # If we didn't get a None value returned:
+                        if testval is not None:
+                            # Set the default value of the variable, which will be copied into every context it's used in!
+                            # N.B. This goes in the default context rather than the variable itself, as the variable may
+                            # have come from an imported module and so be shared with other problems
+                            self.defaultContext.setValue(var, testval)
+                            self.items.append(("default", var, testval))
+                        else:
+                            print("Error in variable initialisation on line: ", str(i), line.strip())
+                elif parsedLine[0] == "distribution":
+                    # Distribution of a variable's values, for Monte Carlo runs
+                    # N.B. montecarlo needs numpy and scipy, so is only imported by problems that use it
+                    from montecarlo import makeDistribution
+                    (name, kind, args) = parsedLine[1:]
+                    try:
+                        var = self.findVar(name)
+                        distribution = makeDistribution(kind, args, os.path.dirname(filename))
+                    except (ProbSyntaxError, ValueError) as err:
+                        print("Error in distribution on line:", str(i), line.strip() + ":", err)
+                    else:
+                        self.addExpression(var)
+                        self.distributions[var.getName()] = distribution
+                        self.items.append(("distribution", var.getName(), distribution))
+                        # The median is the variable's default value, for solving without sampling
+                        self.defaultContext.setValue(var, distribution.median())
+                        self.items.append(("default", var, distribution.median()))
+                        if getattr(distribution, "source", None):
+                            # So that the problem is parsed again if the values change (see probcache.py)
+                            self.sourceFiles.append(os.path.abspath(distribution.source))
+                elif parsedLine[0] == "constdef":
                     # TODO Constant initialisation line
-                    constant_name = parsedLine[0]
-                    # Parse the expression on the RHS
-                    value_expr = self.parseExpr(parsedLine[1])
+                    constant_name = parsedLine[1]
+                    value_expr = parsedLine[2]
                     # See if we can get the value from a None context!
                     testval = value_expr.getValue(None)
                     # If we didn't get a None value returned:
-                    if testval:
+                    if testval is not None:
                         # Create a constant accordingly
                         constant = Constant(constant_name, testval)
                         # Add the constant to the problem
                         self.addExpression(constant)
+                        self.items.append(("expr", constant))
                     else:
-                        print("Error in constant definition on line: ", str(i), parsedLine)
-                elif parsedLine.importcommand:
+                        print("Error in constant definition on line: ", str(i), line.strip())
+                elif parsedLine[0] == "import":
                     # Import command - parse another text file at this point!
-                    subfilename = parsedLine[0]
+                    (subfilename, alias) = parsedLine[1:]
                     # Turn it into a full path
                     subfilepath = os.path.join(os.path.dirname(filename), subfilename)
                     # Check this is a sane file name first!
                     if os.path.isfile(subfilepath):
                         # prevent infinite loops from mutual inclusion...
-                        if subfilepath not in previous_files:
-                            self.parse_file(subfilepath, previous_files)
-                            # Although this is recursive I think the pass-by-reference of previous files will cover multiple consecutive calls...
+                        # (importing the same file more than once by different routes is fine, though)
+                        if os.path.abspath(subfilepath) not in importChain:
+                            module = getModule(subfilepath, importChain)
+                            if alias is None:
+                                self.importModule(module)
+                                self.items.append(("import", module))
+                            else:
+                                # A separate copy of the module's contents, named alias.name
+                                self.importAliased(module, alias)
+                                self.items.append(("alias", alias, module))
                         else:
-                            print("Error! Tried to re-import file", subfilepath, " at line ",str(i))
+                            print("Error! Circular import of file", subfilepath, " at line ",str(i))
                     else:
                         print("Error! Could not import file", subfilepath, " at line ",str(i))
-                 
-                    
 
                 # Finally increment line counter
                 i += 1
+        if classBuilder:
+            print("Error! Class", classBuilder.name, "not closed (with a }) by the end of", filename)
+
+    def getSourceStamps(self):
+        # Modification times and sizes of every file the problem came from, to tell whether any has changed since
+        return _sourceStamps(self.sourceFiles)
+
+    def importModule(self, module):
+        # Add the contents of an imported module to this problem, by replaying what each of its lines did
+        # Modules that have already been imported (e.g. by another route) are skipped
+        if module in self.importedModules:
+            return
+        self.importedModules.add(module)
+        self.replayItems(module.items)
+        self.sourceFiles.extend(module.sourceFiles)
 
-    # Find the variable matching a string of its name
+    def importAliased(self, module, alias):
+        # Add a copy of an imported module's contents to this problem, with its names in the alias' namespace
+        if (module, alias) in self.importedModules:
+            return
+        self.importedModules.add((module, alias))
+        (table, items) = module.getAliasedCopy(alias)
+        # N.B. Before replaying, so that the copies are defined in (and only in) the alias' namespace
+        self.symbols.addNamespace(alias, table)
+        self.replayItems(items)
+        self.sourceFiles.extend(module.sourceFiles)
+
+    def replayItems(self, items):
+        for item in items:
+            if item[0] == "constr":
+                self.addConstr(item[1])
+            elif item[0] == "expr":
+                self.addExpression(item[1])
+            elif item[0] == "default":
+                self.addExpression(item[1])
+                self.defaultContext.setValue(item[1], item[2])
+            elif item[0] == "import":
+                self.importModule(item[1])
+            elif item[0] == "alias":
+                self.importAliased(item[2], item[1])
+            elif item[0] == "class":
+                self.classes[item[1].name] = item[1]
+            elif item[0] == "distribution":
+                self.distributions[item[1]] = item[2]
+            elif item[0] == "object":
+                self.addObjectDefaults(item[1])
+
+    def getAliasedCopy(self, alias):
+        """
+        A copy of everything in this problem, for importing it under an alias: each variable, constant and object is
+        copied under its name in the alias' namespace (x becomes alias.x, object m becomes alias.m), and each equation is
+        copied with its variables replaced by the copies (as NIObject does with its class' variables)
+        Made once per alias and kept, so that every problem importing this module under the same alias shares one copy
+        :return: (SymbolTable of the copies, by their names here, and a list of items to replay as in self.items)
+        """
+        with _moduleCacheLock:
+            if alias not in self.aliasedCopies:
+                self.aliasedCopies[alias] = self.makeAliasedCopy(alias)
+            return self.aliasedCopies[alias]
+
+    def makeAliasedCopy(self, alias):
+        prefix = alias + "."
+        # Each named expression's copy, by its name here
+        copies = {}
+        objects = {}
+        for expr in self.exprs:
+            if isinstance(expr, ObjectVariable):
+                objects[id(expr.obj)] = expr.obj
+            elif isinstance(expr, Constant):
+                copies[expr.getName()] = Constant(prefix + expr.getName(), expr.value)
+            elif isinstance(expr, ScalarVariable):
+                copies[expr.getName()] = ScalarVariable(prefix + expr.getName())
+        items = [("expr", copy) for copy in copies.values()]
+        for constr in self.constrs:
+            if isinstance(constr, BoundConstraint):
+                objects[id(constr.obj)] = constr.obj
+        for obj in objects.values():
+            # Objects are copied as new instances of the same class, with the same values
+            copy = NIObject(prefix + obj.name, obj.niclass)
+            copy.values = list(obj.values)
+            for (var, copiedVar) in zip(obj.variables, copy.variables):
+                copies[var.getName()] = copiedVar
+            items.append(("object", copy))
+        for constr in self.constrs:
+            # Objects' own equations come with the copied objects
+            if not isinstance(constr, BoundConstraint):
+                copy = constr.copy()
+                copy.name = prefix + constr.getName()
+                # N.B. By the original variables' names, as copying an object's variable loses its object
+                for ((var, originalSetter), (copiedVar, setter)) in zip(constr.getDescendantVarsAndSetters(), copy.getDescendantVarsAndSetters()):
+                    if var.getName() in copies:
+                        setter(copies[var.getName()])
+                items.append(("constr", copy))
+        for (name, value) in self.defaultContext.varVals.items():
+            if value is not None and name in copies and not isinstance(copies[name], Constant):
+                items.append(("default", copies[name], value))
+        for (name, distribution) in self.distributions.items():
+            items.append(("distribution", prefix + name, distribution))
+        # Classes are only templates, so are shared rather than copied
+        for niclass in self.classes.values():
+            items.append(("class", niclass))
+        table = SymbolTable(alias)
+        for (name, copy) in copies.items():
+            table.define(name, copy)
+        return (table, items)
+
+    def addInstance(self, obj, params, lineNumber):
+        # Add an object to the problem, with the given (variable name, expression) parameters
+        # A parameter that's a plain value becomes the default value of the object's variable; anything else becomes
+        # an equation linking the object's variable to the rest of the problem
+        for (paramName, expr) in params:
+            var = obj.getVar(paramName)
+            if var is None:
+                print("Error! Class", obj.niclass.name, "has no variable", paramName, "at line", str(lineNumber))
+                continue
+            value = expr.getValue(None)
+            if value is not None:
+                var.value = value
+            else:
+                constr = EqualityConstraint(obj.name + " parameter " + paramName, var, expr)
+                self.addConstr(constr)
+                self.items.append(("constr", constr))
+        self.addObjectDefaults(obj)
+        self.items.append(("object", obj))
+
+    def addObjectDefaults(self, obj):
+        self.addObj(obj)
+        # Set the defaults explicitly, in case any of the object's variables were referred to (and so added) before it
+        for var in obj.variables:
+            if var.value is not None:
+                self.defaultContext.setValue(var, var.value)
+
+    # Find the variable (or constant) matching a string of its name, which may be dotted (e.g. alias.name)
     def findVar(self, varName):
-        matchVars = [var for var in self.exprs if var.name == varName]
-        if len(matchVars) == 1:
-            # Found a unique matching variable!
-            return matchVars[0]
-        elif len(matchVars) == 0:
+        var = self.symbols.lookup(varName)
+        if var is None:
+            if not self.symbols.canDefine(varName):
+                # e.g. alias.name where the aliased import has nothing called name
+                raise ProbSyntaxError("unknown name " + varName)
             # No variable yet, need to make one
-            newVar = ScalarVariable(varName)
-            #print("Made a new variable: " + str(newVar))
-            return newVar
-        else:
-            print("Error - multiple matching expressions for name: " + varName)
-            print("Current exprs: " + self.exprs)
-            return None
-
-    def parseExpr(self, exprS):
-        #print("Parsing", exprS)
-        # Roots of recursion:
-        # If it's a number, return a FixedValue
-        if isinstance(exprS, float):
-            return FixedValue(exprS)
-        # If it's a constant, just return that
-        elif isinstance(exprS, Constant):
-            return exprS
-        # If it's a string, return a variable of that name
-        elif isinstance(exprS, six.string_types):
-            # Attempt to obtain the corresponding variable if it exists already
-            # Probably too clunky a way to do it...
-            #print("Need to find/make ScalarVariable for: " + exprS)
-            return self.findVar(exprS)
-        elif isinstance(exprS, ParseResults):
-            # It's another chunk of parsing!
-            # Now it depends on the length
-            # Hopefully the length of this will be either 1 or 3
-            # If it's 1 it's a variable or number
-            # So just recurse
-            if len(exprS) == 1:
-                return self.parseExpr(exprS[0])
-            # If it's 2 it's a unary expression
-            elif len(exprS) == 2:
-                op = self.parseExpr(exprS[1])
-                return exprS[0](op)
-            # If it's 3 it's a binary expression
-            elif len(exprS) == 3:
-                op1 = self.parseExpr(exprS[0])
-                op2 = self.parseExpr(exprS[2])
-                return exprS[1](op1, op2)
+            var = ScalarVariable(varName)
+            #print("Made a new variable: " + str(var))
+        return var
+
+class ClassBuilder:
+    # Collects the lines of a class definition in a .prob file, then compiles them into an NIClass
+    # Every undotted name in the class is a variable of the class, unless it's a constant;
+    # dotted names (e.g. other.x) refer to variables of the problem the class is defined in
+    def __init__(self, name, problem):
+        self.name = name
+        self.problem = problem
+        self.lineParser = LineParser(self.findVar)
+        # Class variables in the order they're first used, by name
+        self.variables = {}
+        self.constrs = []
+
+    def findVar(self, varName):
+        if varName in self.variables:
+            return self.variables[varName]
+        elif "." in varName:
+            return self.problem.findVar(varName)
+        existing = self.problem.symbols.lookup(varName)
+        if isinstance(existing, Constant):
+            return existing
+        var = ScalarVariable(varName)
+        self.variables[varName] = var
+        return var
+
+    def addLine(self, parsedLine, lineNumber):
+        # Add a parsed line to the class, returning False if it's not allowed in a class
+        # Raises ProbSyntaxError for an initialisation of something other than a class variable
+        if parsedLine[0] == "constraint":
+            (lhs, rhs, title) = parsedLine[1:]
+            self.constrs.append(EqualityConstraint("Line " + str(lineNumber) if title is None else title, lhs, rhs))
+        elif parsedLine[0] == "varinit":
+            # Default value for every object of the class
+            # N.B. Only the class' own variables - constants and the problem's variables (which may belong to a cached
+            # module, shared with other problems) mustn't be changed by a class definition
+            var = self.findVar(parsedLine[1])
+            if self.variables.get(parsedLine[1]) is not var:
+                raise ProbSyntaxError("only the class' own variables can be initialised in it, not " + parsedLine[1])
+            value = parsedLine[2].getValue(None)
+            if value is not None:
+                var.value = value
             else:
-                # Should never get here!
-                print("Error parsing multi-part expression:", exprS)
+                print("Error in variable initialisation on line: ", str(lineNumber))
         else:
-            # Or here!
-            print("Error parsing expression:", exprS)
+            return False
+        return True
+
+    def build(self):
+        return NIClass(self.name, list(self.variables.values()), self.constrs)
+
 
 if __name__ == '__main__':
     p = ParsedProblem(testfilename)
@@ -0,0 +1,247 @@
+# Choice of numerical method for each block of constraints that has to be solved numerically
+# No one method suits every block: a single variable is best found by Newton's method or bracketing, a linear block by
+# one linear solve, a large sparse block by sparse Newton, and a small dense nonlinear block by scipy's hybr or lm.
+# So each block's structure (size, linearity and sparsity, all read off its tape) decides which methods to try, in order.
+# A portfolio can also race its first few candidates against each other in threads, keeping whichever converges first.
+# Either way, the method that solved each block is remembered, and tried first the next time the same block comes up
+# (e.g. in the next solve of a sweep)
+
+import concurrent.futures
+import threading
+
+import numpy as np
+import scipy.optimize
+
+import sparsenewton
+from tape import LOAD_SLOT, LOAD_CONST, ADD, SUB, MUL, DIV, POW, STORE
+
+METHOD_HYBR = "hybr"
+METHOD_LM = "lm"
+METHOD_KRYLOV = "krylov"
+METHOD_NEWTON = "newton"
+METHOD_LINEAR = "linear"
+METHOD_BRACKET = "bracket"
+METHODS = [METHOD_HYBR, METHOD_LM, METHOD_KRYLOV, METHOD_NEWTON, METHOD_LINEAR, METHOD_BRACKET]
+
+# Blocks of at least this many unknowns are solved with sparse Jacobians (see sparsenewton.py) rather than dense ones
+LARGE_SYSTEM_SIZE = 200
+# Blocks at least this big, with at most this fraction of their Jacobian nonzero, count as sparse too
+SPARSE_MIN_SIZE = 50
+SPARSE_MAX_DENSITY = 0.1
+
+
+class MethodCancelled(Exception):
+    # Raised inside a method's residual function to stop it (e.g. when another method has won a race)
+    pass
+
+
+class BlockFeatures:
+    # What the choice of method goes on
+    def __init__(self, size, isLinear, density):
+        self.size = size
+        self.isLinear = isLinear
+        self.density = density
+
+    def __repr__(self):
+        return "<BlockFeatures: size " + str(self.size) + (", linear" if self.isLinear else ", nonlinear") + ", density " + str(round(self.density, 3)) + ">"
+
+
+def getFeatures(tape, slots):
+    """
+    Work out a block's structure from its tape: each op's value is tracked as constant (0), linear (1) or nonlinear (2)
+    in the unknowns, so the block is linear if every residual is at most linear
+    :param slots: the tape slots of the unknowns
+    """
+    unknown = set(slots)
+    degrees = []
+    linear = True
+    nonzeros = 0
+    residualSlots = set()
+    for (op, arg) in tape.code:
+        if op == LOAD_SLOT:
+            degrees.append(1 if arg in unknown else 0)
+            if arg in unknown:
+                residualSlots.add(arg)
+        elif op == LOAD_CONST:
+            degrees.append(0)
+        elif op == STORE:
+            linear = linear and degrees.pop() <= 1
+            nonzeros += len(residualSlots)
+            residualSlots = set()
+        elif op in (ADD, SUB, MUL, DIV):
+            b = degrees.pop()
+            a = degrees.pop()
+            if op == ADD or op == SUB:
+                degrees.append(max(a, b))
+            elif op == MUL:
+                degrees.append(a + b if a + b <= 1 else 2)
+            else:
+                degrees.append(a if b == 0 else 2)
+        elif op == POW:
+            b = degrees.pop()
+            a = degrees.pop()
+            degrees.append(0 if a == 0 and b == 0 else 2)
+        else:
+            # Functions (sin etc.) are nonlinear unless constant
+            degrees.append(0 if degrees.pop() == 0 else 2)
+    size = len(slots)
+    return BlockFeatures(size, linear, nonzeros / float(size * max(tape.numConstrs, 1)) if size else 1.0)
+
+
+def chooseMethods(features):
+    # The methods to try for a block, best first
+    if features.isLinear:
+        return [METHOD_LINEAR, METHOD_NEWTON, METHOD_HYBR]
+    elif features.size == 1:
+        return [METHOD_HYBR, METHOD_NEWTON, METHOD_BRACKET]
+    elif features.size >= LARGE_SYSTEM_SIZE:
+        return [METHOD_NEWTON, METHOD_KRYLOV]
+    elif features.size >= SPARSE_MIN_SIZE and features.density <= SPARSE_MAX_DENSITY:
+        return [METHOD_NEWTON, METHOD_HYBR, METHOD_LM]
+    return [METHOD_HYBR, METHOD_LM, METHOD_NEWTON]
+
+
+def runMethod(method, tape, values, slots, x0, cancelled=None, tracker=None):
+    """
+    Solve a block by one method
+    :param values: 1D array of every slot's value (copied, so methods can run at the same time)
+    :param cancelled: optional threading.Event which stops the method when set
+    :param tracker: optional budgets.BudgetTracker to charge for the method's residual evaluations and iterations
+        (which stops the whole solve, by raising budgets.BudgetExceeded, when the budget runs out)
+    :return: (values of the unknowns, True if converged else False)
+    """
+    values = np.array(values, dtype=float)
+    x0 = np.asarray(x0, dtype=float)
+
+    def f(x):
+        if cancelled is not None and cancelled.is_set():
+            raise MethodCancelled()
+        if tracker is not None:
+            tracker.charge(evaluations=1)
+        values[slots] = x
+        return tape.evaluate(values)
+
+    def jac(x):
+        # One Jacobian per iteration, for the methods that use one
+        if tracker is not None:
+            tracker.charge(iterations=1)
+        values[slots] = x
+        return tape.jacobian(values, slots)[1]
+
+    def shouldStop():
+        # Checked every Newton iteration
+        if tracker is not None:
+            tracker.charge(evaluations=1, iterations=1)
+        return cancelled is not None and cancelled.is_set()
+
+    try:
+        if method == METHOD_NEWTON:
+            return sparsenewton.solve(tape, values, slots, x0, shouldStop=shouldStop)
+        elif method == METHOD_LINEAR:
+            values[slots] = x0
+            (residuals, jacobian) = tape.reverseJacobian(values)
+            step = sparsenewton.linearSolve(jacobian[:, slots], -residuals)
+            if step is None:
+                return (x0, False)
+            x = x0 + step
+            return (x, bool(np.all(np.abs(f(x)) <= 1e-9 * np.maximum(1.0, np.abs(residuals)))))
+        elif method == METHOD_BRACKET:
+            return bracketRoot(lambda x: f(np.array([x]))[0], float(x0[0]))
+        else:
+            result = scipy.optimize.root(f, x0, jac=None if method == METHOD_KRYLOV else jac, method=method)
+            return (result.x, bool(result.success) and bool(np.all(np.isfinite(result.x))))
+    except MethodCancelled:
+        return (x0, False)
+    except (ValueError, ArithmeticError, np.linalg.LinAlgError):
+        return (x0, False)
+
+
+def bracketRoot(f, x0, maxExpansions=60):
+    # Find a sign change around x0, widening the search geometrically, then close in on the root by Brent's method
+    fx0 = f(x0)
+    if fx0 == 0.0:
+        return (np.array([x0]), True)
+    step = max(1.0, abs(x0)) * 1e-2
+    for expansion in range(maxExpansions):
+        for x in (x0 - step, x0 + step):
+            fx = f(x)
+            if np.isfinite(fx) and np.sign(fx) != np.sign(fx0):
+                (a, b) = (min(x0, x), max(x0, x))
+                return (np.array([scipy.optimize.brentq(f, a, b, xtol=1e-14)]), True)
+        step *= 2.0
+    return (np.array([x0]), False)
+
+
+class Portfolio:
+    """
+    Solves blocks of constraints by whichever method suits them, remembering which worked for each block
+    N.B. Shared by every solve of a problem, so safe to use from several threads at once
+    """
+    def __init__(self, race=False, raceSize=3):
+        """
+        :param race: run the first raceSize candidate methods for each block at the same time, keeping the first to converge
+        """
+        self.race = race
+        self.raceSize = raceSize
+        # The method that last solved each block, by key (see solve)
+        self.winners = {}
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        # Locks can't be pickled (e.g. into __probcache__), and the winners are only worth keeping within a session
+        return {"race": self.race, "raceSize": self.raceSize}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def solve(self, key, tape, values, slots, x0, verbose=False, tracker=None):
+        """
+        Solve a block of constraints
+        :param key: identifies the block, e.g. the names of its constraints and unknowns
+        :return: (values of the unknowns, True if converged else False, the method that converged or None)
+        """
+        with self.lock:
+            winner = self.winners.get(key)
+        if winner is not None:
+            # Whatever worked last time is likely to again, so try it on its own before anything else
+            (x, success) = runMethod(winner, tape, values, slots, x0, tracker=tracker)
+            if success:
+                return (x, True, winner)
+        candidates = [method for method in chooseMethods(getFeatures(tape, slots)) if method != winner]
+        if self.race and len(candidates) > 1:
+            (x, success, method) = self.raceMethods(candidates[:self.raceSize], tape, values, slots, x0, tracker)
+            if not success:
+                # Give the rest a chance
+                (x, success, method) = self.tryMethods(candidates[self.raceSize:], tape, values, slots, x0, verbose, tracker)
+        else:
+            (x, success, method) = self.tryMethods(candidates, tape, values, slots, x0, verbose, tracker)
+        if success:
+            with self.lock:
+                self.winners[key] = method
+        return (x, success, method)
+
+    def tryMethods(self, methods, tape, values, slots, x0, verbose=False, tracker=None):
+        # Try each method in turn until one converges
+        x = x0
+        for method in methods:
+            if verbose: print("  Trying method", method)
+            (x, success) = runMethod(method, tape, values, slots, x0, tracker=tracker)
+            if success:
+                return (x, True, method)
+        return (x, False, None)
+
+    def raceMethods(self, methods, tape, values, slots, x0, tracker=None):
+        # Run the methods at once, in threads, keeping the first to converge and cancelling the rest
+        cancelled = threading.Event()
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=len(methods))
+        try:
+            futures = {executor.submit(runMethod, method, tape, values, slots, x0, cancelled, tracker): method for method in methods}
+            for future in concurrent.futures.as_completed(futures):
+                (x, success) = future.result()
+                if success:
+                    cancelled.set()
+                    return (x, True, futures[future])
+            return (x0, False, None)
+        finally:
+            cancelled.set()
+            executor.shutdown(wait=True)
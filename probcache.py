@@ -0,0 +1,122 @@
+# On-disk cache of parsed problems
+# Parsing a large .prob file takes a while, so the parsed Problem is pickled into a __probcache__ directory next to it
+# (much like Python's own __pycache__), together with a fingerprint of every file that went into it.
+# The cached copy is only used while none of those files - the problem file or anything it imports - has changed.
+
+import hashlib
+import os
+import pickle
+
+from parsedproblem import ParsedProblem
+
+# Name of the cache directory created alongside problem files
+CACHE_DIRNAME = "__probcache__"
+# Bump this whenever the parser or the expression/constraint classes change what a parsed problem looks like,
+# so that stale caches are ignored rather than unpickled into the wrong shape
+CACHE_FORMAT_VERSION = 9
+
+
+def loadProblem(filename, useCache=True, cacheDir=None):
+    """
+    Load a problem from a .prob file, using the cached parse if it's still valid
+    :param useCache: set to False to always parse the file (the cache is still refreshed)
+    :param cacheDir: directory to keep the cache in (defaults to a __probcache__ directory next to the file)
+    :return: the ParsedProblem
+    """
+    cachePath = cacheFilename(filename, cacheDir)
+    if useCache:
+        problem = readCache(cachePath)
+        if problem is not None:
+            print("Loaded", filename, "from cache")
+            return problem
+    problem = ParsedProblem(filename)
+    writeCache(cachePath, problem)
+    return problem
+
+
+def cacheFilename(filename, cacheDir=None):
+    # Where the cached parse of a problem file lives
+    filename = os.path.abspath(filename)
+    if cacheDir is None:
+        cacheDir = os.path.join(os.path.dirname(filename), CACHE_DIRNAME)
+        name = os.path.basename(filename)
+    else:
+        # A shared cache directory may hold files of the same name from different places, so include the full path
+        name = os.path.basename(filename) + "." + hashlib.sha1(filename.encode()).hexdigest()[:16]
+    return os.path.join(cacheDir, name + ".pickle")
+
+
+def readCache(cachePath):
+    """
+    Read a cached problem, checking that none of its source files have changed since it was cached
+    :return: the cached ParsedProblem, or None if there is no valid cache
+    """
+    try:
+        with open(cachePath, 'rb') as file:
+            # The fingerprints come first, so we can check them without unpickling the problem itself
+            header = pickle.load(file)
+            if header.get("version") != CACHE_FORMAT_VERSION:
+                return None
+            for (path, stamp, digest) in header["sources"]:
+                if not _sourceUnchanged(path, stamp, digest):
+                    return None
+            return pickle.load(file)
+    except FileNotFoundError:
+        return None
+    except Exception as err:
+        # A corrupt or incompatible cache is just a cache miss
+        print("Ignoring unreadable problem cache", cachePath, "(" + str(err) + ")")
+        return None
+
+
+def writeCache(cachePath, problem):
+    # Cache a parsed problem, along with fingerprints of the files it came from
+    header = {
+        "version": CACHE_FORMAT_VERSION,
+        "sources": [(path, _fileStamp(path), _fileDigest(path)) for path in _uniqueSources(problem)]
+    }
+    tempPath = cachePath + "." + str(os.getpid()) + ".tmp"
+    try:
+        os.makedirs(os.path.dirname(cachePath), exist_ok=True)
+        with open(tempPath, 'wb') as file:
+            pickle.dump(header, file, protocol=pickle.HIGHEST_PROTOCOL)
+            pickle.dump(problem, file, protocol=pickle.HIGHEST_PROTOCOL)
+        # Replace atomically so that other processes never see a half-written cache
+        os.replace(tempPath, cachePath)
+    except OSError as err:
+        # Not being able to cache (e.g. a read-only directory) shouldn't stop the problem loading
+        print("Could not write problem cache", cachePath, "(" + str(err) + ")")
+        if os.path.exists(tempPath):
+            os.remove(tempPath)
+
+
+def clearCache(filename, cacheDir=None):
+    # Remove the cached parse of a problem file, if there is one
+    cachePath = cacheFilename(filename, cacheDir)
+    if os.path.exists(cachePath):
+        os.remove(cachePath)
+
+
+def _uniqueSources(problem):
+    return list(dict.fromkeys(problem.sourceFiles))
+
+
+def _fileStamp(path):
+    stat = os.stat(path)
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+def _fileDigest(path):
+    with open(path, 'rb') as file:
+        return hashlib.sha256(file.read()).hexdigest()
+
+
+def _sourceUnchanged(path, stamp, digest):
+    # A matching modification time and size is taken on trust; otherwise fall back on comparing contents,
+    # so that e.g. checking out or touching an unchanged file doesn't throw the cache away
+    try:
+        if _fileStamp(path) == stamp:
+            return True
+        return _fileDigest(path) == digest
+    except OSError:
+        return False
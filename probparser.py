@@ -0,0 +1,380 @@
+# Parser for the lines of .prob files
+# A hand-written tokenizer and shunting-yard expression parser, which builds expression trees in a single pass over each line
+# See docs/problem_syntax.md for the syntax itself
+
+import math
+import re
+import string
+
+from expressions import FixedValue, ProductExpression, SumExpression, PowerExpression, \
+    DifferenceExpression, QuotientExpression, TanExpression, CosExpression, SinExpression, Constant
+
+# Constants
+constantMap = {
+  "pi": Constant("pi", math.pi),
+  "e": Constant("e", math.e)
+}
+
+# Define mapping from binary operator symbols to composite expression classes
+binaryOperatorMap = {
+    '+': SumExpression,
+    '-': DifferenceExpression,
+    '*': ProductExpression,
+    '/': QuotientExpression,
+    '^': PowerExpression
+}
+
+# Likewise for unary operators
+unaryOperatorMap = {
+    'sin': SinExpression,
+    'cos': CosExpression,
+    'tan': TanExpression
+}
+
+# Binding strength of each binary operator, and whether it groups to the right (a^b^c = a^(b^c)) rather than the left
+binaryPrecedence = {
+    '+': (1, False),
+    '-': (1, False),
+    '*': (2, False),
+    '/': (2, False),
+    '^': (4, True)
+}
+# Unary minus binds more tightly than everything but ^, so -a*b = (-a)*b but -a^2 = -(a^2)
+UNARY_PRECEDENCE = 3
+# Stands for unary minus among the pending operators while parsing an expression
+_NEGATE = "negate"
+
+# Tokens are the text of each match: names (possibly dotted, e.g. object.variable), symbols, numbers, strings, comments,
+# and any other single character (which is an error), with the whitespace between them skipped over
+# A token's kind is told by its first character, so tokenizing a line is a single findall, making plain strings
+# Order matters: longer symbols must come before their prefixes (e.g. "==" before "=")
+_tokenPattern = re.compile(r"""
+    [A-Za-z_][A-Za-z0-9_]*(?:\.[A-Za-z_][A-Za-z0-9_]*)*  # name
+  | :=|==|[-+*/^()={},~]                                # symbol
+  | (?:[0-9]+(?:\.[0-9]*)?|\.[0-9]+)(?:[eE][-+]?[0-9]+)? # number
+  | "[^"]*"                                             # string
+  | \#.*                                                # comment
+  | \S                                                  # anything else is an error
+  """, re.VERBOSE | re.DOTALL)
+_NAME_STARTS = frozenset(string.ascii_letters + "_")
+_NUMBER_STARTS = frozenset(string.digits + ".")
+# Marks the end of a line (or the comment at the end of it)
+_END = ""
+
+
+class ProbSyntaxError(Exception):
+    # An error in the syntax of a line, with the (0-based) character position it was found at
+    def __init__(self, message, column=None):
+        super(ProbSyntaxError, self).__init__(message)
+        self.column = column
+
+
+def tokenize(text):
+    """
+    Split a line into tokens (bad characters are tokens too - the parser deals with them)
+    :return: a list of token strings, ending with _END (which replaces a comment, if there is one)
+    """
+    tokens = _tokenPattern.findall(text)
+    if tokens and tokens[-1][0] == "#":
+        tokens[-1] = _END
+    else:
+        tokens.append(_END)
+    return tokens
+
+
+def _applyOperator(operator, operands):
+    # Replace the operand(s) on top of the stack with a binary operator or negation applied to them
+    if operator is _NEGATE:
+        operand = operands[-1]
+        if isinstance(operand, FixedValue):
+            # Fold negative numbers into a single value
+            operands[-1] = FixedValue(-operand.value)
+        else:
+            operands[-1] = ProductExpression(FixedValue(-1.0), operand)
+    else:
+        rhs = operands.pop()
+        operands[-1] = binaryOperatorMap[operator](operands[-1], rhs)
+
+
+def isName(token):
+    return token[:1] in _NAME_STARTS
+
+
+def isString(token):
+    # N.B. A lone " is a bad character, not a string
+    return token[:1] == '"' and len(token) > 1
+
+
+class LineParser:
+    """
+    Parses single lines of a .prob file
+    Each line is one of:
+      ("constraint", lhs, rhs, title)  - an equation, with title None if not given
+      ("varinit", name, expr)          - a variable initialisation (:=)
+      ("constdef", name, expr)         - a symbolic constant definition (==)
+      ("distribution", name, kind, args) - a distribution of a variable's values (~), with args a list of numbers and
+                                       strings (see montecarlo.py)
+      ("import", filename, alias)      - an import of another file, with alias None if not given
+      ("class", name)                  - the start of a class definition, whose body runs until...
+      ("end",)                         - ...a closing brace
+      ("object", className, name, params) - an object instantiation, with params a list of (variable name, expr)
+    or None for a blank or comment-only line
+    Syntax errors are raised as ProbSyntaxError
+    """
+    def __init__(self, findVar):
+        """
+        :param findVar: function taking a variable name and returning the (possibly new) variable expression for it
+        """
+        self.findVar = findVar
+        self.text = ""
+        self.tokens = [_END]
+        self.pos = 0
+        # Numbers, by their text - FixedValues never change, so each number only needs making once
+        self.numbers = {}
+
+    def parseLine(self, text):
+        self.text = text
+        self.tokens = tokens = tokenize(text)
+        self.pos = 0
+        first = tokens[0]
+        if not first:
+            return None
+        second = tokens[1]
+        if first[0] in _NAME_STARTS:
+            if second == ':=':
+                self.pos = 2
+                return ("varinit", first, self.parseWholeExpression())
+            elif second == '==':
+                self.pos = 2
+                return ("constdef", first, self.parseWholeExpression())
+            elif second == '~':
+                return self.parseDistribution()
+            elif second == '(' and first == "import":
+                return self.parseImport()
+            elif second[:1] in _NAME_STARTS:
+                if first == "class":
+                    return self.parseClass()
+                return self.parseObject()
+        elif first == '}':
+            self.pos = 1
+            self.expectEnd()
+            return ("end",)
+        lhs = self.parseExpression()
+        self.expectSymbol('=')
+        rhs = self.parseExpression()
+        title = None
+        if isString(tokens[self.pos]):
+            title = self.expectString()
+        self.expectEnd()
+        return ("constraint", lhs, rhs, title)
+
+    def parseImport(self):
+        # import("filename"), optionally followed by: as alias
+        self.pos = 2
+        filename = self.expectString()
+        self.expectSymbol(')')
+        alias = None
+        if self.tokens[self.pos] == "as":
+            self.pos += 1
+            alias = self.expectName()
+            if "." in alias:
+                self.pos -= 1
+                self.fail("an undotted name")
+        self.expectEnd()
+        return ("import", filename, alias)
+
+    def parseDistribution(self):
+        # name ~ kind(arg1, arg2...), where each argument is a string or a constant expression
+        self.pos = 2
+        kind = self.expectName().lower()
+        self.expectSymbol('(')
+        args = []
+        while self.tokens[self.pos] != ')':
+            if isString(self.tokens[self.pos]):
+                args.append(self.expectString())
+            else:
+                argPos = self.pos
+                value = self.parseExpression().getValue(None)
+                if value is None:
+                    self.pos = argPos
+                    self.fail("a number or a string")
+                args.append(value)
+            if self.tokens[self.pos] != ',':
+                break
+            self.pos += 1
+        self.expectSymbol(')')
+        self.expectEnd()
+        return ("distribution", self.tokens[0], kind, args)
+
+    def parseClass(self):
+        # class Name {
+        self.pos = 1
+        name = self.expectName()
+        self.expectSymbol('{')
+        self.expectEnd()
+        return ("class", name)
+
+    def parseObject(self):
+        # ClassName objectName, optionally followed by parameters: (var1 = expr1, var2 = expr2...)
+        self.pos = 0
+        className = self.expectName()
+        name = self.expectName()
+        params = []
+        if self.tokens[self.pos] == '(':
+            self.pos += 1
+            while True:
+                paramName = self.expectName()
+                self.expectSymbol('=')
+                params.append((paramName, self.parseExpression()))
+                if self.tokens[self.pos] != ',':
+                    break
+                self.pos += 1
+            self.expectSymbol(')')
+        self.expectEnd()
+        return ("object", className, name, params)
+
+    def parseFormula(self, text):
+        # Parse text that's just an expression (e.g. a metric to differentiate), rather than a whole line
+        self.text = text
+        self.tokens = tokenize(text)
+        self.pos = 0
+        return self.parseWholeExpression()
+
+    def parseWholeExpression(self):
+        # An expression that must run to the end of the line
+        expr = self.parseExpression()
+        self.expectEnd()
+        return expr
+
+    def parseExpression(self):
+        """
+        An expression, running up to the first token that can't continue it (e.g. '=' or the end of the line)
+        Shunting-yard: operands and pending operators are kept on stacks, and each operator is applied as soon as the
+        next one binds no more tightly than it (or at a closing bracket, or the end of the expression), all in one loop
+        rather than with a recursive call per operand and operator
+        """
+        tokens = self.tokens
+        pos = self.pos
+        numbers = self.numbers
+        operands = []
+        # Pending operators, as (precedence, operator): a binary operator symbol, _NEGATE, or for an open bracket,
+        # precedence -1 and the function it's the argument of (or None)
+        operators = []
+        openBrackets = 0
+        while True:
+            # Expecting an operand (or something that starts one)
+            token = tokens[pos]
+            pos += 1
+            first = token[:1]
+            if first in _NAME_STARTS:
+                lowerName = token.lower()
+                if tokens[pos] == '(' and lowerName in unaryOperatorMap:
+                    operators.append((-1, unaryOperatorMap[lowerName]))
+                    openBrackets += 1
+                    pos += 1
+                    continue
+                elif lowerName in constantMap:
+                    operands.append(constantMap[lowerName])
+                else:
+                    try:
+                        operands.append(self.findVar(token))
+                    except ProbSyntaxError as err:
+                        # findVar doesn't know where in the line the name was
+                        if err.column is None:
+                            err.column = self.column(pos - 1)
+                        raise
+            elif first in _NUMBER_STARTS and token != ".":
+                number = numbers.get(token)
+                if number is None:
+                    number = numbers[token] = FixedValue(float(token))
+                operands.append(number)
+            elif token == '(':
+                operators.append((-1, None))
+                openBrackets += 1
+                continue
+            elif token == '-':
+                operators.append((UNARY_PRECEDENCE, _NEGATE))
+                continue
+            elif token == '+':
+                continue
+            else:
+                self.pos = pos - 1
+                self.fail("a number, name or '('")
+            # Expecting a binary operator, a closing bracket or the end of the expression
+            while True:
+                token = tokens[pos]
+                if token in binaryPrecedence:
+                    (precedence, rightAssociative) = binaryPrecedence[token]
+                    while operators:
+                        (topPrecedence, operator) = operators[-1]
+                        if topPrecedence < precedence or (topPrecedence == precedence and rightAssociative):
+                            break
+                        del operators[-1]
+                        if operator is _NEGATE:
+                            _applyOperator(operator, operands)
+                        else:
+                            rhs = operands.pop()
+                            operands[-1] = binaryOperatorMap[operator](operands[-1], rhs)
+                    operators.append((precedence, token))
+                    pos += 1
+                    break
+                elif token == ')' and openBrackets:
+                    (precedence, operator) = operators.pop()
+                    while precedence >= 0:
+                        _applyOperator(operator, operands)
+                        (precedence, operator) = operators.pop()
+                    if operator is not None:
+                        operands[-1] = operator(operands[-1])
+                    openBrackets -= 1
+                    pos += 1
+                else:
+                    self.pos = pos
+                    if openBrackets:
+                        self.fail(repr(')'))
+                    while operators:
+                        _applyOperator(operators.pop()[1], operands)
+                    return operands[0]
+
+    def expectSymbol(self, symbol):
+        # Consume the next token, which must be the given symbol
+        if self.tokens[self.pos] != symbol:
+            self.fail(repr(symbol))
+        self.pos += 1
+
+    def expectName(self):
+        # Consume the next token, which must be a name, and return it
+        token = self.tokens[self.pos]
+        if not isName(token):
+            self.fail("a name")
+        self.pos += 1
+        return token
+
+    def expectString(self):
+        # Consume the next token, which must be a string, and return its contents
+        token = self.tokens[self.pos]
+        if not isString(token):
+            self.fail("a string")
+        self.pos += 1
+        return token[1:-1]
+
+    def expectEnd(self):
+        if self.tokens[self.pos]:
+            self.fail("the end of the line")
+
+    def fail(self, expected):
+        # Raise an error about the current token, giving the position in the line it was found at
+        token = self.tokens[self.pos]
+        if not token:
+            found = "the end of the line"
+        elif isString(token):
+            found = "the string " + token
+        else:
+            found = "'" + token + "'"
+        raise ProbSyntaxError("expected " + expected + " but found " + found, self.column(self.pos))
+
+    def column(self, tokenIndex):
+        # Character position of a token in the line (only needed for error messages, so work it out the slow way)
+        for (i, match) in enumerate(_tokenPattern.finditer(self.text)):
+            if i == tokenIndex:
+                return match.start()
+        return len(self.text.rstrip())
@@ -0,0 +1,271 @@
+# Export of solver results to disk
+# Rows of results are buffered into chunks and each chunk is written out as soon as it fills up,
+# so long sweeps can be streamed to disk while they run rather than held in memory until the end
+
+from abc import abstractmethod
+from abc import ABCMeta
+import csv
+import os
+import zipfile
+
+import numpy as np
+
+from equationsolver import Context, STATUSES, STATUS_SOLVED
+
+# Number of rows held in memory before they are written to disk
+DEFAULT_CHUNK_SIZE = 10000
+# Name of the column holding the solver status of each row
+STATUS_COLUMN = "status"
+
+
+class ResultWriter(metaclass=ABCMeta):
+    """
+    Base class for writers of solver results
+    Each row of results is a value for every one of a fixed list of variable names, plus the status of the solve
+    Variables without a value (e.g. from a failed solve) are stored as NaN
+    """
+    def __init__(self, filename, fieldnames, chunkSize=DEFAULT_CHUNK_SIZE):
+        self.filename = filename
+        self.fieldnames = list(fieldnames)
+        self.chunkSize = chunkSize
+        # Number of rows written to disk so far
+        self.numRows = 0
+        self.closed = False
+        # Rows waiting to be written out
+        self._pendingValues = []
+        self._pendingStatuses = []
+
+    def writeRow(self, values, status=STATUS_SOLVED):
+        """
+        Add a row of results, writing out the current chunk if it is full
+        :param values: a Context, or a dict of variable names to values
+        :param status: the status of the solve that gave these values (one of equationsolver.STATUSES)
+        """
+        if isinstance(values, Context):
+            values = values.varVals
+        self._pendingValues.append([_toFloat(values.get(name)) for name in self.fieldnames])
+        self._pendingStatuses.append(STATUSES.index(status))
+        if len(self._pendingValues) >= self.chunkSize:
+            self.flush()
+
+    def writeRows(self, rows):
+        # Add rows of (values, status) tuples, e.g. as generated by batchsolver.sweep
+        for (values, status) in rows:
+            self.writeRow(values, status)
+
+    def writeChunk(self, values, statuses):
+        """
+        Write a whole chunk of results straight to disk, e.g. from a vectorised solve
+        :param values: 2D array with a row per result and a column per field name
+        :param statuses: 1D array of status codes (indices into equationsolver.STATUSES), one per row
+        """
+        self.flush()
+        values = np.asarray(values, dtype=float).reshape(-1, len(self.fieldnames))
+        statuses = np.asarray(statuses, dtype=np.int8)
+        self._writeChunk(values, statuses)
+        self.numRows += len(values)
+
+    def flush(self):
+        # Write out any rows waiting in the current chunk
+        if self._pendingValues:
+            values = np.array(self._pendingValues, dtype=float).reshape(-1, len(self.fieldnames))
+            statuses = np.array(self._pendingStatuses, dtype=np.int8)
+            self._pendingValues = []
+            self._pendingStatuses = []
+            self._writeChunk(values, statuses)
+            self.numRows += len(values)
+
+    def close(self):
+        if not self.closed:
+            self.flush()
+            self._finish()
+            self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+
+    @abstractmethod
+    def _writeChunk(self, values, statuses):
+        pass
+
+    @abstractmethod
+    def _finish(self):
+        pass
+
+
+class CSVResultWriter(ResultWriter):
+    # Plain text output, with a status column followed by a column per variable
+    def __init__(self, filename, fieldnames, chunkSize=DEFAULT_CHUNK_SIZE):
+        super(CSVResultWriter, self).__init__(filename, fieldnames, chunkSize)
+        self.file = open(filename, 'w', newline='')
+        self.writer = csv.writer(self.file)
+        self.writer.writerow([STATUS_COLUMN] + self.fieldnames)
+
+    def _writeChunk(self, values, statuses):
+        # Missing values are left blank, as they always have been in exported CSVs
+        cells = np.where(np.isnan(values), None, values).tolist()
+        self.writer.writerows([STATUSES[status]] + row for (status, row) in zip(statuses.tolist(), cells))
+        self.file.flush()
+
+    def _finish(self):
+        self.file.close()
+
+
+class NPYResultWriter(ResultWriter):
+    """
+    Binary output as a NumPy .npy file holding a 1D structured array, with a status field and a float field per variable
+    The file is valid after every chunk has been written, and can be read back memory-mapped with loadResults
+    """
+    def __init__(self, filename, fieldnames, chunkSize=DEFAULT_CHUNK_SIZE):
+        super(NPYResultWriter, self).__init__(filename, fieldnames, chunkSize)
+        self.dtype = resultDtype(self.fieldnames)
+        self.file = open(filename, 'w+b')
+        # The array length isn't known until we finish, so leave room in the header to rewrite it
+        self.headerLength = len(_npyHeader(self.dtype, _MAX_ROWS))
+        self._writeHeader()
+
+    def _writeHeader(self):
+        self.file.seek(0)
+        self.file.write(_npyHeader(self.dtype, self.numRows, self.headerLength))
+        self.file.seek(0, os.SEEK_END)
+
+    def _writeChunk(self, values, statuses):
+        chunk = np.empty(len(values), dtype=self.dtype)
+        chunk[STATUS_COLUMN] = statuses
+        for (i, name) in enumerate(self.fieldnames):
+            chunk[name] = values[:, i]
+        self.file.write(chunk.tobytes())
+
+    def flush(self):
+        super(NPYResultWriter, self).flush()
+        # Keep the header up to date so that partial results can be read while a sweep is still running
+        self._writeHeader()
+        self.file.flush()
+
+    def _finish(self):
+        self.file.close()
+
+
+class NPZResultWriter(ResultWriter):
+    """
+    Binary output as a NumPy .npz archive, with an array per variable plus one of status codes
+    Rows are streamed to a temporary .npy file as they arrive and only gathered into the archive on closing
+    """
+    def __init__(self, filename, fieldnames, chunkSize=DEFAULT_CHUNK_SIZE, compress=False):
+        super(NPZResultWriter, self).__init__(filename, fieldnames, chunkSize)
+        self.compress = compress
+        self.tempFilename = filename + ".partial.npy"
+        self.tempWriter = NPYResultWriter(self.tempFilename, self.fieldnames, chunkSize)
+
+    def _writeChunk(self, values, statuses):
+        self.tempWriter.writeChunk(values, statuses)
+
+    def _finish(self):
+        self.tempWriter.close()
+        rows = np.load(self.tempFilename, mmap_mode='r')
+        # Written member by member, as np.savez would, rather than through np.savez itself - which takes the arrays as
+        # keyword arguments, so variables called e.g. "file" or "allow_pickle" would clash with its own parameters
+        compression = zipfile.ZIP_DEFLATED if self.compress else zipfile.ZIP_STORED
+        with zipfile.ZipFile(self.filename, 'w', compression=compression, allowZip64=True) as archive:
+            for name in [STATUS_COLUMN] + self.fieldnames:
+                with archive.open(name + ".npy", 'w', force_zip64=True) as member:
+                    np.lib.format.write_array(member, np.ascontiguousarray(rows[name]), allow_pickle=False)
+        del rows
+        os.remove(self.tempFilename)
+
+
+class ParquetResultWriter(ResultWriter):
+    # Columnar output via pyarrow (if it's installed), with one row group per chunk
+    def __init__(self, filename, fieldnames, chunkSize=DEFAULT_CHUNK_SIZE):
+        super(ParquetResultWriter, self).__init__(filename, fieldnames, chunkSize)
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError("Writing Parquet files requires pyarrow to be installed")
+        self.pyarrow = pyarrow
+        fields = [pyarrow.field(STATUS_COLUMN, pyarrow.dictionary(pyarrow.int8(), pyarrow.string()))]
+        fields.extend(pyarrow.field(name, pyarrow.float64()) for name in self.fieldnames)
+        self.schema = pyarrow.schema(fields)
+        self.writer = pyarrow.parquet.ParquetWriter(filename, self.schema)
+
+    def _writeChunk(self, values, statuses):
+        pa = self.pyarrow
+        columns = [pa.DictionaryArray.from_arrays(pa.array(statuses, type=pa.int8()), pa.array(STATUSES))]
+        columns.extend(pa.array(values[:, i]) for i in range(len(self.fieldnames)))
+        self.writer.write_table(pa.Table.from_arrays(columns, schema=self.schema))
+
+    def _finish(self):
+        self.writer.close()
+
+
+# Mapping from file extensions to the writer used for them
+RESULT_WRITERS = {
+    '.csv': CSVResultWriter,
+    '.npy': NPYResultWriter,
+    '.npz': NPZResultWriter,
+    '.parquet': ParquetResultWriter
+}
+
+
+def writerForFilename(filename, fieldnames, **kwargs):
+    # Make a result writer of the right type for the extension of the given file name
+    extension = os.path.splitext(filename)[1].lower()
+    if extension not in RESULT_WRITERS:
+        raise ValueError("Don't know how to write results to a " + extension + " file (" + filename + ")")
+    return RESULT_WRITERS[extension](filename, fieldnames, **kwargs)
+
+
+def loadResults(filename, mmap=True):
+    """
+    Read back results written by one of the binary writers
+    :param mmap: for .npy files, map the file into memory rather than reading it all in
+    :return: a structured array (.npy), a dict-like NpzFile of arrays (.npz) or a pyarrow Table (.parquet)
+    """
+    extension = os.path.splitext(filename)[1].lower()
+    if extension == '.npy':
+        return np.load(filename, mmap_mode='r' if mmap else None)
+    elif extension == '.npz':
+        return np.load(filename)
+    elif extension == '.parquet':
+        import pyarrow.parquet
+        return pyarrow.parquet.read_table(filename)
+    else:
+        raise ValueError("Can't load results from a " + extension + " file (" + filename + ")")
+
+
+def resultDtype(fieldnames):
+    # The structured array type used for a row of results
+    return np.dtype([(STATUS_COLUMN, np.int8)] + [(name, np.float64) for name in fieldnames])
+
+
+def statusNames(statusCodes):
+    # Turn an array of status codes back into status strings
+    return [STATUSES[code] for code in np.asarray(statusCodes).tolist()]
+
+
+def _toFloat(value):
+    return np.nan if value is None else float(value)
+
+
+# Largest row count we leave room for in a .npy header
+_MAX_ROWS = 2**63 - 1
+
+
+def _npyHeader(dtype, numRows, length=None):
+    """
+    Make a .npy file header (format version 1.0, or 2.0 for very long headers) for a 1D array
+    :param length: pad the header out to exactly this many bytes, so that it can be rewritten in place later
+    """
+    header = "{'descr': " + repr(np.lib.format.dtype_to_descr(dtype)) + ", 'fortran_order': False, 'shape': (" + str(numRows) + ",), }"
+    version = 1 if len(header) < 65000 else 2
+    prefixLength = 10 if version == 1 else 12
+    if length is None:
+        # Round up to a multiple of 64 bytes, as NumPy itself does, allowing for the terminating newline
+        length = -(-(prefixLength + len(header) + 1) // 64) * 64
+    header = header.ljust(length - prefixLength - 1) + "\n"
+    sizeBytes = (len(header)).to_bytes(2 if version == 1 else 4, 'little')
+    return np.lib.format.MAGIC_PREFIX + bytes([version, 0]) + sizeBytes + header.encode('latin1')
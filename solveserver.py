@@ -0,0 +1,352 @@
+# Long-running solve server, which keeps problems loaded so that clients don't pay for startup and parsing per solve
+# Clients send requests as JSON objects, one per line, over a local Unix socket (or the server's stdin, e.g. for tests),
+# and get one JSON line back per request. Parsed problems stay in memory - along with their tapes and the numerical
+# methods that worked for each block (see portfolio.py) - as does the last solution of each problem, which is the
+# starting point for numerical solving in the next solve of it (a warm start), and the plan of its last complete solve
+# with each set of inputs, which later solves with the same inputs follow rather than sequencing the problem again
+# (see Problem.solvePlan). A problem is reloaded when its file, or any file it imports, changes.
+# Requests are pipelined: a client can send many without waiting, and they're solved concurrently in a thread pool,
+# so responses may come back in a different order - each has the "id" of its request.
+#
+# Requests ("id" is optional, and just copied into the response):
+#   {"op": "load", "problem": "examples/masses.prob"}   (re)load a problem, giving its variable names
+#   {"op": "solve", "problem": ..., "inputs": {"mass1.m": 5}, "warmStart": true, "budget": {"maxSeconds": 1}}
+#   {"op": "batch", "problem": ..., "rows": [{...}, {...}], "warmStart": true, "budget": {...}}
+#   {"op": "sensitivity", "problem": ..., "inputs": {...}, "metric": "total_weight"}   (see autodiff.py)
+#   {"op": "ping"}, {"op": "shutdown"}
+# Inputs are on top of the problem's default values; null makes a variable an output.
+# Responses have "ok": true with the results, or "ok": false with an "error" message.
+# Run with: python solveserver.py --socket PATH  (or --stdio) [--workers N] [--quiet] [problem files to preload...]
+
+import argparse
+import concurrent.futures
+import json
+import os
+import socket
+import socketserver
+import sys
+import threading
+
+from autodiff import solveWithGradient
+from budgets import SolveBudget
+from equationsolver import STATUS_SOLVED, STATUS_BUDGET_EXCEEDED, STATUS_CANCELLED
+from probcache import loadProblem
+
+# The budget limits a request may set (see budgets.SolveBudget)
+BUDGET_LIMITS = ["maxSeconds", "maxEvaluations", "maxIterations", "blockSeconds", "blockEvaluations", "blockIterations"]
+DEFAULT_WORKERS = 4
+
+
+class RequestError(Exception):
+    # Something wrong with a request, reported back to the client
+    pass
+
+
+def toJSON(value):
+    # Solved values may be numpy scalars or arrays
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if hasattr(value, "tolist"):
+        return value.tolist()
+    return float(value)
+
+
+class SolveServer:
+    """
+    Answers requests (see the top of this file) against problems kept loaded in memory
+    Safe to use from many threads at once
+    """
+    def __init__(self, useCache=True, workers=DEFAULT_WORKERS):
+        """
+        :param useCache: load problems through the on-disk parse cache (see probcache.py)
+        :param workers: number of requests to solve at once
+        """
+        self.useCache = useCache
+        self.workers = workers
+        self.lock = threading.Lock()
+        # Loaded problems, by absolute filename, as (stamps of its source files when it was loaded, problem, its
+        # variable names - which are worked out once, rather than per request)
+        self.problems = {}
+        # The last solution of each problem, for warm starts
+        self.warmStarts = {}
+        # The plans of complete solves of each problem, by the names of the variables given values
+        self.plans = {}
+        self.stopped = threading.Event()
+        # Called (with no arguments) when a shutdown request has been answered
+        self.onShutdown = None
+
+    def getProblem(self, filename, reload=False):
+        # The loaded problem, loading it first if it's new or its file has changed since it was loaded
+        if not isinstance(filename, str):
+            raise RequestError("no problem file given")
+        path = os.path.abspath(filename)
+        if not os.path.isfile(path):
+            raise RequestError("can't read problem file " + filename)
+        with self.lock:
+            loaded = self.problems.get(path)
+        # Checking every source file, so that a change to an imported file is picked up too
+        if loaded is not None and loaded[0] == loaded[1].getSourceStamps() and not reload:
+            return (path,) + loaded[1:]
+        problem = loadProblem(path, self.useCache)
+        names = problem.getVariableNames()
+        stamps = problem.getSourceStamps()
+        with self.lock:
+            # Another request may have loaded the same files meanwhile, and already kept warm starts and plans for them
+            loaded = self.problems.get(path)
+            if loaded is not None and loaded[0] == stamps and not reload:
+                return (path,) + loaded[1:]
+            self.problems[path] = (stamps, problem, names)
+            self.warmStarts.pop(path, None)
+            self.plans.pop(path, None)
+        return (path, problem, names)
+
+    def makeContext(self, problem, names, inputs):
+        # The problem's default context with the given inputs
+        if not isinstance(inputs, dict):
+            raise RequestError("inputs must be an object mapping variable names to values")
+        unknown = sorted(set(inputs) - set(names))
+        if unknown:
+            raise RequestError("unknown variable(s): " + ", ".join(unknown))
+        context = problem.defaultContext.copy()
+        context.varVals.update(inputs)
+        return context
+
+    def makeBudget(self, request):
+        limits = request.get("budget")
+        if limits is None:
+            return None
+        if not isinstance(limits, dict) or any(name not in BUDGET_LIMITS for name in limits):
+            raise RequestError("budget limits must be some of: " + ", ".join(BUDGET_LIMITS))
+        return SolveBudget(**limits)
+
+    def getRefContext(self, path, request):
+        if not request.get("warmStart", True):
+            return False
+        with self.lock:
+            return self.warmStarts.get(path, False)
+
+    def solveContext(self, path, problem, context, refContext, budget):
+        # Solve, following the plan of an earlier complete solve with the same variables given values if there is one
+        # (and solving from scratch if following it fails, other than by being stopped, so the result is just as a fresh
+        # solve would give)
+        key = frozenset(name for (name, value) in context.varVals.items() if value is not None)
+        with self.lock:
+            plan = self.plans.get(path, {}).get(key)
+        result = None
+        if plan is not None:
+            start = context.copy()
+            result = problem.solvePlan(plan, context, refContext, budget)
+            if not result and result.status not in (STATUS_BUDGET_EXCEEDED, STATUS_CANCELLED):
+                context.varVals.clear()
+                context.varVals.update(start.varVals)
+                result = None
+        if result is None:
+            result = problem.solve(context, refContext, budget)
+        if result.status == STATUS_SOLVED:
+            with self.lock:
+                self.plans.setdefault(path, {})[key] = result.plan
+        return result
+
+    def describeResult(self, names, result):
+        # A SolveResult as JSON, with the values of just the problem's variables (not its constants)
+        return {"status": result.status,
+                "values": {name: toJSON(result.values.get(name)) for name in names},
+                "freeVars": list(result.freeVars), "diagnosis": result.diagnosis, "seconds": result.seconds}
+
+    def solve(self, request):
+        (path, problem, names) = self.getProblem(request.get("problem"))
+        context = self.makeContext(problem, names, request.get("inputs", {}))
+        result = self.solveContext(path, problem, context, self.getRefContext(path, request), self.makeBudget(request))
+        if result:
+            with self.lock:
+                self.warmStarts[path] = context
+        return self.describeResult(names, result)
+
+    def batch(self, request):
+        # Solve each row in turn, each warm-started from the last solution, as in batchsolver.sweep
+        (path, problem, names) = self.getProblem(request.get("problem"))
+        rows = request.get("rows")
+        if not isinstance(rows, list):
+            raise RequestError("rows must be a list of inputs")
+        contexts = [self.makeContext(problem, names, inputs) for inputs in rows]
+        budget = self.makeBudget(request)
+        refContext = self.getRefContext(path, request)
+        results = []
+        for context in contexts:
+            result = self.solveContext(path, problem, context, refContext, budget)
+            if result and request.get("warmStart", True):
+                refContext = context
+            results.append(self.describeResult(names, result))
+        if refContext:
+            with self.lock:
+                self.warmStarts[path] = refContext
+        return {"results": results}
+
+    def sensitivity(self, request):
+        # Solve, then give the gradient of a metric with respect to every input
+        (path, problem, names) = self.getProblem(request.get("problem"))
+        metric = request.get("metric")
+        if not isinstance(metric, str):
+            raise RequestError("no metric given")
+        context = self.makeContext(problem, names, request.get("inputs", {}))
+        (solved, gradient) = solveWithGradient(problem, context, metric, self.getRefContext(path, request))
+        if not solved:
+            raise RequestError("couldn't solve the problem with these inputs")
+        return {"values": {name: toJSON(context.varVals.get(name)) for name in names},
+                "gradient": {name: toJSON(value) for (name, value) in gradient.items()}}
+
+    def load(self, request):
+        (path, problem, names) = self.getProblem(request.get("problem"), reload=True)
+        return {"variables": names}
+
+    def handle(self, request):
+        """
+        Answer one request
+        :param request: dict (see the top of this file)
+        :return: the response, as a dict
+        """
+        ops = {"solve": self.solve, "batch": self.batch, "sensitivity": self.sensitivity, "load": self.load,
+               "ping": lambda request: {}}
+        if not isinstance(request, dict):
+            return {"id": None, "ok": False, "error": "requests must be JSON objects"}
+        response = {"id": request.get("id")}
+        try:
+            op = ops.get(request.get("op"))
+            if op is None:
+                raise RequestError("unknown op " + repr(request.get("op")) + " (should be one of: " + ", ".join(sorted(ops) + ["shutdown"]) + ")")
+            response.update(op(request))
+            response["ok"] = True
+        except RequestError as err:
+            response.update(ok=False, error=str(err))
+        except Exception as err:
+            # Anything else going wrong (e.g. a syntax error in the problem file) only fails this request
+            response.update(ok=False, error=type(err).__name__ + ": " + str(err))
+        return response
+
+    def serveLines(self, lines, write):
+        """
+        Answer a stream of requests, solving up to self.workers of them at once
+        :param lines: iterable of request lines (str)
+        :param write: function taking one response line (str), called from any thread (one at a time)
+        """
+        writeLock = threading.Lock()
+
+        def respond(response):
+            text = json.dumps(response) + "\n"
+            with writeLock:
+                write(text)
+
+        with concurrent.futures.ThreadPoolExecutor(self.workers) as executor:
+            pending = []
+            for line in lines:
+                if not line.strip():
+                    continue
+                try:
+                    request = json.loads(line)
+                except ValueError as err:
+                    respond({"id": None, "ok": False, "error": "bad JSON: " + str(err)})
+                    continue
+                if isinstance(request, dict) and request.get("op") == "shutdown":
+                    # Finish what's in flight first
+                    concurrent.futures.wait(pending)
+                    respond({"id": request.get("id"), "ok": True})
+                    self.stopped.set()
+                    if self.onShutdown is not None:
+                        self.onShutdown()
+                    break
+                pending = [future for future in pending if not future.done()]
+                pending.append(executor.submit(lambda request=request: respond(self.handle(request))))
+
+    def serveStdio(self, infile=None, outfile=None):
+        # Answer requests from stdin on stdout; anything else printed (e.g. solving progress) goes to stderr
+        infile = infile or sys.stdin
+        outfile = outfile or sys.stdout
+        stdout = sys.stdout
+        sys.stdout = sys.stderr
+        try:
+            self.serveLines(infile, lambda text: (outfile.write(text), outfile.flush()))
+        finally:
+            sys.stdout = stdout
+
+    def serveSocket(self, path):
+        # Answer requests from any number of clients connecting to a Unix socket at path, until shut down
+        server = UnixSolveServer(path, self)
+        self.onShutdown = lambda: threading.Thread(target=server.shutdown).start()
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+            os.unlink(path)
+
+
+class SolveRequestHandler(socketserver.StreamRequestHandler):
+    # One client connection
+    def handle(self):
+        self.server.solveServer.serveLines((line.decode("utf-8") for line in self.rfile),
+                                           lambda text: self.wfile.write(text.encode("utf-8")))
+
+
+class UnixSolveServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, solveServer):
+        self.solveServer = solveServer
+        socketserver.UnixStreamServer.__init__(self, path, SolveRequestHandler)
+
+
+class SolveClient:
+    """
+    Client for a server on a Unix socket
+    request() sends one request and waits for its response; send() and receive() allow pipelining
+    """
+    def __init__(self, path):
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.connect(path)
+        self.rfile = self.socket.makefile("rb")
+        self.nextId = 0
+
+    def send(self, request):
+        # Send a request without waiting for the response, returning its id
+        if "id" not in request:
+            request = dict(request, id=self.nextId)
+            self.nextId += 1
+        self.socket.sendall((json.dumps(request) + "\n").encode("utf-8"))
+        return request["id"]
+
+    def receive(self):
+        # The next response to arrive (not necessarily to the request sent first)
+        line = self.rfile.readline()
+        if not line:
+            raise ConnectionError("solve server closed the connection")
+        return json.loads(line)
+
+    def request(self, request):
+        requestId = self.send(request)
+        response = self.receive()
+        assert response["id"] == requestId, "request() can't be mixed with pipelined requests awaiting responses"
+        return response
+
+    def close(self):
+        self.rfile.close()
+        self.socket.close()
+
+
+if __name__ == "__main__":
+    argParser = argparse.ArgumentParser(description="Eutactic solve server: answers JSON-lines solve requests")
+    transport = argParser.add_mutually_exclusive_group(required=True)
+    transport.add_argument("--socket", help="path of the Unix socket to listen on")
+    transport.add_argument("--stdio", action="store_true", help="answer requests from stdin on stdout")
+    argParser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="number of requests to solve at once")
+    argParser.add_argument("--quiet", action="store_true", help="don't show solving progress")
+    argParser.add_argument("--no-cache", action="store_true", help="always parse problem files, rather than using __probcache__")
+    argParser.add_argument("preload", nargs="*", help="problem files to load straight away")
+    args = argParser.parse_args()
+    if args.quiet:
+        sys.stdout = sys.stderr = open(os.devnull, "w")
+    solveServer = SolveServer(not args.no_cache, args.workers)
+    for filename in args.preload:
+        solveServer.getProblem(filename)
+    if args.stdio:
+        solveServer.serveStdio(sys.stdin, sys.__stdout__)
+    else:
+        solveServer.serveSocket(args.socket)
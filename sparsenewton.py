@@ -0,0 +1,229 @@
+# Newton's method for large blocks of constraints, with sparse Jacobians
+# scipy.optimize.root works with dense Jacobians, whose memory and factorisation time grow as n^2 and n^3 - too much
+# for blocks of thousands of unknowns, where each constraint only refers to a few of them. Here the Jacobian is only
+# ever held in sparse form, so time and memory grow with its number of nonzeros instead. It comes from the tape
+# (see tape.py), either:
+# * exactly, by reverse-mode automatic differentiation (Tape.reverseJacobian), or
+# * by finite differences, perturbing whole groups of variables at once: variables that never appear in the same
+#   constraint can share a perturbation without their effects mixing, so a graph colouring of the variables means only
+#   one batched tape evaluation per colour (usually a handful) rather than one per variable
+# Each Newton step is then a sparse linear solve, by sparse LU or by a Krylov method (GMRES, preconditioned with an
+# incomplete LU factorisation)
+# There's also a dense Newton's method for the opposite case - many instances of the same small block, e.g. an array
+# context (see objects.NIObjectArray and montecarlo.py) - which steps every instance at once (see solveBatch)
+
+import numpy as np
+import scipy.sparse
+import scipy.sparse.linalg
+
+from tape import LOAD_SLOT, STORE
+
+JACOBIAN_REVERSE = "reverse"
+JACOBIAN_COLOURED = "coloured"
+LINEAR_LU = "lu"
+LINEAR_KRYLOV = "krylov"
+
+
+def sparsityPattern(tape, slots):
+    """
+    Which of the variables each constraint refers to, straight from the tape's code
+    :param slots: the tape slots of the variables
+    :return: boolean scipy.sparse.csr_matrix of shape (constraints, len(slots))
+    """
+    columnOfSlot = {slot: column for (column, slot) in enumerate(slots)}
+    (rows, cols) = ([], [])
+    seen = set()
+    # Ops come before the STORE of the residual they belong to
+    pending = []
+    for (op, arg) in tape.code:
+        if op == LOAD_SLOT and arg in columnOfSlot:
+            pending.append(columnOfSlot[arg])
+        elif op == STORE:
+            for column in pending:
+                if (arg, column) not in seen:
+                    seen.add((arg, column))
+                    rows.append(arg)
+                    cols.append(column)
+            pending = []
+    return scipy.sparse.csr_matrix((np.ones(len(rows), dtype=bool), (rows, cols)), shape=(tape.numConstrs, len(slots)))
+
+
+def colourColumns(pattern):
+    """
+    Greedily colour the columns (variables) so that no two columns of the same colour share a row (constraint)
+    :return: array of each column's colour (0, 1, 2...)
+    """
+    pattern = scipy.sparse.csr_matrix(pattern)
+    byColumn = pattern.tocsc()
+    colours = np.full(pattern.shape[1], -1, dtype=int)
+    for column in range(pattern.shape[1]):
+        rows = byColumn.indices[byColumn.indptr[column]:byColumn.indptr[column + 1]]
+        # Colours already taken by columns sharing a row with this one
+        used = set()
+        for row in rows:
+            used.update(colours[pattern.indices[pattern.indptr[row]:pattern.indptr[row + 1]]].tolist())
+        colour = 0
+        while colour in used:
+            colour += 1
+        colours[column] = colour
+    return colours
+
+
+def colouredJacobian(tape, values, slots, pattern, colours, residuals=None):
+    """
+    Finite-difference Jacobian of the residuals with respect to the variables in slots, in sparse form,
+    with one batched evaluation of the tape for every colour of variables at once
+    """
+    x = values[slots]
+    steps = np.sqrt(np.finfo(float).eps) * np.maximum(1.0, np.abs(x))
+    steps = (x + steps) - x
+    numColours = int(colours.max()) + 1 if len(colours) else 0
+    batch = np.repeat(np.asarray(values, dtype=float)[:, np.newaxis], numColours + 1, axis=1)
+    batch[slots, colours + 1] += steps
+    results = tape.evaluate(batch)
+    if residuals is None:
+        residuals = results[:, 0]
+    coo = pattern.tocoo()
+    entries = (results[coo.row, colours[coo.col] + 1] - residuals[coo.row]) / steps[coo.col]
+    return scipy.sparse.csr_matrix((entries, (coo.row, coo.col)), shape=pattern.shape)
+
+
+def linearSolve(jacobian, rhs, method=LINEAR_LU):
+    # Solve jacobian . x = rhs, returning None if it can't be done
+    jacobian = jacobian.tocsc()
+    if method == LINEAR_KRYLOV:
+        try:
+            preconditioner = scipy.sparse.linalg.spilu(jacobian)
+            M = scipy.sparse.linalg.LinearOperator(jacobian.shape, preconditioner.solve)
+        except RuntimeError:
+            M = None
+        (solution, info) = scipy.sparse.linalg.gmres(jacobian, rhs, M=M, atol=0.0, restart=50, maxiter=20)
+        return solution if info == 0 else None
+    try:
+        return scipy.sparse.linalg.splu(jacobian).solve(rhs)
+    except RuntimeError:
+        # Singular
+        return None
+
+
+def solve(tape, values, slots, x0, jacobianMethod=JACOBIAN_REVERSE, linearMethod=LINEAR_LU, tolerance=1e-10, maxIterations=50, verbose=False, shouldStop=None):
+    """
+    Find values of the variables in the given slots that make every residual on the tape zero, by damped Newton iteration
+    :param values: 1D array of every slot's value (the other slots' values are left as they are)
+    :param x0: starting values of the variables being solved for
+    :param tolerance: largest acceptable absolute residual
+    :param shouldStop: optional function checked every iteration, which gives up (unconverged) when it returns True
+    :return: (values of the variables, True if converged else False)
+    """
+    x = np.array(x0, dtype=float)
+    values = np.array(values, dtype=float)
+    if jacobianMethod == JACOBIAN_COLOURED:
+        pattern = sparsityPattern(tape, slots)
+        colours = colourColumns(pattern)
+    values[slots] = x
+    residuals = tape.evaluate(values)
+    for iteration in range(maxIterations):
+        norm = np.linalg.norm(residuals)
+        if verbose:
+            print("  Newton iteration", iteration, "residual norm", norm)
+        if not np.isfinite(norm) or (shouldStop is not None and shouldStop()):
+            return (x, False)
+        if np.max(np.abs(residuals)) <= tolerance:
+            return (x, True)
+        if jacobianMethod == JACOBIAN_COLOURED:
+            jacobian = colouredJacobian(tape, values, slots, pattern, colours, residuals)
+        else:
+            jacobian = tape.reverseJacobian(values)[1][:, slots]
+        step = linearSolve(jacobian, -residuals, linearMethod)
+        if step is None or not np.all(np.isfinite(step)):
+            return (x, False)
+        if np.all(np.abs(step) <= 4.0 * np.finfo(float).eps * np.maximum(1.0, np.abs(x))):
+            # Converged as far as rounding allows (e.g. with large values, whose residuals can't get much below 1e-10)
+            return (x, True)
+        # Backtrack until the residuals actually get smaller
+        fraction = 1.0
+        while True:
+            values[slots] = x + fraction * step
+            newResiduals = tape.evaluate(values)
+            newNorm = np.linalg.norm(newResiduals)
+            if newNorm <= (1.0 - 1e-4 * fraction) * norm or fraction < 1e-4:
+                break
+            fraction /= 2.0
+        x = x + fraction * step
+        residuals = newResiduals
+    return (x, bool(np.max(np.abs(residuals)) <= tolerance))
+
+
+def stackedSolve(jacobians, rhs):
+    # Solve each of a stack of small dense systems jacobians[i] . x[i] = rhs[i], giving NaN for any that are singular
+    try:
+        return np.linalg.solve(jacobians, rhs[..., np.newaxis])[..., 0]
+    except np.linalg.LinAlgError:
+        solutions = np.full(rhs.shape, np.nan)
+        for i in range(len(rhs)):
+            try:
+                solutions[i] = np.linalg.solve(jacobians[i], rhs[i])
+            except np.linalg.LinAlgError:
+                pass
+        return solutions
+
+
+def solveBatch(tape, values, slots, x0, tolerance=1e-10, maxIterations=50, shouldStop=None):
+    """
+    Solve many instances of a small block at once, by damped Newton iteration on all of them together
+    Each iteration takes one batched tape evaluation for every instance's finite-difference Jacobian, and one stacked
+    dense linear solve for every instance's step; instances drop out as they converge (or fail)
+    :param values: 2D array of every slot's values, with one column per instance
+    :param x0: 2D array of starting values of the variables being solved for, with one column per instance
+    :param shouldStop: optional function checked every iteration, which gives up on the instances still unconverged
+        when it returns True
+    :return: (values of the variables, boolean array of which instances converged)
+    """
+    values = np.array(values, dtype=float)
+    x = np.array(x0, dtype=float)
+    (n, count) = x.shape
+    converged = np.zeros(count, dtype=bool)
+    # The instances still being solved
+    active = np.arange(count)
+    columns = np.arange(1, n + 1)
+    for iteration in range(maxIterations + 1):
+        if shouldStop is not None and shouldStop():
+            break
+        xActive = x[:, active]
+        steps = np.sqrt(np.finfo(float).eps) * np.maximum(1.0, np.abs(xActive))
+        steps = (xActive + steps) - xActive
+        # Each instance as it is, then with each variable perturbed in turn, all in one evaluation
+        batch = np.repeat(values[:, np.newaxis, active], n + 1, axis=1)
+        batch[slots] = xActive[:, np.newaxis]
+        batch[slots, columns] += steps
+        results = tape.evaluate(batch.reshape(len(values), -1)).reshape(tape.numConstrs, n + 1, len(active))
+        residuals = results[:, 0]
+        done = np.all(np.abs(residuals) <= tolerance, axis=0)
+        converged[active[done]] = True
+        keep = ~done & np.all(np.isfinite(residuals), axis=0)
+        if iteration == maxIterations or not keep.any():
+            break
+        (active, xActive, results, residuals, steps) = (active[keep], xActive[:, keep], results[..., keep], residuals[:, keep], steps[:, keep])
+        # Jacobians stacked by instance, as (instances, constraints, variables)
+        jacobians = ((results[:, 1:] - residuals[:, np.newaxis]) / steps).transpose(2, 0, 1)
+        step = stackedSolve(jacobians, -residuals.T).T
+        # Singular instances are given up on
+        solvable = np.all(np.isfinite(step), axis=0)
+        (active, xActive, residuals, step) = (active[solvable], xActive[:, solvable], residuals[:, solvable], step[:, solvable])
+        # Instances whose steps are down to rounding have converged as far as they can
+        tiny = np.all(np.abs(step) <= 4.0 * np.finfo(float).eps * np.maximum(1.0, np.abs(xActive)), axis=0)
+        converged[active[tiny]] = True
+        (active, xActive, residuals, step) = (active[~tiny], xActive[:, ~tiny], residuals[:, ~tiny], step[:, ~tiny])
+        # Backtrack each instance until its residuals actually get smaller
+        norms = np.linalg.norm(residuals, axis=0)
+        fractions = np.ones(len(active))
+        trying = np.arange(len(active))
+        while len(trying):
+            trial = values[:, active[trying]]
+            trial[slots] = xActive[:, trying] + fractions[trying] * step[:, trying]
+            newNorms = np.linalg.norm(tape.evaluate(trial), axis=0)
+            better = newNorms <= (1.0 - 1e-4 * fractions[trying]) * norms[trying]
+            trying = trying[~better & (fractions[trying] >= 1e-4)]
+            fractions[trying] /= 2.0
+        x[:, active] = xActive + fractions * step
+    return (x, converged)
@@ -0,0 +1,146 @@
+# Response-surface surrogates: cheap approximations of a problem's outputs as functions of its inputs, fitted to the
+# solutions found so far, for previewing what an input change will do (e.g. a slider move in the GUI) straight away,
+# while the exact solve is still running
+# The interpolant is a cubic radial basis function one, phi(r) = r^3, with a linear polynomial tail, in inputs scaled to
+# comparable ranges. It goes through every solution exactly, and takes O(n^2) work to add a solution to (by a bordered
+# update of the inverse of its interpolation matrix) and O(n) to evaluate, for n solutions - so it keeps up with
+# solutions as they arrive. It's refitted from scratch every so often, to rescale the inputs and keep rounding errors
+# from building up. With too few solutions for the interpolant (or only degenerate ones), it gives the outputs of the
+# nearest solution instead.
+
+import numpy as np
+
+# Most solutions kept - beyond that, the oldest are dropped
+DEFAULT_MAX_POINTS = 200
+# Solutions added between refits from scratch
+REFIT_INTERVAL = 50
+
+
+class RBFSurrogate:
+    """
+    Interpolates several outputs of a problem at once over a fixed set of inputs (see the top of this file)
+    Values are passed in and out as dicts by variable name
+    """
+    def __init__(self, inputNames, outputNames, maxPoints=DEFAULT_MAX_POINTS):
+        self.inputNames = list(inputNames)
+        self.outputNames = list(outputNames)
+        self.maxPoints = maxPoints
+        # The solutions, as input values (one row per solution) and output values
+        self.points = np.empty((0, len(self.inputNames)))
+        self.values = np.empty((0, len(self.outputNames)))
+        # Inputs are scaled as (x - offset) / scale before interpolating
+        self.offset = np.zeros(len(self.inputNames))
+        self.scale = np.ones(len(self.inputNames))
+        # Inverse of the interpolation matrix, whose rows and columns are the polynomial terms and then the solutions,
+        # and the coefficients of each output (None if there's no interpolant, e.g. too few solutions)
+        self.inverse = None
+        self.coefficients = None
+        self.addedSinceRefit = 0
+
+    def __len__(self):
+        return len(self.points)
+
+    def polynomial(self, scaled):
+        # The polynomial terms (1, x1, x2...) of scaled points, as rows
+        return np.hstack([np.ones((len(scaled), 1)), scaled])
+
+    def kernel(self, scaledA, scaledB):
+        # phi of the distances between every pair of scaled points, as an array of shape (len(scaledA), len(scaledB))
+        distances = np.sqrt(((scaledA[:, np.newaxis, :] - scaledB[np.newaxis, :, :]) ** 2).sum(axis=2))
+        return distances ** 3
+
+    def getRHS(self):
+        return np.vstack([np.zeros((len(self.inputNames) + 1, len(self.outputNames))), self.values])
+
+    def add(self, inputs, outputs):
+        """
+        Add a solution
+        :param inputs: dict of input values by name
+        :param outputs: dict of output values by name
+        :return: True if it was added, False if it was left out (some values missing, or the same inputs as one already added)
+        """
+        try:
+            point = np.array([inputs[name] for name in self.inputNames], dtype=float)
+            values = np.array([outputs[name] for name in self.outputNames], dtype=float)
+        except (KeyError, TypeError):
+            return False
+        if not (np.all(np.isfinite(point)) and np.all(np.isfinite(values))):
+            return False
+        if len(self.points) and np.any(np.all(self.points == point, axis=1)):
+            return False
+        self.points = np.vstack([self.points, point])
+        self.values = np.vstack([self.values, values])
+        self.addedSinceRefit += 1
+        if len(self.points) > self.maxPoints:
+            # Drop the oldest quarter, so this doesn't happen on every add
+            drop = len(self.points) - self.maxPoints + self.maxPoints // 4
+            (self.points, self.values) = (self.points[drop:], self.values[drop:])
+            self.refit()
+        elif self.inverse is None or self.addedSinceRefit >= REFIT_INTERVAL:
+            self.refit()
+        else:
+            self.update()
+        return True
+
+    def addSolution(self, context):
+        # Add a solution from a solved Context (which must have a value for every input and output)
+        return self.add(context.varVals, context.varVals)
+
+    def update(self):
+        # Add the last point to the interpolant, by the block formula for the inverse of a matrix with a row and column added
+        scaled = (self.points - self.offset) / self.scale
+        border = np.concatenate([self.polynomial(scaled[-1:])[0], self.kernel(scaled[-1:], scaled[:-1])[0]])
+        product = self.inverse.dot(border)
+        # The Schur complement (phi(0) = 0 on the diagonal)
+        schur = -border.dot(product)
+        if abs(schur) <= 1e-10 * max(1.0, abs(border.dot(product))):
+            # The new point makes the matrix (nearly) singular, so start again
+            self.refit()
+            return
+        size = len(border)
+        inverse = np.empty((size + 1, size + 1))
+        inverse[:size, :size] = self.inverse + np.outer(product, product) / schur
+        inverse[:size, size] = inverse[size, :size] = -product / schur
+        inverse[size, size] = 1.0 / schur
+        self.inverse = inverse
+        self.coefficients = inverse.dot(self.getRHS())
+
+    def refit(self):
+        # Fit the interpolant from scratch, rescaling the inputs to the spread of the solutions
+        self.addedSinceRefit = 0
+        (self.inverse, self.coefficients) = (None, None)
+        numTerms = len(self.inputNames) + 1
+        if len(self.points) <= numTerms:
+            return
+        self.offset = self.points.mean(axis=0)
+        spread = self.points.std(axis=0)
+        self.scale = np.where(spread > 0, spread, np.maximum(np.abs(self.offset), 1.0))
+        scaled = (self.points - self.offset) / self.scale
+        poly = self.polynomial(scaled)
+        matrix = np.block([[np.zeros((numTerms, numTerms)), poly.T], [poly, self.kernel(scaled, scaled)]])
+        try:
+            inverse = np.linalg.inv(matrix)
+        except np.linalg.LinAlgError:
+            return
+        if np.all(np.isfinite(inverse)) and np.linalg.cond(matrix) < 1e12:
+            self.inverse = inverse
+            self.coefficients = inverse.dot(self.getRHS())
+
+    def predict(self, inputs):
+        """
+        Approximate outputs for some input values
+        :param inputs: dict of input values by name
+        :return: dict of approximate output values by name, or None if there are no solutions yet
+        """
+        if not len(self.points):
+            return None
+        point = np.array([inputs[name] for name in self.inputNames], dtype=float)
+        scaled = ((point - self.offset) / self.scale)[np.newaxis]
+        if self.coefficients is None:
+            nearest = np.argmin(((self.points - point) / self.scale) ** 2 @ np.ones(len(point)))
+            return dict(zip(self.outputNames, self.values[nearest].tolist()))
+        row = np.concatenate([self.polynomial(scaled)[0], self.kernel(scaled, (self.points - self.offset) / self.scale)[0]])
+        return dict(zip(self.outputNames, row.dot(self.coefficients).tolist()))
+
+    def __repr__(self):
+        return "<RBFSurrogate: " + str(len(self.points)) + " solutions, " + str(len(self.inputNames)) + " inputs, " + str(len(self.outputNames)) + " outputs>"
@@ -0,0 +1,124 @@
+# Symbol tables: lookup of named expressions (variables and constants) by name
+# Names may be dotted (e.g. "pump1.flow"), in which case each part but the last names a nested namespace -
+# an object instance, an aliased import or similar
+
+
+class SymbolTable:
+    """
+    A namespace of named expressions, with hashed lookup, plus any number of nested namespaces (themselves SymbolTables)
+    Symbols and namespaces live in separate dicts, so a name can refer to both a variable and a namespace
+    """
+    def __init__(self, name="", parent=None):
+        self.name = name
+        self.parent = parent
+        # Local name -> expression
+        self.symbols = {}
+        # Local name -> SymbolTable
+        self.namespaces = {}
+
+    def getQualifiedName(self, localName=None):
+        # Full dotted name of this namespace (or of a symbol in it), from the outermost table
+        parts = [] if localName is None else [localName]
+        table = self
+        while table.parent is not None:
+            parts.append(table.name)
+            table = table.parent
+        return ".".join(reversed(parts))
+
+    def getNamespace(self, name, create=False):
+        """
+        Find a nested namespace by its (possibly dotted) name, relative to this one
+        :param create: make any namespaces that don't exist yet, rather than returning None
+        """
+        table = self
+        for part in name.split("."):
+            if part in table.namespaces:
+                table = table.namespaces[part]
+            elif create:
+                table = table.namespaces.setdefault(part, SymbolTable(part, table))
+            else:
+                return None
+        return table
+
+    def addNamespace(self, name, table):
+        # Make an existing table available as a nested namespace of this one (e.g. an aliased import)
+        # N.B. The table isn't re-parented, as it may be reachable by several routes
+        self.namespaces[name] = table
+
+    def canDefine(self, name):
+        # Whether a new symbol could be defined under this name - not if it's inside a namespace added from elsewhere
+        # (e.g. an aliased import), as that namespace belongs to (and is shared with) something else
+        table = self
+        for part in name.split(".")[:-1]:
+            if part not in table.namespaces:
+                return True
+            elif table.namespaces[part].parent is not table:
+                return False
+            table = table.namespaces[part]
+        return True
+
+    def define(self, name, expr):
+        """
+        Add an expression to the table under a (possibly dotted) name, creating namespaces for any dotted prefix
+        If the name is already defined, the existing definition is kept
+        :return: the expression now defined under that name
+        """
+        if "." in name:
+            if not self.canDefine(name):
+                existing = self.lookup(name)
+                if existing is None:
+                    raise ValueError("Can't define " + name + " inside a namespace added from elsewhere")
+                return existing
+            (prefix, localName) = name.rsplit(".", 1)
+            return self.getNamespace(prefix, create=True).symbols.setdefault(localName, expr)
+        return self.symbols.setdefault(name, expr)
+
+    def lookup(self, name):
+        """
+        Find an expression by its (possibly dotted) name
+        Undotted names not defined here are looked for in the enclosing namespaces in turn
+        :return: the expression, or None if there is none by that name
+        """
+        if "." in name:
+            (prefix, localName) = name.rsplit(".", 1)
+            table = self.getNamespace(prefix)
+            if table is not None and localName in table.symbols:
+                return table.symbols[localName]
+        else:
+            table = self
+            while table is not None:
+                if name in table.symbols:
+                    return table.symbols[name]
+                table = table.parent
+        return None
+
+    def __contains__(self, name):
+        return self.lookup(name) is not None
+
+    def items(self):
+        """
+        Every symbol in this table and its nested namespaces, as (dotted name relative to this table, expression)
+        Namespaces reachable by more than one route (e.g. an aliased import) are only visited once
+        """
+        seen = set()
+        stack = [("", self)]
+        while stack:
+            (prefix, table) = stack.pop()
+            if id(table) in seen:
+                continue
+            seen.add(id(table))
+            for (name, expr) in table.symbols.items():
+                yield (prefix + name, expr)
+            for (name, namespace) in table.namespaces.items():
+                stack.append((prefix + name + ".", namespace))
+
+    def filter(self, exprType):
+        # Dict of every symbol of the given type (e.g. all the ScalarVariables), keyed by the expression's own name
+        # (so that a symbol reachable by several routes appears once, under the name contexts know it by)
+        return {expr.getName(): expr for (name, expr) in self.items() if isinstance(expr, exprType)}
+
+    def __len__(self):
+        return sum(1 for item in self.items())
+
+    def __repr__(self):
+        return "<SymbolTable: " + (self.getQualifiedName() or "(root)") + ", " + str(len(self.symbols)) + " symbols, namespaces " + repr(sorted(self.namespaces.keys())) + ">"
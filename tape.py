@@ -0,0 +1,285 @@
+# Flat "tape" form of a set of constraints, for evaluating their residuals quickly
+# Each constraint's residual (lhs - rhs) is compiled into postfix opcodes held in numpy arrays, and the evaluator runs
+# the whole tape once over an array of values - either one set of variable values, or a whole batch of them at once,
+# so that e.g. every column of a finite-difference Jacobian is worked out in a single pass
+
+import numpy as np
+
+from expressions import ScalarVariable, Variable, SumExpression, DifferenceExpression, ProductExpression, \
+    QuotientExpression, PowerExpression, SinExpression, CosExpression, TanExpression
+
+# Opcodes
+LOAD_SLOT = 0   # push the value of variable slot arg
+LOAD_CONST = 1  # push constant arg
+ADD = 2
+SUB = 3
+MUL = 4
+DIV = 5
+POW = 6
+SIN = 7
+COS = 8
+TAN = 9
+STORE = 10      # pop the residual of constraint arg
+OPCODE_NAMES = ["load", "const", "add", "sub", "mul", "div", "pow", "sin", "cos", "tan", "store"]
+
+_binaryOpcodes = {
+    SumExpression: ADD,
+    DifferenceExpression: SUB,
+    ProductExpression: MUL,
+    QuotientExpression: DIV,
+    PowerExpression: POW
+}
+_unaryOpcodes = {
+    SinExpression: SIN,
+    CosExpression: COS,
+    TanExpression: TAN
+}
+_unaryFunctions = {SIN: np.sin, COS: np.cos, TAN: np.tan}
+
+
+class TapeError(Exception):
+    # Raised when something can't be compiled into a tape (e.g. an expression class the tape doesn't know)
+    pass
+
+
+class Tape:
+    """
+    The residuals of a list of constraints, as postfix code
+    Variables are referred to by slot - their position in slotNames - so values are passed in as an array indexed by slot
+    """
+    def __init__(self, constrs):
+        # The constraints, in the order of their residuals
+        self.constrs = list(constrs)
+        self.numConstrs = len(constrs)
+        # Names of the variables the constraints refer to, in slot order, and the slot of each name
+        self.slotNames = []
+        self.slotIndex = {}
+        self.constants = []
+        ops = []
+        args = []
+        for (i, constr) in enumerate(constrs):
+            (lhs, rhs, nameOf) = constr.getSides()
+            self.compile(lhs, nameOf, ops, args)
+            self.compile(rhs, nameOf, ops, args)
+            ops.append(SUB)
+            args.append(0)
+            ops.append(STORE)
+            args.append(i)
+        self.ops = np.array(ops, dtype=np.int8)
+        self.args = np.array(args, dtype=np.int32)
+        self.constants = np.array(self.constants, dtype=float)
+        # The interpreter walks plain lists, which is much quicker than indexing numpy arrays one element at a time
+        self.code = list(zip(self.ops.tolist(), self.args.tolist()))
+
+    def compile(self, expr, nameOf, ops, args):
+        # Append the postfix code for an expression (N.B. recursive, but only as deep as the expression itself)
+        exprType = type(expr)
+        if exprType in _binaryOpcodes:
+            self.compile(expr.argA, nameOf, ops, args)
+            self.compile(expr.argB, nameOf, ops, args)
+            ops.append(_binaryOpcodes[exprType])
+            args.append(0)
+        elif exprType in _unaryOpcodes:
+            self.compile(expr.arg, nameOf, ops, args)
+            ops.append(_unaryOpcodes[exprType])
+            args.append(0)
+        elif isinstance(expr, ScalarVariable):
+            name = nameOf(expr) if nameOf else expr.getName()
+            if name not in self.slotIndex:
+                self.slotIndex[name] = len(self.slotNames)
+                self.slotNames.append(name)
+            ops.append(LOAD_SLOT)
+            args.append(self.slotIndex[name])
+        elif isinstance(expr, Variable):
+            # Constants and fixed values
+            ops.append(LOAD_CONST)
+            args.append(len(self.constants))
+            self.constants.append(expr.value)
+        else:
+            raise TapeError("Can't compile " + repr(expr) + " into a tape")
+
+    def __len__(self):
+        return len(self.code)
+
+    def __repr__(self):
+        return "<Tape: " + str(self.numConstrs) + " constraints, " + str(len(self.slotNames)) + " slots, " + str(len(self.code)) + " ops>"
+
+    def listing(self):
+        # Human-readable form of the code, one op per line
+        lines = []
+        for (op, arg) in self.code:
+            if op == LOAD_SLOT:
+                lines.append("load  " + self.slotNames[arg])
+            elif op == LOAD_CONST:
+                lines.append("const " + repr(float(self.constants[arg])))
+            elif op == STORE:
+                lines.append("store " + str(arg))
+            else:
+                lines.append(OPCODE_NAMES[op])
+        return "\n".join(lines)
+
+    def getValues(self, context, batchSize=None):
+        """
+        Make an array of the values of the tape's variables in a context, with NaN for undefined values
+        :param batchSize: if given, make a (slots x batchSize) array with the values repeated in each column - or, for
+            values that are arrays (e.g. in the context of an objects.NIObjectArray), with one element in each column
+        """
+        if batchSize is not None:
+            values = np.empty((len(self.slotNames), batchSize))
+            for (slot, name) in enumerate(self.slotNames):
+                value = context.varVals.get(name)
+                values[slot] = np.nan if value is None else value
+            return values
+        return np.array([np.nan if value is None else value for value in
+                         (context.varVals.get(name) for name in self.slotNames)], dtype=float)
+
+    def evaluate(self, values):
+        """
+        Run the tape
+        :param values: array of variable values indexed by slot - either 1D, or 2D with one column per set of values
+        :return: array of the constraints' residuals, with the same number of dimensions as values
+        """
+        residuals = np.empty((self.numConstrs,) + np.shape(values)[1:])
+        constants = self.constants
+        stack = []
+        push = stack.append
+        pop = stack.pop
+        with np.errstate(all="ignore"):
+            for (op, arg) in self.code:
+                if op == LOAD_SLOT:
+                    push(values[arg])
+                elif op == LOAD_CONST:
+                    push(constants[arg])
+                elif op == STORE:
+                    residuals[arg] = pop()
+                elif op >= SIN:
+                    push(_unaryFunctions[op](pop()))
+                else:
+                    b = pop()
+                    a = pop()
+                    if op == ADD:
+                        push(a + b)
+                    elif op == SUB:
+                        push(a - b)
+                    elif op == MUL:
+                        push(a * b)
+                    elif op == DIV:
+                        push(a / b)
+                    else:
+                        push(a ** b)
+        return residuals
+
+    def jacobian(self, values, slots, steps=None):
+        """
+        Finite-difference Jacobian of the residuals with respect to some of the variables, in a single batched pass
+        :param values: 1D array of variable values by slot (the point to differentiate at)
+        :param slots: the slots of the variables to differentiate with respect to
+        :param steps: step size for each variable (defaults to a relative step suited to double precision)
+        :return: (residuals at values, Jacobian array of shape (constraints, len(slots)))
+        """
+        n = len(slots)
+        if steps is None:
+            steps = np.sqrt(np.finfo(float).eps) * np.maximum(1.0, np.abs(values[slots]))
+        # Use the steps actually taken, after rounding
+        steps = (values[slots] + steps) - values[slots]
+        batch = np.repeat(np.asarray(values, dtype=float)[:, np.newaxis], n + 1, axis=1)
+        batch[slots, np.arange(1, n + 1)] += steps
+        results = self.evaluate(batch)
+        return (results[:, 0], (results[:, 1:] - results[:, :1]) / steps)
+
+    def reverseJacobian(self, values):
+        """
+        Exact Jacobian of the residuals with respect to every slot, by reverse-mode automatic differentiation:
+        one forward pass recording every intermediate value, then one backward pass propagating adjoints
+        (each op belongs to exactly one residual, so a single backward pass gives every row)
+        :param values: 1D array of variable values by slot
+        :return: (residuals, sparse Jacobian of shape (constraints, slots) as a scipy.sparse.csr_matrix)
+        """
+        import scipy.sparse
+        code = self.code
+        constants = self.constants
+        # Forward pass: the value each op produced, and which ops produced its operands
+        results = [0.0] * len(code)
+        operands = [None] * len(code)
+        residuals = np.empty(self.numConstrs)
+        stack = []
+        with np.errstate(all="ignore"):
+            for (k, (op, arg)) in enumerate(code):
+                if op == LOAD_SLOT:
+                    results[k] = float(values[arg])
+                    stack.append(k)
+                elif op == LOAD_CONST:
+                    results[k] = float(constants[arg])
+                    stack.append(k)
+                elif op == STORE:
+                    operands[k] = (stack.pop(),)
+                    residuals[arg] = results[operands[k][0]]
+                elif op >= SIN:
+                    a = stack.pop()
+                    operands[k] = (a,)
+                    results[k] = float(_unaryFunctions[op](results[a]))
+                    stack.append(k)
+                else:
+                    b = stack.pop()
+                    a = stack.pop()
+                    operands[k] = (a, b)
+                    (x, y) = (results[a], results[b])
+                    if op == ADD:
+                        results[k] = x + y
+                    elif op == SUB:
+                        results[k] = x - y
+                    elif op == MUL:
+                        results[k] = x * y
+                    elif op == DIV:
+                        results[k] = x / y if y != 0 else np.nan
+                    else:
+                        results[k] = float(np.power(x, y))
+                    stack.append(k)
+            # Backward pass
+            adjoints = [0.0] * len(code)
+            (rows, cols, entries) = ([], [], [])
+            row = 0
+            for k in range(len(code) - 1, -1, -1):
+                (op, arg) = code[k]
+                adjoint = adjoints[k]
+                if op == STORE:
+                    row = arg
+                    adjoints[operands[k][0]] += 1.0
+                elif op == LOAD_SLOT:
+                    if adjoint != 0.0:
+                        rows.append(row)
+                        cols.append(arg)
+                        entries.append(adjoint)
+                elif op == LOAD_CONST or adjoint == 0.0:
+                    pass
+                elif op >= SIN:
+                    a = operands[k][0]
+                    x = results[a]
+                    if op == SIN:
+                        adjoints[a] += adjoint * np.cos(x)
+                    elif op == COS:
+                        adjoints[a] -= adjoint * np.sin(x)
+                    else:
+                        adjoints[a] += adjoint / np.cos(x) ** 2
+                else:
+                    (a, b) = operands[k]
+                    (x, y) = (results[a], results[b])
+                    if op == ADD:
+                        adjoints[a] += adjoint
+                        adjoints[b] += adjoint
+                    elif op == SUB:
+                        adjoints[a] += adjoint
+                        adjoints[b] -= adjoint
+                    elif op == MUL:
+                        adjoints[a] += adjoint * y
+                        adjoints[b] += adjoint * x
+                    elif op == DIV:
+                        adjoints[a] += adjoint / y
+                        adjoints[b] -= adjoint * x / y ** 2
+                    else:
+                        adjoints[a] += adjoint * y * np.power(x, y - 1)
+                        # (Only matters if the exponent is variable, in which case the base must be positive anyway)
+                        if code[b][0] != LOAD_CONST:
+                            adjoints[b] += adjoint * results[k] * np.log(x)
+        jacobian = scipy.sparse.coo_matrix((entries, (rows, cols)), shape=(self.numConstrs, len(self.slotNames))).tocsr()
+        return (residuals, jacobian)
@@ -1,5 +1,40 @@
-from objects import ObjectTestProblem
-from parsedproblem import ParsedProblem
+import asyncio
+import concurrent.futures
+import json
+import os
+import pickle
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+from asyncsolver import solveAsync, sweepAsync, solveStream, solveBatchAsync
+from autodiff import gradient, gradients, solveWithGradient
+from codegen import generateModule
+from designoptimizer import DesignOptimizer
+from montecarlo import MonteCarlo, Normal, Uniform, Empirical, LogNormal, QuantileSketch, RunningStats, SAMPLING_RANDOM
+from batchsolver import gridInputs, runSweep, sweep, evaluateResiduals
+from equationsolver import Problem, Context, BLOCK_ANALYTIC, BLOCK_NUMERIC, STATUS_SOLVED, STATUS_PARTIAL, STATUS_FAILED, STATUS_BUDGET_EXCEEDED, STATUS_CANCELLED
+from expressions import ScalarVariable
+from budgets import SolveBudget, CancelToken
+from constraints import EqualityConstraint
+from dofanalyzer import DOFAnalyzer
+from expressions import ProductExpression, SumExpression, DifferenceExpression, QuotientExpression, SinExpression, PowerExpression, FixedValue
+from objects import ObjectTestProblem, NIClass, NIObject, NIObjectArray, BoundConstraint
+from parsedproblem import ParsedProblem, getModule
+from portfolio import Portfolio, getFeatures, METHOD_LINEAR
+from probparser import LineParser, ProbSyntaxError
+from probcache import loadProblem, readCache, cacheFilename
+from resultexport import NPZResultWriter, loadResults, statusNames
+from solveserver import SolveServer, SolveClient
+from sparsenewton import sparsityPattern, colourColumns, colouredJacobian
+from surrogate import RBFSurrogate
+from symboltable import SymbolTable
+from tape import Tape
 
 def divider(item):
     print("*" * 10 + str(item) + "*" * 40)
@@ -49,5 +84,759 @@ def test_objects():
     print(testprob)
     testprob.solve()
 
+def test_shared_class_templates():
+    # Objects are views of their class' constraints, with only their own values held per object
+    m = ScalarVariable("m")
+    W = ScalarVariable("W")
+    g = ScalarVariable("g", 9.81)
+    mass = NIClass("Mass", [m, W], [EqualityConstraint("Weight", W, ProductExpression(m, g))])
+    objs = [NIObject("mass" + str(i), mass) for i in range(3)]
+    assert not hasattr(objs[0], "__dict__") and not hasattr(objs[0].constrs[0], "__dict__")
+    assert not hasattr(mass.constrs[0], "__dict__")
+    assert objs[1].constrs[0].constr is mass.constrs[0]
+    assert objs[1].getVar("W").getName() == "mass1.W" and objs[1].constrs[0].getName() == "mass1.Weight"
+    # Bound constraints pickle (e.g. into __probcache__) as just their binding
+    copied = pickle.loads(pickle.dumps(objs[1].constrs[0]))
+    assert copied.getName() == "mass1.Weight" and copied.index == 0
+    # g isn't a class variable, so is shared between the objects
+    assert sorted(var.getName() for var in objs[2].constrs[0].getExprs()) == ["g", "mass2.W", "mass2.m"]
+    p = Problem("Masses")
+    for (i, obj) in enumerate(objs):
+        obj.getVar("m").value = 10.0 * (i + 1)
+        p.addObj(obj)
+    context = p.defaultContext.copy()
+    assert p.solve(context)
+    assert np.allclose([context.getValue(obj.getVar("W")) for obj in objs], [98.1, 196.2, 294.3])
+
+def test_parsed_objects():
+    # Classes and objects defined in a .prob file
+    p = ParsedProblem("examples/masses.prob")
+    assert sorted(p.classes.keys()) == ["Mass"]
+    assert p.findVar("mass2.F").getName() == "mass2.F"
+    context = p.defaultContext.copy()
+    assert p.solve(context)
+    assert np.isclose(context.getValue(p.findVar("mass2.F")), 100.0)
+    assert np.isclose(context.getValue(p.findVar("total_weight")), 30 * 9.81)
+    # Every object shares the class' equations
+    assert all(constr.constr in p.classes["Mass"].constrs for constr in p.constrs if isinstance(constr, BoundConstraint))
+    # A class can only initialise its own variables, not constants or (possibly shared) variables of imported modules
+    with tempfile.TemporaryDirectory() as tempdir:
+        with open(os.path.join(tempdir, "consts.prob"), "w") as file:
+            file.write("k == 2\n")
+        with open(os.path.join(tempdir, "lib.prob"), "w") as file:
+            file.write("g := 9.81\n")
+        with open(os.path.join(tempdir, "main.prob"), "w") as file:
+            file.write('import("consts.prob")\nimport("lib.prob") as lib\nclass Spring {\n  F = k * x\n  k := 3\n  lib.g := 1\n  x := 0.5\n}\nSpring s(x = 0.25)\n')
+        p = ParsedProblem(os.path.join(tempdir, "main.prob"))
+        lib = getModule(os.path.join(tempdir, "lib.prob"))
+    assert p.findVar("k").value == 2 and lib.findVar("g").value is None
+    assert lib.defaultContext.varVals["g"] == 9.81 and p.defaultContext.varVals["lib.g"] == 9.81
+    assert p.classes["Spring"].slots.keys() == {"F", "x"}
+
+def test_object_array():
+    # A fleet solved as one object array should match the same objects solved one by one
+    F = ScalarVariable("F", 5.0)
+    m = ScalarVariable("m")
+    a = ScalarVariable("a")
+    x = ScalarVariable("x")
+    c = ScalarVariable("c", 2.0)
+    part = NIClass("Part", [F, m, a, x, c], [
+        EqualityConstraint("Newton's 2nd law", F, ProductExpression(m, a)),
+        # Needs solving numerically, as x appears twice
+        EqualityConstraint("Kinematics", SumExpression(x, SinExpression(x)), ProductExpression(c, a))])
+    masses = np.linspace(1.0, 10.0, 6)
+    fleet = NIObjectArray("part", part, len(masses))
+    fleet.setValues("m", masses)
+    # Give the first two a known acceleration instead of a force, so that they're solved as a separate group
+    fleet.values["F"][:2] = np.nan
+    fleet.values["a"][:2] = 0.0
+    assert fleet.solve()
+    assert fleet.statuses == [STATUS_SOLVED] * len(masses)
+    assert np.allclose(fleet.getValues("F")[:2], 0.0)
+    for i in range(len(masses)):
+        obj = NIObject(fleet.getInstanceName(i), part)
+        p = Problem("One part")
+        p.addObj(obj)
+        context = p.defaultContext.copy()
+        context.setValue(obj.getVar("m"), masses[i])
+        if i < 2:
+            context.setValue(obj.getVar("F"), None)
+            context.setValue(obj.getVar("a"), 0.0)
+        assert p.solve(context)
+        for name in ["F", "a", "x"]:
+            assert np.isclose(context.getValue(obj.getVar(name)), fleet.getValues(name)[i])
+
+def test_export_sweep():
+    # Stream a sweep to each of the built-in formats and read it back
+    p = ParsedProblem("examples/test2.prob")
+    inputs = list(gridInputs({"R_ext": [1.0, 2.0, 8.0], "EMF": [9.0, 18.0]}))
+    with tempfile.TemporaryDirectory() as tempdir:
+        for extension in [".npy", ".npz", ".csv"]:
+            filename = os.path.join(tempdir, "sweep" + extension)
+            numRows = runSweep(p, inputs, filename, chunkSize=4)
+            assert numRows == len(inputs)
+        results = loadResults(os.path.join(tempdir, "sweep.npy"))
+        assert statusNames(results["status"]) == [STATUS_SOLVED] * len(inputs)
+        # I = EMF / (R_int + R_ext)
+        expected = [row["EMF"] / (1.0 + row["R_ext"]) for row in inputs]
+        assert np.allclose(results["I"], expected)
+        archive = loadResults(os.path.join(tempdir, "sweep.npz"))
+        assert np.allclose(archive["I"], expected)
+        del results, archive
+        # Variables can have names that np.savez uses for its own parameters
+        for compress in [False, True]:
+            filename = os.path.join(tempdir, "names.npz")
+            writer = NPZResultWriter(filename, ["file", "allow_pickle", "args"], chunkSize=2, compress=compress)
+            for i in range(3):
+                writer.writeRow({"file": i, "allow_pickle": 2.0 * i, "args": None})
+            writer.close()
+            with loadResults(filename) as archive:
+                assert sorted(archive.keys()) == ["allow_pickle", "args", "file", "status"]
+                assert np.array_equal(archive["file"], [0, 1, 2]) and np.array_equal(archive["allow_pickle"], [0, 2, 4])
+                assert np.all(np.isnan(archive["args"])) and statusNames(archive["status"]) == [STATUS_SOLVED] * 3
+
+def test_partial_solve():
+    # With an input missing, everything that doesn't depend on it is still solved, and the rest is reported as free
+    p = ParsedProblem("examples/masses.prob")
+    context = p.defaultContext.copy()
+    context.varVals["mass1.m"] = None
+    result = p.solve(context)
+    assert not result and result.status == STATUS_PARTIAL
+    assert result.freeVars == ("mass1.a", "mass1.m", "mass1.W", "mass2.a", "mass2.F", "total_weight")
+    assert np.isclose(context.varVals["mass2.W"], 20 * 9.81) and context.varVals["mass1.F"] == 50.0
+    # Including coupled blocks that have to be solved numerically: the labour market here is determined, i and r aren't
+    p = ParsedProblem("examples/classical_economy.prob")
+    context = p.defaultContext.copy()
+    result = p.solve(context)
+    assert result.status == STATUS_PARTIAL and result.freeVars == ("i", "r")
+    assert np.isclose(context.varVals["Q_labour"], 100.0)
+    # A sweep carries on past a row with a missing input
+    p = ParsedProblem("examples/masses.prob")
+    statuses = [status for (context, status) in sweep(p, [{"mass1.m": None}, {"mass1.m": 5.0}])]
+    assert statuses == [STATUS_PARTIAL, STATUS_SOLVED]
+
+def test_block_diagnosis():
+    # Blocks that can't be solved numerically are rejected before the root-finder is tried, saying why
+    x = ScalarVariable("x")
+    y = ScalarVariable("y")
+    sum = EqualityConstraint("sum", SumExpression(x, y), FixedValue(1.0))
+    diff = EqualityConstraint("diff", DifferenceExpression(x, y), FixedValue(0.0))
+    double = EqualityConstraint("double", ProductExpression(FixedValue(2.0), SumExpression(x, y)), FixedValue(2.0))
+    product = EqualityConstraint("product", ProductExpression(x, y), FixedValue(0.25))
+    for (constrs, diagnosis) in [([sum, double], "numerically singular (rank 1 of 2)"),
+                                 ([sum, diff, product], "overdetermined - 1 constraint(s) too many")]:
+        p = Problem("Diagnosis test")
+        p.addConstrs(*constrs)
+        result = p.solve(Context())
+        assert not result
+        assert result.diagnosis.startswith(diagnosis) and all(constr.getName() in result.diagnosis for constr in constrs)
+    # ...but not blocks that are only singular at the starting point (x = y = 0 here)
+    p = Problem("Diagnosis test")
+    p.addConstrs(sum, EqualityConstraint("product", ProductExpression(x, y), FixedValue(0.21)))
+    context = Context()
+    result = p.solve(context)
+    assert result and result.diagnosis is None
+    assert np.isclose(context.varVals["x"] * context.varVals["y"], 0.21)
+
+def test_sparse_newton():
+    # A large coupled block is solved with sparse Jacobians: v[i] + sin(v[i+1]) / 4 = 1 + i / 1000, wrapping around
+    n = 250
+    v = [ScalarVariable("v" + str(i)) for i in range(n)]
+    constrs = [EqualityConstraint("c" + str(i), SumExpression(v[i], ProductExpression(FixedValue(0.25), SinExpression(v[(i + 1) % n]))),
+                                  FixedValue(1.0 + 0.001 * i)) for i in range(n)]
+    p = Problem("Sparse test")
+    p.addConstrs(*constrs)
+    context = Context()
+    assert p.solve(context)
+    assert np.allclose([constr.getResidual(context) for constr in constrs], 0.0, atol=1e-9)
+    # Each constraint only refers to two variables, so two colours (and two tape evaluations) give the whole Jacobian
+    tape = Tape(constrs)
+    slots = [tape.slotIndex[var.getName()] for var in v]
+    pattern = sparsityPattern(tape, slots)
+    assert pattern.nnz == 2 * n
+    colours = colourColumns(pattern)
+    assert colours.max() + 1 <= 3
+    values = np.linspace(0.0, 1.0, len(tape.slotNames))
+    exact = tape.reverseJacobian(values)[1][:, slots]
+    assert np.allclose(colouredJacobian(tape, values, slots, pattern, colours).toarray(), exact.toarray(), atol=1e-6)
+
+def test_method_portfolio():
+    # Each numerical block is solved by a method suiting its structure, and the method that worked is remembered
+    x = ScalarVariable("x")
+    y = ScalarVariable("y")
+    linear = [EqualityConstraint("sum", SumExpression(x, y), FixedValue(3.0)),
+              EqualityConstraint("diff", DifferenceExpression(ProductExpression(FixedValue(2.0), x), y), FixedValue(0.0))]
+    nonlinear = [linear[0], EqualityConstraint("product", ProductExpression(x, SinExpression(y)), FixedValue(0.5))]
+    assert getFeatures(Tape(linear), [0, 1]).isLinear
+    assert not getFeatures(Tape(nonlinear), [0, 1]).isLinear
+    p = Problem("Portfolio test")
+    p.addConstrs(*linear)
+    context = Context()
+    assert p.solve(context)
+    assert np.isclose(context.varVals["x"], 1.0) and np.isclose(context.varVals["y"], 2.0)
+    assert list(p.getPortfolio().winners.values()) == [METHOD_LINEAR]
+    # Racing the candidate methods gets the same answer
+    p = Problem("Portfolio test")
+    p.addConstrs(*nonlinear)
+    p.portfolio = Portfolio(race=True)
+    context = Context({"x": None, "y": None})
+    assert p.solve(context, Context({"x": 1.0, "y": 1.0}))
+    assert np.allclose([constr.getResidual(context) for constr in nonlinear], 0.0)
+    assert len(p.portfolio.winners) == 1
+    # The portfolio's winners aren't pickled (e.g. into __probcache__), just its settings
+    copied = pickle.loads(pickle.dumps(p.portfolio))
+    assert copied.race and copied.winners == {}
+
+def test_solve_budget():
+    # A budget stops a solve part way through numerical solving, with its own status
+    x = ScalarVariable("x")
+    p = Problem("Budget test")
+    p.addConstr(EqualityConstraint("c", SumExpression(x, SinExpression(x)), FixedValue(2.0)))
+    result = p.solve(Context(), budget=SolveBudget(blockEvaluations=2))
+    assert not result and result.status == STATUS_BUDGET_EXCEEDED and "residual evaluations" in result.diagnosis
+    assert p.solve(Context(), budget=SolveBudget(maxSeconds=60.0, blockEvaluations=1000))
+    # Cancelling stops a solve, and a sweep after the row it was solving
+    token = CancelToken()
+    token.cancel()
+    p = ParsedProblem("examples/masses.prob")
+    results = list(sweep(p, [{"mass1.m": 1.0}, {"mass1.m": 2.0}], budget=SolveBudget(cancelToken=token)))
+    assert [status for (context, status) in results] == [STATUS_CANCELLED]
+    token.reset()
+    results = list(sweep(p, [{"mass1.m": 1.0}, {"mass1.m": 2.0}], budget=SolveBudget(cancelToken=token)))
+    assert [status for (context, status) in results] == [STATUS_SOLVED, STATUS_SOLVED]
+
+def test_solve_result():
+    # A solve leaves the problem as it was, and says what it did in an immutable result
+    x = ScalarVariable("x")
+    a = ScalarVariable("a", 2.0)
+    y = ScalarVariable("y")
+    p = Problem("Result test")
+    p.addConstrs(EqualityConstraint("c", SumExpression(x, SinExpression(x)), a), EqualityConstraint("d", y, ProductExpression(FixedValue(2.0), x)))
+    result = p.solve()
+    assert result and p.defaultContext.varVals["x"] is None
+    assert [(block.kind, block.constrs, block.variables) for block in result.plan] == [(BLOCK_NUMERIC, ("c",), ("x",)), (BLOCK_ANALYTIC, ("d",), ("y",))]
+    assert dict(result.constrStatuses) == {"c": STATUS_SOLVED, "d": STATUS_SOLVED} and result.plan[0].method is not None
+    assert np.isclose(result.values["y"], 2.0 * result.values["x"]) and result.seconds >= 0.0
+    try:
+        result.status = STATUS_PARTIAL
+        assert False, "should have failed"
+    except AttributeError:
+        pass
+    assert pickle.loads(pickle.dumps(result)).values == result.values
+    # So one problem can be solved in many threads at once, giving the same answers as one at a time
+    inputs = np.linspace(0.5, 3.0, 24)
+    solveFor = lambda value: p.solve(Context({"x": None, "a": value, "y": None})).values["x"]
+    expected = [solveFor(value) for value in inputs]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+        assert np.allclose(list(executor.map(solveFor, inputs)), expected)
+    assert np.allclose(np.array(expected) + np.sin(expected), inputs)
+
+def test_async_solving():
+    # Solving from an event loop, one at a time, as a stream, or with cancellation
+    p = ParsedProblem("examples/masses.prob")
+    rows = [{"mass1.m": 1.0}, {"mass1.m": None}, {"mass1.m": 4.0}]
+
+    class SlowConstraint(EqualityConstraint):
+        # Takes a while to propagate, so there's time to cancel the solve
+        calls = 0
+
+        def propagate(self, context):
+            SlowConstraint.calls += 1
+            time.sleep(0.01)
+            return super(SlowConstraint, self).propagate(context)
+
+    chain = [ScalarVariable("v" + str(i), 1.0 if i == 0 else None) for i in range(100)]
+    slow = Problem("Slow")
+    slow.addConstrs(*[SlowConstraint("c" + str(i), chain[i + 1], chain[i]) for i in range(99)])
+
+    async def run():
+        result = await solveAsync(p)
+        assert result and np.isclose(result.values["total_weight"], 294.3)
+        swept = [(context.varVals["mass1.W"], result.status) async for (context, result) in sweepAsync(p, rows)]
+        assert [status for (weight, status) in swept] == [STATUS_SOLVED, STATUS_PARTIAL, STATUS_SOLVED]
+        assert np.isclose(swept[2][0], 4.0 * 9.81)
+        batch = await solveBatchAsync(p, rows, maxConcurrent=2)
+        assert [result.status for (context, result) in batch] == [status for (weight, status) in swept]
+        # Inputs are only read as results are taken
+        read = []
+
+        def inputs():
+            for row in rows * 10:
+                read.append(row)
+                yield row
+        stream = solveStream(p, inputs(), maxConcurrent=2)
+        await stream.__anext__()
+        assert len(read) == 2
+        await stream.aclose()
+        # Cancelling the awaiting task stops the solve, not just the waiting
+        task = asyncio.ensure_future(solveAsync(slow))
+        await asyncio.sleep(0.1)
+        task.cancel()
+        try:
+            await task
+            assert False, "should have been cancelled"
+        except asyncio.CancelledError:
+            pass
+        calls = SlowConstraint.calls
+        await asyncio.sleep(0.1)
+        assert SlowConstraint.calls == calls < 99
+    asyncio.run(run())
+
+def test_solve_server():
+    # Pipelined JSON-lines requests against problems kept loaded, answered in any order but matched up by id
+    server = SolveServer(useCache=False)
+    requests = [{"id": 1, "op": "solve", "problem": "examples/masses.prob", "inputs": {"mass1.m": 5.0}},
+                {"id": 2, "op": "batch", "problem": "examples/masses.prob", "rows": [{"mass1.m": None}, {"mass1.m": 2.0}]},
+                {"id": 3, "op": "sensitivity", "problem": "examples/masses.prob", "metric": "total_weight"},
+                {"id": 4, "op": "solve", "problem": "examples/masses.prob", "inputs": {"nonsense": 1.0}},
+                {"id": 5, "op": "frobnicate"}]
+    output = []
+    server.serveLines([json.dumps(request) + "\n" for request in requests] + ["not json\n"], output.append)
+    responses = {response["id"]: response for response in map(json.loads, output)}
+    assert responses[1]["ok"] and responses[1]["status"] == STATUS_SOLVED and np.isclose(responses[1]["values"]["mass1.W"], 5.0 * 9.81)
+    assert [result["status"] for result in responses[2]["results"]] == [STATUS_PARTIAL, STATUS_SOLVED]
+    assert "mass1.m" in responses[2]["results"][0]["freeVars"]
+    assert np.isclose(responses[3]["gradient"]["mass1.m"], 9.81)
+    assert not responses[4]["ok"] and "nonsense" in responses[4]["error"]
+    assert not responses[5]["ok"] and not responses[None]["ok"]
+    # The problem was only loaded once, and the complete solves' plans were kept, by the variables given values
+    assert len(server.problems) == 1
+    assert len(server.plans[os.path.abspath("examples/masses.prob")]) == 1
+    # Later solves with the same inputs follow the kept plan, giving the same results
+    output = []
+    server.serveLines([json.dumps(requests[0]) + "\n"], output.append)
+    assert json.loads(output[0])["values"] == responses[1]["values"]
+    # Editing an imported file reloads the problem
+    with tempfile.TemporaryDirectory() as tempdir:
+        with open(os.path.join(tempdir, "lib.prob"), "w") as file:
+            file.write("k := 2\n")
+        with open(os.path.join(tempdir, "main.prob"), "w") as file:
+            file.write('import("lib.prob")\ny = 3 * k\n')
+        request = {"op": "solve", "problem": os.path.join(tempdir, "main.prob")}
+        assert server.handle(request)["values"]["y"] == 6
+        with open(os.path.join(tempdir, "lib.prob"), "w") as file:
+            file.write("k := 5.0\n")
+        assert server.handle(request)["values"]["y"] == 15
+    # Over a Unix socket
+    path = os.path.join(tempfile.mkdtemp(), "solve.sock")
+    server = SolveServer(useCache=False)
+    thread = threading.Thread(target=server.serveSocket, args=(path,))
+    thread.start()
+    try:
+        for attempt in range(100):
+            if os.path.exists(path):
+                break
+            time.sleep(0.01)
+        client = SolveClient(path)
+        ids = [client.send({"op": "solve", "problem": "examples/masses.prob", "inputs": {"mass1.m": m}}) for m in (1.0, 2.0, 3.0)]
+        responses = [client.receive() for i in ids]
+        assert sorted(response["id"] for response in responses) == ids and all(response["ok"] for response in responses)
+        assert client.request({"op": "shutdown"})["ok"]
+        client.close()
+    finally:
+        thread.join(10)
+    assert not thread.is_alive() and not os.path.exists(path)
+
+def test_codegen():
+    # A generated module solves the problem just as the solver does, with nothing but the standard library
+    p = ParsedProblem("examples/masses.prob")
+    namespace = {}
+    source = generateModule(p)
+    exec(compile(source, "generated", "exec"), namespace)
+    assert [line for line in source.splitlines() if line.startswith(("import", "from"))] == ["import math"]
+    context = p.defaultContext.copy()
+    context.varVals["mass1.m"] = 3.0
+    p.solve(context)
+    solution = namespace["solve"]({"mass1.m": 3.0})
+    assert all(np.isclose(solution[name], context.varVals[name]) for name in p.getVariableNames())
+    # Including numerical blocks, with their generated Jacobians
+    x = ScalarVariable("x")
+    y = ScalarVariable("y")
+    a = ScalarVariable("a", 2.0)
+    z = ScalarVariable("z")
+    p = Problem("Codegen test")
+    p.addConstrs(EqualityConstraint("c", SumExpression(x, SinExpression(ProductExpression(x, y))), a),
+                 EqualityConstraint("d", PowerExpression(y, FixedValue(2.0)), SumExpression(x, FixedValue(1.0))),
+                 EqualityConstraint("e", z, QuotientExpression(x, y)))
+    namespace = {}
+    exec(compile(generateModule(p, refContext=Context({"x": 1.0, "y": 1.0, "z": 1.0})), "generated", "exec"), namespace)
+    for value in (1.8, 2.2):
+        solution = namespace["solve"]({"a": value})
+        assert np.isclose(solution["x"] + np.sin(solution["x"] * solution["y"]), value)
+        assert np.isclose(solution["y"] ** 2, solution["x"] + 1.0) and np.isclose(solution["z"], solution["x"] / solution["y"])
+    try:
+        namespace["solve"]({"x": 1.0})
+        assert False, "should have failed"
+    except namespace["SolveError"]:
+        pass
+    # Only problems that solve completely can be generated
+    try:
+        generateModule(ParsedProblem("examples/classical_economy.prob"))
+        assert False, "should have failed"
+    except ValueError as err:
+        assert "partial" in str(err)
+
+def test_monte_carlo():
+    # Distributions from a .prob file, pushed through analytic and numerical steps a batch at a time
+    with tempfile.TemporaryDirectory() as tempdir:
+        with open(os.path.join(tempdir, "loads.csv"), "w") as file:
+            file.write("load\n1\n2\n3\n4\n")
+        with open(os.path.join(tempdir, "model.prob"), "w") as file:
+            file.write('x ~ normal(3, 0.5)\nk ~ empirical("loads.csv")\nm ~ lognormal(0, 0.1)\ny = 2 * x + 1\nz * z = y + k\n')
+        p = ParsedProblem(os.path.join(tempdir, "model.prob"))
+        assert isinstance(p.distributions["x"], Normal) and isinstance(p.distributions["k"], Empirical)
+        assert isinstance(p.distributions["m"], LogNormal) and p.distributions["m"].sigma == 0.1
+        assert p.defaultContext.varVals["x"] == 3.0 and np.isclose(p.defaultContext.varVals["m"], 1.0)
+        mc = MonteCarlo(p, refContext=Context({"z": 3.0}))
+        result = mc.run(20000, batchSize=5000, keepSamples=True)
+        assert result.count == 20000 and result.failures == 0
+        assert abs(result.mean("y") - 7.0) < 0.01 and abs(result.std("y") - 1.0) < 0.01
+        assert abs(result.quantile("y", 0.95) - (7.0 + 1.6449)) < 0.02
+        assert np.allclose(result.getSamples("z") ** 2, result.getSamples("y") + result.getSamples("k"))
+        assert abs(np.median(np.log(result.getSamples("m")))) < 0.005 and abs(np.std(np.log(result.getSamples("m"))) - 0.1) < 0.005
+        assert set(np.unique(result.getSamples("k"))) == {1.0, 2.0, 3.0, 4.0}
+        # Common random numbers: each input is sampled the same whatever the other inputs
+        other = MonteCarlo(p, {"m": Uniform(0, 1)}, refContext=Context({"z": 3.0})).run(20000, outputs=["x"], batchSize=5000, keepSamples=True)
+        assert np.array_equal(other.getSamples("x"), result.getSamples("x"))
+    # Samples that can't be solved are counted, and left out of the statistics
+    x = ScalarVariable("x")
+    y = ScalarVariable("y")
+    p = Problem("Monte Carlo failures")
+    p.addConstr(EqualityConstraint("root", ProductExpression(y, y), x))
+    result = MonteCarlo(p, {"x": Uniform(-1, 3)}, refContext=Context({"y": 1.0})).run(100, sampling=SAMPLING_RANDOM, batchSize=50)
+    assert 10 < result.failures < 40 and result.stats["x"].min > 0
+    assert result.stats["y"].count == 100 - result.failures
+    assert abs(result.mean("y") - 2.0 / np.sqrt(3.0)) < 0.15
+    # The streaming statistics agree with working them out from every value
+    values = np.random.default_rng(1).lognormal(0.0, 0.5, 100000)
+    (stats, sketch) = (RunningStats(), QuantileSketch())
+    for batch in np.split(values, 10):
+        stats.add(batch)
+        sketch.add(batch)
+    assert np.isclose(stats.mean, values.mean()) and np.isclose(stats.variance(), values.var(ddof=1))
+    assert np.allclose(sketch.quantile([0.01, 0.5, 0.99]), np.quantile(values, [0.01, 0.5, 0.99]), rtol=0.01)
+    assert len(sketch) <= 250
+    parser = LineParser(ScalarVariable)
+    assert parser.parseLine('d ~ Normal(2 * pi, 0.1) # comment') == ("distribution", "d", "normal", [2 * np.pi, 0.1])
+    assert parser.parseLine('d ~ empirical("values.txt")') == ("distribution", "d", "empirical", ["values.txt"])
+    try:
+        parser.parseLine("d ~ normal(a, 1)")
+        assert False, "should have failed"
+    except ProbSyntaxError as err:
+        assert err.column == 11
+
+def test_design_optimizer():
+    # A later solve can follow an earlier one's plan, as long as the same variables are inputs
+    p = ParsedProblem("examples/masses.prob")
+    plan = p.solve().plan
+    context = p.defaultContext.copy()
+    context.varVals["mass1.m"] = 3.0
+    result = p.solvePlan(plan, context)
+    expected = p.defaultContext.copy()
+    expected.varVals["mass1.m"] = 3.0
+    p.solve(expected)
+    assert result and [block.constrs for block in result.plan] == [block.constrs for block in plan]
+    assert all(np.isclose(context.varVals[name], expected.varVals[name]) for name in p.getVariableNames())
+    # With different inputs it solves from scratch instead
+    (context, expected) = (p.defaultContext.copy(), p.defaultContext.copy())
+    context.varVals["mass1.m"] = expected.varVals["mass1.m"] = None
+    (result, expectedResult) = (p.solvePlan(plan, context), p.solve(expected))
+    assert result.status == expectedResult.status and result.freeVars == expectedResult.freeVars
+    # Following a plan fails where it leads to an inconsistent check, or outside a function's domain
+    with tempfile.TemporaryDirectory() as tempdir:
+        with open(os.path.join(tempdir, "check.prob"), "w") as file:
+            file.write("x := 1\none := 1\ntwo := 2\ny = x + one\ny = two * x\n")
+        with open(os.path.join(tempdir, "domain.prob"), "w") as file:
+            file.write("x := 0.5\nsin(y) = x\nz = y + x\n")
+        for filename in ["check.prob", "domain.prob"]:
+            p = ParsedProblem(os.path.join(tempdir, filename))
+            plan = p.solve().plan
+            context = p.defaultContext.copy()
+            context.varVals["x"] = 2.0
+            result = p.solvePlan(plan, context)
+            assert not result and result.status == STATUS_FAILED
+            assert any(block.status == STATUS_FAILED for block in result.plan)
+    # Optimising through analytic steps and a numerical block (d), against known optima
+    with tempfile.TemporaryDirectory() as tempdir:
+        with open(os.path.join(tempdir, "beam.prob"), "w") as file:
+            file.write("w := 2\nh := 2\nA = w * h\nZ = w * h^2 / 6\nd^3 + d = A\n")
+        p = ParsedProblem(os.path.join(tempdir, "beam.prob"))
+    optimizer = DesignOptimizer(p, "A", ["w", "h"], {"w": (1, 5), "h": (1, 10)}, ["Z >= 10"])
+    result = optimizer.optimize()
+    assert result.success and np.isclose(result.design["w"], 1.0) and np.isclose(result.design["h"], np.sqrt(60.0))
+    assert np.isclose(result.context.varVals["d"] ** 3 + result.context.varVals["d"], result.objective)
+    assert result.solves < 20
+    result = DesignOptimizer(p, "Z", ["w", "h"], {"w": (1, 5), "h": (1, 10)}, ["A <= 8"], maximize=True).optimize()
+    assert result.success and np.isclose(result.objective, 64.0 / 6.0)
+    result = DesignOptimizer(p, "d", ["w"], {"w": (1, None)}, ["w * h >= 3 * d"]).optimize()
+    assert result.success and np.isclose(result.objective, np.sqrt(2.0))
+    # A design outside the model's domain stops the optimisation, rather than crashing it
+    with tempfile.TemporaryDirectory() as tempdir:
+        with open(os.path.join(tempdir, "domain.prob"), "w") as file:
+            file.write("x := 0.5\nsin(y) = x\nz = y + x\n")
+        domainProblem = ParsedProblem(os.path.join(tempdir, "domain.prob"))
+    result = DesignOptimizer(domainProblem, "z", ["x"], {"x": (0, 3)}, maximize=True).optimize()
+    assert not result.success and result.design is not None and result.design["x"] <= 1.0
+    # The shared-factorisation gradients match one-at-a-time ones
+    context = p.defaultContext.copy()
+    p.solve(context)
+    inputs = ["w", "h"]
+    assert gradients(p, context, ["A", "d", "Z - d"], inputs) == [gradient(p, context, metric, inputs) for metric in ["A", "d", "Z - d"]]
+    # Where the constraints are singular, the gradient is NaN (rather than the constraint being taken for a check)
+    with tempfile.TemporaryDirectory() as tempdir:
+        with open(os.path.join(tempdir, "cube.prob"), "w") as file:
+            file.write("a := 0\nz^3 = a\n")
+        p = ParsedProblem(os.path.join(tempdir, "cube.prob"))
+    context = p.defaultContext.copy()
+    assert p.solve(context)
+    assert np.isnan(gradient(p, context, "z", ["a"])["a"])
+
+def test_surrogate():
+    # With one solution, or too few for the interpolant, it gives the nearest solution's outputs
+    f = lambda a, b: a ** 2 + np.sin(3 * b)
+    s = RBFSurrogate(["a", "b"], ["y"])
+    assert s.predict({"a": 0, "b": 0}) is None
+    assert s.add({"a": 0, "b": 0}, {"y": f(0, 0)}) and s.add({"a": 1, "b": 1}, {"y": f(1, 1)})
+    assert s.predict({"a": 0.2, "b": 0.1}) == {"y": f(0, 0)}
+    # Solutions with missing values or the same inputs as one already added are left out
+    assert not s.add({"a": 0, "b": 0}, {"y": 5.0}) and not s.add({"a": 2, "b": 2}, {"y": None}) and len(s) == 2
+    # Added one at a time (refitting from scratch only every so often), it still interpolates the solutions exactly, and
+    # approximates between them about as well as fitting them all at once
+    rng = np.random.default_rng(0)
+    points = rng.uniform(0, 2, (120, 2))
+    for (a, b) in points:
+        s.add({"a": a, "b": b}, {"y": f(a, b)})
+    assert len(s) == 122 and s.addedSinceRefit > 0
+    assert all(np.isclose(s.predict({"a": a, "b": b})["y"], f(a, b)) for (a, b) in points[-s.addedSinceRefit:])
+    tests = [{"a": a, "b": b} for (a, b) in rng.uniform(0.2, 1.8, (50, 2))]
+    assert max(abs(s.predict(x)["y"] - f(x["a"], x["b"])) for x in tests) < 0.02
+    incremental = [s.predict(x)["y"] for x in tests]
+    s.refit()
+    assert np.allclose(incremental, [s.predict(x)["y"] for x in tests], atol=1e-3)
+    # Beyond the most solutions kept, the oldest are dropped
+    s = RBFSurrogate(["a"], ["y"], maxPoints=20)
+    for a in range(30):
+        s.add({"a": a}, {"y": a})
+    assert len(s) <= 20 and s.points[-1][0] == 29 and np.isclose(s.predict({"a": 25.5})["y"], 25.5)
+    # Fitted to a problem's solutions, from solved contexts
+    with tempfile.TemporaryDirectory() as tempdir:
+        with open(os.path.join(tempdir, "beam.prob"), "w") as file:
+            file.write("w := 2\nh := 2\nA = w * h\nd^3 + d = A\n")
+        p = ParsedProblem(os.path.join(tempdir, "beam.prob"))
+    s = RBFSurrogate(["w", "h"], ["A", "d"])
+    for w in np.linspace(1, 3, 6):
+        for h in np.linspace(1, 3, 6):
+            context = p.defaultContext.copy()
+            context.varVals.update(w=w, h=h)
+            assert p.solve(context) and s.addSolution(context)
+    context = p.defaultContext.copy()
+    context.varVals.update(w=2.1, h=1.7)
+    p.solve(context)
+    approx = s.predict(context.varVals)
+    assert abs(approx["A"] - context.varVals["A"]) < 1e-3 and abs(approx["d"] - context.varVals["d"]) < 1e-2
+
+def test_lazy_imports():
+    # Loading the solver core and parser shouldn't drag in the numerical libraries or the grammar
+    code = "import sys, equationsolver, parsedproblem; print(sorted(m for m in ['numpy', 'scipy', 'pyparsing'] if m in sys.modules))"
+    output = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+    assert output.stdout.strip() == "[]"
+
+def test_problem_cache():
+    # A cached problem should be reused until it, or a file it imports, changes
+    with tempfile.TemporaryDirectory() as tempdir:
+        for name in ["orbits.prob", "constants.prob"]:
+            shutil.copy(os.path.join("examples", name), tempdir)
+        filename = os.path.join(tempdir, "orbits.prob")
+        p = loadProblem(filename)
+        cached = readCache(cacheFilename(filename))
+        assert cached is not None
+        assert sorted(cached.getVariableNames()) == sorted(p.getVariableNames())
+        # Changing an imported file invalidates the cache
+        with open(os.path.join(tempdir, "constants.prob"), 'a') as file:
+            file.write("\nextra_constant == 2\n")
+        assert readCache(cacheFilename(filename)) is None
+        p = loadProblem(filename)
+        assert "extra_constant" in [expr.getName() for expr in p.exprs]
+        assert readCache(cacheFilename(filename)) is not None
+
+def test_diamond_import():
+    # Two files importing the same library should share one parse of it, and importing both is fine
+    files = {
+        "base.prob": 'k == 2\nx := 3\n',
+        "left.prob": 'import("base.prob")\nl = x * k\n',
+        "right.prob": 'import("base.prob")\nr = x + k\n',
+        "top.prob": 'import("left.prob")\nimport("right.prob")\nx := 5\n'
+    }
+    with tempfile.TemporaryDirectory() as tempdir:
+        for (name, contents) in files.items():
+            with open(os.path.join(tempdir, name), 'w') as file:
+                file.write(contents)
+        p = ParsedProblem(os.path.join(tempdir, "top.prob"))
+        base = getModule(os.path.join(tempdir, "base.prob"))
+        assert base is getModule(os.path.join(tempdir, "left.prob")).items[0][1]
+        assert base is getModule(os.path.join(tempdir, "right.prob")).items[0][1]
+        solveContext = p.defaultContext.copy()
+        assert p.solve(solveContext)
+        assert solveContext.varVals["l"] == 10
+        assert solveContext.varVals["r"] == 7
+        # Overriding the default in the importing file mustn't leak back into the shared module
+        assert base.defaultContext.varVals["x"] == 3
+
+def test_symbol_table():
+    # Nested namespaces, dotted names and aliased imports
+    table = SymbolTable()
+    x = ScalarVariable("x")
+    flow = ScalarVariable("pump1.flow")
+    assert table.define("x", x) is x
+    assert table.define("pump1.flow", flow) is flow
+    assert table.define("x", ScalarVariable("x")) is x
+    assert table.lookup("pump1.flow") is flow and table.lookup("pump1.x") is None
+    assert table.getNamespace("pump1").lookup("x") is x
+    assert table.getNamespace("pump1").getQualifiedName("flow") == "pump1.flow"
+    assert sorted(table.filter(ScalarVariable).keys()) == ["pump1.flow", "x"]
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        with open(os.path.join(tmpdir, "lib.prob"), "w") as f:
+            f.write("g := 9.81\nw = m*g\n")
+        with open(os.path.join(tmpdir, "main.prob"), "w") as f:
+            f.write('import("lib.prob") as lib\nlib.m := 2\nx = lib.w + 1\ny = lib.nothing\nlib.nothing := 3\nlib.nothing ~ normal(1, 2)\n')
+        p = ParsedProblem(os.path.join(tmpdir, "main.prob"))
+        # An aliased import's names are only available dotted
+        assert p.symbols.lookup("w") is None and p.findVar("lib.w").getName() == "lib.w"
+        assert p.getVariableNames() == ["lib.g", "lib.m", "lib.w", "x"] and p.distributions == {}
+        context = p.defaultContext.copy()
+        assert p.solve(context)
+        assert abs(context.getValue(p.findVar("x")) - 20.62) < 1e-9
+
+        # Each aliased import is a separate copy, so modules can share variable names
+        with open(os.path.join(tmpdir, "a.prob"), "w") as f:
+            f.write("x := 1\ny = 2*x\n")
+        with open(os.path.join(tmpdir, "b.prob"), "w") as f:
+            f.write("x := 5\nz = 3*x\n")
+        with open(os.path.join(tmpdir, "two.prob"), "w") as f:
+            f.write('import("a.prob") as a\nimport("b.prob") as b\nimport("a.prob") as c\nc.x := 2\nq = a.x + b.x + c.y\n')
+        p = ParsedProblem(os.path.join(tmpdir, "two.prob"))
+        assert p.findVar("a.x") is not p.findVar("b.x")
+        assert p.getVariableNames() == ["a.x", "a.y", "b.x", "b.z", "c.x", "c.y", "q"]
+        context = p.defaultContext.copy()
+        assert p.solve(context)
+        assert context.varVals["q"] == 1 + 5 + 4 and context.varVals["a.y"] == 2 and context.varVals["b.z"] == 15
+        # The module itself (shared with anything else importing it) is untouched
+        assert getModule(os.path.join(tmpdir, "a.prob")).getVariableNames() == ["x", "y"]
+        # Objects and aliased imports inside an aliased module are copied into its namespace too
+        with open(os.path.join(tmpdir, "mid.prob"), "w") as f:
+            f.write('class Mass {\n  F = m * acc\n  m := 3\n}\nMass m1(acc = 2)\nimport("a.prob") as inner\nw = m1.F + inner.y\n')
+        with open(os.path.join(tmpdir, "top.prob"), "w") as f:
+            f.write('import("mid.prob") as mid\nimport("mid.prob") as other\nother.inner.x := 10\nq = mid.w + other.w\n')
+        p = ParsedProblem(os.path.join(tmpdir, "top.prob"))
+        context = p.defaultContext.copy()
+        assert p.solve(context)
+        assert context.varVals["mid.m1.F"] == 6 and context.varVals["other.inner.y"] == 20 and context.varVals["q"] == 8 + 26
+
+def test_compact_expressions():
+    # Expressions have no per-instance dict, compare by interned id and only work out their text formula when asked
+    a = ScalarVariable("a")
+    expr = ProductExpression(a, SumExpression(FixedValue(1.0), ScalarVariable("b")))
+    assert not hasattr(a, "__dict__") and not hasattr(expr, "__dict__")
+    assert not hasattr(expr, "_name")
+    assert expr.name == "(a * (1.0 + b))"
+    # Variables with the same name are the same variable; composite expressions are only equal to themselves
+    assert ScalarVariable("a") == a and hash(ScalarVariable("a")) == hash(a)
+    assert expr == expr and expr != ProductExpression(a, SumExpression(FixedValue(1.0), ScalarVariable("b")))
+    copied = pickle.loads(pickle.dumps(expr))
+    assert copied.argA == a and copied.name == expr.name
+
+def test_tape():
+    # A tape evaluates the same residuals as the expression trees, for one context or a batch of them
+    p = ParsedProblem("examples/test.prob")
+    tape = p.getTape()
+    contexts = []
+    for i in range(3):
+        context = Context({name: 1.0 + 0.5 * i + 0.1 * j for (j, name) in enumerate(tape.slotNames)})
+        contexts.append(context)
+        expected = [constr.getResidual(context) for constr in tape.constrs]
+        assert np.allclose(tape.evaluate(tape.getValues(context)), expected)
+    batch = evaluateResiduals(p, contexts)
+    assert batch.shape == (3, len(p.constrs))
+    assert np.allclose(batch[2], [constr.getResidual(contexts[2]) for constr in tape.constrs])
+    # Finite-difference Jacobian of x*sin(y) - z = 0
+    x = ScalarVariable("x")
+    y = ScalarVariable("y")
+    z = ScalarVariable("z")
+    tape = Tape([EqualityConstraint("c", ProductExpression(x, SinExpression(y)), z)])
+    values = np.array([2.0, 0.5, 1.0])
+    (residuals, jac) = tape.jacobian(values, [0, 1, 2])
+    assert np.allclose(residuals, [2.0 * np.sin(0.5) - 1.0])
+    assert np.allclose(jac, [[np.sin(0.5), 2.0 * np.cos(0.5), -1.0]], atol=1e-6)
+
+def test_gradient():
+    # Exact reverse-mode Jacobian of x*sin(y) - z^x = 0
+    x = ScalarVariable("x")
+    y = ScalarVariable("y")
+    z = ScalarVariable("z")
+    tape = Tape([EqualityConstraint("c", ProductExpression(x, SinExpression(y)), PowerExpression(z, x))])
+    (residuals, jac) = tape.reverseJacobian(np.array([2.0, 0.5, 1.3]))
+    assert np.allclose(jac.toarray(), [[np.sin(0.5) - 1.3 ** 2 * np.log(1.3), 2.0 * np.cos(0.5), -2.0 * 1.3]])
+    # Gradient through a numerically-solved constraint: x + sin(x) = c, y = k*x, so d(y^2)/dc = 2yk / (1 + cos x)
+    c = ScalarVariable("c")
+    k = ScalarVariable("k")
+    p = Problem("Gradient test")
+    p.addConstrs(EqualityConstraint("a", SumExpression(x, SinExpression(x)), c), EqualityConstraint("b", y, ProductExpression(k, x)))
+    p.addExprs(x, y, c, k)
+    context = Context({"c": 2.0, "k": 3.0})
+    (solved, grad) = solveWithGradient(p, context, "y^2")
+    assert solved and sorted(grad.keys()) == ["c", "k"]
+    (xValue, yValue) = (context.varVals["x"], context.varVals["y"])
+    assert np.isclose(grad["c"], 2.0 * yValue * 3.0 / (1.0 + np.cos(xValue)))
+    assert np.isclose(grad["k"], 2.0 * yValue * xValue)
+    # Through objects, against finite differences
+    p = ParsedProblem("examples/masses.prob")
+    inputs = [name for name in p.getVariableNames() if p.defaultContext.varVals.get(name) is not None]
+    context = p.defaultContext.copy()
+    p.solve(context)
+    grad = gradient(p, context, "mass2.F / mass1.W", inputs)
+    perturbed = p.defaultContext.copy()
+    perturbed.varVals["mass1.m"] += 1e-6
+    p.solve(perturbed)
+    expected = (perturbed.varVals["mass2.F"] / perturbed.varVals["mass1.W"] - context.varVals["mass2.F"] / context.varVals["mass1.W"]) / 1e-6
+    assert np.isclose(grad["mass1.m"], expected, rtol=1e-4)
+
+def test_dof_analyzer():
+    # Which variables a choice of inputs determines, updated as inputs are toggled
+    p = ParsedProblem("examples/masses.prob")
+    analyzer = DOFAnalyzer(p)
+    assert analyzer.inputs == {"mass1.m", "mass1.g", "mass2.m", "mass2.g"}
+    report = analyzer.getReport()
+    assert report.isWellConstrained() and "total_weight" in report.determined
+    # One input too few: mass1.m, and everything depending on it, is free
+    analyzer.setInput("mass1.m", False)
+    assert analyzer.getMissingInputs() == 1 and analyzer.getExcessConstraints() == 0
+    report = analyzer.getReport()
+    assert {"mass1.m", "mass1.a", "total_weight"} <= report.free
+    assert "mass1.F" in report.determined and "mass1.F" not in report.free
+    # Swapping which variable is the input is fine; one too many over-constrains the weights
+    analyzer.setInput("total_weight", True)
+    assert analyzer.getReport().isWellConstrained()
+    analyzer.setInput("mass1.m", True)
+    report = analyzer.getReport()
+    assert report.excessConstraints == 1 and "Line 11" in report.overconstrained and not report.free
+    # The same answer as analysing from scratch
+    fresh = DOFAnalyzer(p, analyzer.inputs).getReport()
+    assert (fresh.determined, fresh.overconstrained) == (report.determined, report.overconstrained)
+
+def test_line_parser():
+    # Conventional operator precedence, and syntax errors reported with their position
+    parser = LineParser(ScalarVariable)
+    (kind, lhs, rhs, title) = parser.parseLine('y = a - b + c*d^e^f / -g "Title" # comment')
+    assert kind == "constraint" and title == "Title"
+    assert rhs.getName() == "((a - b) + ((c * (d ^ (e ^ f))) / (-1.0 * g)))"
+    assert parser.parseLine("x := -2")[2].getValue(None) == -2
+    assert parser.parseLine("   # nothing here") is None
+    try:
+        parser.parseLine("a = (b + c")
+        assert False, "should have failed"
+    except ProbSyntaxError as err:
+        assert err.column == 10
+
 if __name__ == '__main__':
     test_objects()